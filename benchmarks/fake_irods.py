@@ -0,0 +1,188 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""An in-process stand-in for the parts of partisan used by transponster.
+
+Objects only exist as a size in memory, and are downloaded as sparse files of
+that size. Every operation waits for a fixed latency, transfers are limited to
+a given bandwidth each, and every try of a transfer fails at a given rate.
+"""
+from dataclasses import dataclass, field
+from hashlib import md5
+from os import PathLike
+import os
+from pathlib import PurePath
+import random
+from threading import Lock
+from time import sleep
+from typing import Dict, Iterator, List, Optional
+
+
+class FakeIrodsError(Exception):
+    """Raised when an operation on the fake iRODS fails."""
+
+
+@dataclass
+class FakeIrods:
+    """Configuration and contents of a simulated iRODS zone.
+
+    Args:
+        latency: seconds taken by every operation, before any transfer.
+        bandwidth: bytes per second of each transfer, or None for no limit.
+        failure_rate: probability that a try of a transfer fails.
+        seed: seed for the failures, so that runs are repeatable.
+    """
+
+    latency: float = 0.0
+    bandwidth: Optional[float] = None
+    failure_rate: float = 0.0
+    seed: int = 0
+    sizes: Dict[str, int] = field(default_factory=dict)
+    operations: int = 0
+    failures: int = 0
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+        self._lock = Lock()
+
+    def add_objects(
+        self, collection: str, n_objects: int, size: int
+    ) -> "FakeCollection":
+        """Create a collection of objects of the same size.
+
+        Args:
+            collection: the path of the collection.
+            n_objects: the number of objects to create.
+            size: the size of each object in bytes.
+        """
+        for i in range(n_objects):
+            self.store(PurePath(collection, f"{i}.dat"), size)
+        return FakeCollection(collection, self)
+
+    def store(self, path: PathLike, size: int):
+        """Create or replace an object.
+
+        Args:
+            path: the path of the object.
+            size: the size of the object in bytes.
+        """
+        with self._lock:
+            self.sizes[str(path)] = size
+
+    def operation(self, n_bytes: Optional[int] = None, tries: int = 1):
+        """Simulate an operation, which is tried up to tries times.
+
+        Args:
+            n_bytes: the number of bytes transferred by the operation, or None if
+                it is not a transfer.
+            tries: the number of times to try the operation before giving up.
+        """
+        for _ in range(tries):
+            with self._lock:
+                self.operations += 1
+                failed = (
+                    n_bytes is not None and self._random.random() < self.failure_rate
+                )
+                if failed:
+                    self.failures += 1
+            duration = self.latency
+            if self.bandwidth is not None and n_bytes is not None:
+                duration += n_bytes / self.bandwidth
+            sleep(duration)
+            if not failed:
+                return
+        raise FakeIrodsError(f"Operation failed after {tries} tries")
+
+
+class FakeDataObject:
+    """A data object in a FakeIrods zone.
+
+    When created the same way as a partisan DataObject, from its path alone,
+    it belongs to the zone set as FakeDataObject.irods. As in partisan, path is
+    the collection holding the object and name its basename.
+    """
+
+    irods: Optional[FakeIrods] = None
+
+    def __init__(self, path: PathLike, irods: Optional[FakeIrods] = None) -> None:
+        self.path = PurePath(path).parent
+        self.name = PurePath(path).name
+        self._irods = irods if irods is not None else FakeDataObject.irods
+
+    def __str__(self) -> str:
+        return str(PurePath(self.path, self.name))
+
+    def __repr__(self) -> str:
+        return str(self)
+
+    def exists(self) -> bool:
+        """Whether the object exists."""
+        return str(self) in self._irods.sizes
+
+    def size(self) -> int:
+        """Size of the object in bytes."""
+        self._irods.operation()
+        return self._irods.sizes[str(self)]
+
+    def checksum(self) -> str:
+        """Checksum of the object."""
+        self._irods.operation()
+        return md5(f"{self}:{self._irods.sizes[str(self)]}".encode()).hexdigest()
+
+    def get(self, local_path: PathLike, tries: int = 1, **_):
+        """Download the object as a sparse file."""
+        size = self._irods.sizes[str(self)]
+        self._irods.operation(size, tries)
+        with open(local_path, "wb") as local_file:
+            local_file.truncate(size)
+
+    def put(self, local_path: PathLike, tries: int = 1, **_):
+        """Upload a local file as this object."""
+        size = os.path.getsize(local_path)
+        self._irods.operation(size, tries)
+        self._irods.store(str(self), size)
+
+
+class FakeCollection:
+    """A collection in a FakeIrods zone."""
+
+    def __init__(self, path: PathLike, irods: FakeIrods) -> None:
+        self.path = PurePath(path)
+        self.name = self.path.name
+        self._irods = irods
+
+    def __fspath__(self) -> str:
+        return str(self.path)
+
+    def __repr__(self) -> str:
+        return str(self.path)
+
+    def exists(self) -> bool:
+        """Collections always exist in the fake zone."""
+        return True
+
+    def iter_contents(self) -> Iterator[FakeDataObject]:
+        """Iterate over the data objects directly in this collection."""
+        self._irods.operation()
+        for path in sorted(self._irods.sizes):
+            if PurePath(path).parent == self.path:
+                yield FakeDataObject(path, self._irods)
+
+    def contents(self) -> List[FakeDataObject]:
+        """Get the data objects directly in this collection."""
+        return list(self.iter_contents())
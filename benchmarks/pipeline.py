@@ -0,0 +1,248 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Run the whole pipeline against a simulated iRODS and report its throughput.
+
+Usage:
+    python -m benchmarks.pipeline --batch_sizes 1 4 16 --stage_depths 1 4
+
+Every combination of batch size and stage depth is run on the same simulated
+inputs, and one line is reported for each.
+"""
+import argparse
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, List, Optional
+from unittest.mock import patch
+
+import structlog
+
+from benchmarks.fake_irods import FakeCollection, FakeDataObject, FakeIrods
+from transponster.async_controller import AsyncController
+from transponster.controller import Controller
+from transponster.input import iter_batches
+from transponster.util import Script, parse_size
+
+
+@dataclass
+class BenchmarkConfig:
+    """Parameters of one benchmark run."""
+
+    n_objects: int = 100
+    object_size: int = 2**20
+    batch_size: int = 1
+    stage_depth: int = 1
+    workers: int = 1
+    latency: float = 0.0
+    bandwidth: Optional[float] = None
+    failure_rate: float = 0.0
+    script_seconds: float = 0.0
+    script_seconds_per_input: float = 0.0
+    engine: str = "threads"
+
+
+@dataclass
+class BenchmarkResult:
+    """Throughput of one benchmark run."""
+
+    config: BenchmarkConfig
+    elapsed: float
+    batches: int
+    failed: int
+    bytes: int
+    utilisation: Dict[str, float]
+
+    @property
+    def batches_per_second(self) -> float:
+        """Batches uploaded per second."""
+        return self.batches / self.elapsed
+
+    @property
+    def bytes_per_second(self) -> float:
+        """Input bytes downloaded per second."""
+        return self.bytes / self.elapsed
+
+
+def make_script(directory: Path, seconds: float, seconds_per_input: float) -> Path:
+    """Write a script which sleeps, then copies its inputs to its outputs.
+
+    Args:
+        directory: the directory in which to write the script.
+        seconds: the time the script takes for every batch.
+        seconds_per_input: the extra time the script takes for every input.
+    """
+    script_path = Path(directory, "synthetic.sh")
+    script_path.write_text(
+        f"""#!/bin/bash
+n_inputs=$(ls input | wc -l)
+sleep "$(awk -v n="$n_inputs" 'BEGIN {{ print {seconds} + {seconds_per_input} * n }}')"
+for f in input/*; do
+    cp "$f" "output/$(basename "$f").out"
+done
+""",
+        encoding="utf-8",
+    )
+    script_path.chmod(0o755)
+    return script_path
+
+
+def run_benchmark(config: BenchmarkConfig, work_dir: Path) -> BenchmarkResult:
+    """Run the pipeline once against a simulated iRODS.
+
+    Args:
+        config: the parameters of the run.
+        work_dir: a directory for the script and scratch space of the run.
+    """
+    irods = FakeIrods(
+        latency=config.latency,
+        bandwidth=config.bandwidth,
+        failure_rate=config.failure_rate,
+    )
+    inputs = irods.add_objects("/fakeZone/inputs", config.n_objects, config.object_size)
+    outputs = FakeCollection("/fakeZone/outputs", irods)
+    scratch = Path(work_dir, "scratch")
+    scratch.mkdir(exist_ok=True)
+    script = Script(
+        make_script(work_dir, config.script_seconds, config.script_seconds_per_input)
+    )
+
+    # Outputs are created as partisan DataObjects by JobBatch
+    FakeDataObject.irods = irods
+    with patch("transponster.util.DataObject", FakeDataObject):
+        batches = iter_batches(inputs.contents(), scratch, config.batch_size)
+        if config.engine == "asyncio":
+            controller = AsyncController(
+                outputs,
+                script,
+                batches,
+                max_per_stage=config.stage_depth,
+                download_workers=config.workers,
+                upload_workers=config.workers,
+                processing_workers=config.workers,
+            )
+        else:
+            controller = Controller(
+                outputs,
+                script,
+                batches,
+                False,
+                max_per_stage=config.stage_depth,
+                scratch_location=scratch,
+                download_workers=config.workers,
+                upload_workers=config.workers,
+                processing_workers=config.workers,
+            )
+        start = perf_counter()
+        controller.run()
+        elapsed = perf_counter() - start
+
+    snapshot = controller.metrics.snapshot()
+    return BenchmarkResult(
+        config,
+        elapsed,
+        snapshot["stages"]["upload"]["batches"],
+        sum(stage["failed"] for stage in snapshot["stages"].values()),
+        snapshot["stages"]["download"]["bytes"],
+        {
+            name: stage["batch_seconds"] / (config.workers * elapsed)
+            for name, stage in snapshot["stages"].items()
+        },
+    )
+
+
+def format_results(results: List[BenchmarkResult]) -> str:
+    """Format benchmark results as a table."""
+    header = (
+        f"{'batch':>6}{'depth':>6}{'batches':>9}{'failed':>8}{'batches/s':>11}"
+        f"{'MiB/s':>9}{'download':>10}{'process':>9}{'upload':>8}"
+    )
+    rows = [header, "-" * len(header)]
+    for result in results:
+        rows.append(
+            f"{result.config.batch_size:>6}{result.config.stage_depth:>6}"
+            f"{result.batches:>9}{result.failed:>8}"
+            f"{result.batches_per_second:>11.2f}"
+            f"{result.bytes_per_second / 2**20:>9.1f}"
+            f"{result.utilisation['download']:>10.0%}"
+            f"{result.utilisation['processing']:>9.0%}"
+            f"{result.utilisation['upload']:>8.0%}"
+        )
+    return "\n".join(rows)
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--stage_depths", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--n_objects", type=int, default=100)
+    parser.add_argument("--object_size", default="1M")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="Seconds per iRODS operation."
+    )
+    parser.add_argument(
+        "--bandwidth", help="Bytes per second of each transfer, e.g. 100M."
+    )
+    parser.add_argument(
+        "--failure_rate",
+        type=float,
+        default=0.0,
+        help="Probability that a try of an iRODS operation fails.",
+    )
+    parser.add_argument("--script_seconds", type=float, default=0.05)
+    parser.add_argument("--script_seconds_per_input", type=float, default=0.0)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(
+            logging.INFO if args.verbose else logging.CRITICAL
+        )
+    )
+
+    results = []
+    for batch_size in args.batch_sizes:
+        for stage_depth in args.stage_depths:
+            config = BenchmarkConfig(
+                n_objects=args.n_objects,
+                object_size=parse_size(args.object_size),
+                batch_size=batch_size,
+                stage_depth=stage_depth,
+                workers=args.workers,
+                latency=args.latency,
+                bandwidth=(
+                    parse_size(args.bandwidth) if args.bandwidth is not None else None
+                ),
+                failure_rate=args.failure_rate,
+                script_seconds=args.script_seconds,
+                script_seconds_per_input=args.script_seconds_per_input,
+                engine=args.engine,
+            )
+            with TemporaryDirectory(prefix="transponster-benchmark-") as work_dir:
+                results.append(run_benchmark(config, Path(work_dir)))
+
+    print(format_results(results))
+
+
+if __name__ == "__main__":
+    main()
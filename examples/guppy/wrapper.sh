@@ -1,6 +1,6 @@
 #!/usr/bin/bash
 set -e
-GUPPY_BASECALL_ID=${GUPPY_BASECALL_ID:-0}
+GUPPY_BASECALL_ID=${GUPPY_BASECALL_ID:-${TRANSPONSTER_SLOT:-0}}
 GUPPY_CONFIG=${GUPPY_CONFIG:-dna_r10.4_e8.1_fast.cfg}
 
 guppy_basecaller -i ${1} -s guppy_output -c $GUPPY_CONFIG 
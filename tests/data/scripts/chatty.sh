@@ -0,0 +1,8 @@
+#!/bin/bash
+
+# Write a lot of output, then fail
+for i in $(seq 1 10000); do
+    echo "line $i"
+done
+echo "oops" >&2
+exit 1
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+for f in input/*; do
+    cp "$f" "output/$(basename "$f").out"
+done
@@ -0,0 +1,6 @@
+#!/bin/bash
+
+for f in input/*; do
+    echo "processing $f"
+    cp "$f" "output/$(basename "$f").out"
+done
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+echo "$TRANSPONSTER_SLOT" > output/slot.txt
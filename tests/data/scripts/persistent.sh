@@ -0,0 +1,13 @@
+#!/bin/bash
+
+while read -r working_dir; do
+    echo "Processing $working_dir"
+    echo "Working on $working_dir" >&2
+    if [ -f "$working_dir/input/7.txt" ]; then
+        echo "TRANSPONSTER error cannot process 7.txt"
+        continue
+    fi
+    test -f "$working_dir/input/13.txt" && exit 3
+    echo "$$" > "$working_dir/output/pid.txt"
+    echo "TRANSPONSTER ok"
+done
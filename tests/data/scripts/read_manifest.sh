@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Copy each input as soon as it is listed in the manifest
+n=0
+while true; do
+    mapfile -t lines < inputs.txt
+    while [ "$n" -lt "${#lines[@]}" ]; do
+        line="${lines[$n]}"
+        n=$((n + 1))
+        case "$line" in
+            "#done") exit 0 ;;
+            "#failed") exit 1 ;;
+            *) cp "$line" "output/$(basename "$line").out" ;;
+        esac
+    done
+    sleep 0.1
+done
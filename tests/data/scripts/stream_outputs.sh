@@ -0,0 +1,14 @@
+#!/bin/bash
+
+echo "early" > output/early.txt
+touch output/early.txt.done
+
+# Only finish once the early output has been uploaded and removed
+for _ in $(seq 50); do
+    [ -e output/early.txt ] || break
+    sleep 0.1
+done
+[ ! -e output/early.txt ] || exit 1
+
+echo "late" > output/late.txt
+touch output/late.txt.done
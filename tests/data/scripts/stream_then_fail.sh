@@ -0,0 +1,11 @@
+#!/bin/bash
+
+echo "early" > output/early.txt
+touch output/early.txt.done
+
+# Only fail once the early output has been uploaded and removed
+for _ in $(seq 50); do
+    [ -e output/early.txt ] || break
+    sleep 0.1
+done
+exit 1
@@ -0,0 +1,170 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import get_ident
+from time import sleep
+
+from partisan.irods import Collection
+
+from transponster.async_controller import AsyncController, _first_error
+from transponster.input import iter_batches_from_collection
+from transponster.util import BatchObserver, BatchState, Script
+
+
+class FailedBatches(BatchObserver):
+    """Records the inputs of the batches which failed."""
+
+    def __init__(self):
+        self.inputs = []
+
+    def batch_state_changed(self, batch, state):
+        if state == BatchState.FAILED:
+            self.inputs += [obj.data_obj.name for obj in batch.input_objs]
+
+
+class TestAsyncController:
+    def test_run(self, irods_inputs, irods_output_dir, scratch_folder):
+        """Test running the whole pipeline on a collection."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/copy_input.sh").resolve())
+        batches = iter_batches_from_collection(
+            Collection(irods_inputs), scratch_folder, batch_size=4
+        )
+
+        controller = AsyncController(
+            output_collection,
+            script,
+            batches,
+            max_per_stage=2,
+            download_workers=2,
+            upload_workers=2,
+            processing_workers=2,
+            transfer_workers=4,
+        )
+        controller.run()
+
+        assert controller.error_queue.empty()
+        assert controller.count == 4
+        assert controller.n_batches == 4
+        assert controller.metrics.snapshot()["stages"]["upload"]["batches"] == 4
+        assert sorted(obj.name for obj in output_collection.contents()) == sorted(
+            f"{i}.txt.out" for i in range(15)
+        )
+
+    def test_failed_batches(self, irods_inputs, irods_output_dir, scratch_folder):
+        """Test that batches fail as they do with the threaded engine."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/fails_on_7_and_13.sh").resolve())
+        batches = iter_batches_from_collection(Collection(irods_inputs), scratch_folder)
+        failed = FailedBatches()
+
+        controller = AsyncController(
+            output_collection,
+            script,
+            batches,
+            processing_workers=3,
+            observer=failed,
+        )
+        controller.run()
+
+        assert controller.count == 15
+        assert sorted(failed.inputs) == ["13.txt", "7.txt"]
+        snapshot = controller.metrics.snapshot()
+        assert snapshot["stages"]["processing"]["failed"] == 2
+        assert snapshot["stages"]["upload"]["batches"] == 13
+
+    def test_unexpected_error(self, irods_inputs, irods_output_dir, scratch_folder):
+        """Test failing batches on errors other than those of the script."""
+
+        class FailingObserver(FailedBatches):
+            def batch_state_changed(self, batch, state):
+                super().batch_state_changed(batch, state)
+                if state == BatchState.PROCESSING:
+                    raise RuntimeError("Observer failed")
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/copy_input.sh").resolve())
+        batches = iter_batches_from_collection(
+            Collection(irods_inputs), scratch_folder, batch_size=4
+        )
+        failed = FailingObserver()
+
+        controller = AsyncController(
+            output_collection, script, batches, observer=failed
+        )
+        controller.run()
+
+        assert controller.count == 4
+        assert controller.n_failed == 4
+        assert len(failed.inputs) == 15
+
+    def test_observers_off_the_loop(
+        self, irods_inputs, irods_output_dir, scratch_folder
+    ):
+        """Test that observers, which may block, are not called on the loop."""
+
+        class ThreadRecorder(BatchObserver):
+            def __init__(self):
+                self.threads = {}
+
+            def batch_state_changed(self, batch, state):
+                self.threads.setdefault(state, set()).add(get_ident())
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/fails_on_7_and_13.sh").resolve())
+        batches = iter_batches_from_collection(Collection(irods_inputs), scratch_folder)
+        recorder = ThreadRecorder()
+
+        controller = AsyncController(
+            output_collection, script, batches, observer=recorder
+        )
+        # The loop runs in the thread which runs the controller
+        controller.run()
+
+        assert controller.n_failed == 2
+        assert set(recorder.threads) == set(BatchState) - {BatchState.RETRYING}
+        for threads in recorder.threads.values():
+            assert get_ident() not in threads
+
+
+def test_first_error_waits_for_running_transfers():
+    """Test that transfers still running when one fails are waited for."""
+
+    finished = []
+
+    def fail():
+        raise OSError("Transfer failed")
+
+    def slow():
+        sleep(0.2)
+        finished.append(True)
+
+    async def first_error(pool):
+        # The slow transfer starts first, so that it is running when the other fails
+        transfers = [pool.submit(slow), pool.submit(fail)]
+        return await _first_error(transfers)
+
+    with ThreadPoolExecutor(2) as pool:
+        error = asyncio.run(first_error(pool))
+        assert finished == [True]
+    assert isinstance(error, OSError)
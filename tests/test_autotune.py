@@ -0,0 +1,108 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+from queue import Empty, Full, Queue
+
+import pytest
+
+from transponster.autotune import Autotuner
+from transponster.download_thread import DownloadThread
+from transponster.upload_thread import UploadThread
+from transponster.util import Channel, JobBatch, ScratchBudget
+
+
+@pytest.fixture
+def stages(scratch_folder):
+    processing_queue = Channel(maxsize=1)
+    upload_queue = Channel(maxsize=1)
+    scratch_budget = ScratchBudget(100)
+    download_thread = DownloadThread(
+        Channel(), processing_queue, Queue(), scratch_folder, max_workers=3
+    )
+    upload_thread = UploadThread(None, upload_queue, Queue(), max_workers=3)
+    autotuner = Autotuner(
+        download_thread,
+        upload_thread,
+        processing_queue,
+        upload_queue,
+        scratch_budget,
+        interval=0.1,
+    )
+    return autotuner, download_thread, upload_thread, processing_queue, upload_queue
+
+
+def starve(queue: Channel):
+    """Make a stage wait for a batch from an empty queue."""
+    with pytest.raises(Empty):
+        queue.get(timeout=0.05)
+
+
+def block(queue: Channel):
+    """Make a stage wait for room in a full queue."""
+    with pytest.raises(Full):
+        queue.put(None, timeout=0.06)
+
+
+class TestAutotuner:
+    def test_starved_processing(self, stages):
+        """Test that downloads are increased when processing waits for them."""
+        autotuner, download_thread, _, processing_queue, _ = stages
+
+        starve(processing_queue)
+        assert len(autotuner.step()) == 1
+        assert download_thread.n_workers == 2
+        assert processing_queue.maxsize == 2
+
+        # Nothing happened in the last interval
+        assert autotuner.step() == []
+
+        for _ in range(2):
+            starve(processing_queue)
+            autotuner.step()
+        assert download_thread.n_workers == 3
+
+    def test_downloads_ahead(self, stages):
+        """Test that downloads are decreased when they wait for processing."""
+        autotuner, download_thread, _, processing_queue, _ = stages
+        download_thread.set_workers(2)
+
+        processing_queue.put(None)
+        block(processing_queue)
+        autotuner.step()
+        assert download_thread.n_workers == 1
+        # The processing queue is never made smaller than it started
+        assert processing_queue.maxsize == 1
+
+    def test_blocked_processing(self, stages):
+        """Test that uploads are increased when processing waits for them."""
+        autotuner, _, upload_thread, _, upload_queue = stages
+
+        upload_queue.put(None)
+        block(upload_queue)
+        autotuner.step()
+        assert upload_thread.n_workers == 2
+        assert upload_queue.maxsize == 2
+
+    def test_scratch_budget(self, stages):
+        """Test that downloads are not increased when scratch is nearly used."""
+        autotuner, download_thread, _, processing_queue, _ = stages
+        autotuner.scratch_budget.charge(JobBatch(), 95)
+
+        starve(processing_queue)
+        assert "scratch" in autotuner.step()[0]
+        assert download_thread.n_workers == 1
@@ -0,0 +1,47 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+from benchmarks.pipeline import BenchmarkConfig, format_results, run_benchmark
+
+
+class TestBenchmark:
+    def test_run_benchmark(self, tmp_path):
+        """Test running the pipeline against the simulated iRODS."""
+        config = BenchmarkConfig(n_objects=10, object_size=1024, batch_size=3)
+        result = run_benchmark(config, tmp_path)
+
+        assert result.batches == 4
+        assert result.failed == 0
+        assert result.bytes == 10 * 1024
+        assert 0 < result.utilisation["processing"] <= 1
+        assert "batches/s" in format_results([result])
+
+    def test_asyncio_engine(self, tmp_path):
+        """Test benchmarking the asyncio engine."""
+        config = BenchmarkConfig(n_objects=10, batch_size=3, engine="asyncio")
+        result = run_benchmark(config, tmp_path)
+
+        assert result.batches == 4
+
+    def test_failed_transfers(self, tmp_path):
+        """Test that batches fail when every transfer fails."""
+        config = BenchmarkConfig(n_objects=4, object_size=1024, failure_rate=1.0)
+        result = run_benchmark(config, tmp_path)
+
+        assert result.batches == 0
+        assert result.failed == 4
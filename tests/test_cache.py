@@ -0,0 +1,127 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import os
+import socket
+import stat
+import subprocess
+from pathlib import Path
+from time import time
+
+from partisan.irods import DataObject
+
+from transponster.cache import InputCache
+
+
+class TestInputCache:
+    def test_hit_and_miss(self, irods_inputs, tmp_path):
+        """Test that a cached object is linked rather than downloaded again."""
+
+        cache = InputCache(Path(tmp_path, "cache"))
+        data_obj = DataObject(irods_inputs + "/2.txt")
+
+        first = Path(tmp_path, "first.txt")
+        second = Path(tmp_path, "second.txt")
+        cache.fetch(data_obj, first)
+        cache.fetch(data_obj, second)
+
+        assert cache.misses == 1
+        assert cache.hits == 1
+        assert second.read_text() == "File number 2"
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+        assert not os.stat(second).st_mode & stat.S_IWUSR
+
+    def test_key(self, irods_inputs):
+        """Test that objects of one collection with the same checksum differ."""
+
+        first = DataObject(irods_inputs + "/2.txt")
+        second = DataObject(irods_inputs + "/3.txt")
+
+        assert InputCache.key(first, "0" * 32) != InputCache.key(second, "0" * 32)
+
+    def test_persists_across_runs(self, irods_inputs, tmp_path):
+        """Test that entries from a previous cache are reused."""
+
+        data_obj = DataObject(irods_inputs + "/3.txt")
+        InputCache(Path(tmp_path, "cache")).fetch(data_obj, Path(tmp_path, "a.txt"))
+
+        cache = InputCache(Path(tmp_path, "cache"))
+        cache.fetch(data_obj, Path(tmp_path, "b.txt"))
+
+        assert cache.hits == 1
+        assert cache.misses == 0
+
+    def test_lru_eviction(self, irods_inputs, tmp_path):
+        """Test that least recently used entries are evicted."""
+
+        # Each file is 13 bytes, so only two fit in the cache
+        cache = InputCache(Path(tmp_path, "cache"), max_bytes=30)
+        for name in ["1.txt", "2.txt", "1.txt", "3.txt"]:
+            data_obj = DataObject(f"{irods_inputs}/{name}")
+            cache.fetch(data_obj, Path(tmp_path, f"{cache.hits + cache.misses}"))
+
+        assert cache.size == 26
+        assert len(os.listdir(cache.directory)) == 2
+
+        cache.fetch(DataObject(irods_inputs + "/1.txt"), Path(tmp_path, "hit"))
+        cache.fetch(DataObject(irods_inputs + "/2.txt"), Path(tmp_path, "miss"))
+
+        assert cache.hits == 2
+        assert cache.misses == 4
+
+    def test_partial_downloads(self, tmp_path):
+        """Test removing only the partial downloads of processes which are gone."""
+
+        directory = Path(tmp_path, "cache")
+        directory.mkdir()
+        with subprocess.Popen(["true"]) as process:
+            process.wait()
+        host = socket.gethostname()
+        key = "0" * 64
+        names = {
+            "running": f"{key}.{host}.{os.getpid()}.1.part",
+            "gone": f"{key}.{host}.{process.pid}.1.part",
+            "other_host": f"{key}.other.host.123.1.part",
+            "other_host_old": f"{key}.other.host.456.1.part",
+        }
+        for name in names.values():
+            Path(directory, name).touch()
+        two_days_ago = time() - 2 * 24 * 60 * 60
+        os.utime(Path(directory, names["other_host_old"]), (two_days_ago,) * 2)
+
+        InputCache(directory)
+
+        assert sorted(os.listdir(directory)) == sorted(
+            [names["running"], names["other_host"]]
+        )
+
+    def test_evicted_by_other_process(self, irods_inputs, tmp_path):
+        """Test that an entry removed by another process is downloaded again."""
+
+        cache = InputCache(Path(tmp_path, "cache"))
+        data_obj = DataObject(irods_inputs + "/4.txt")
+        cache.fetch(data_obj, Path(tmp_path, "first.txt"))
+        for path in cache.directory.iterdir():
+            path.unlink()
+
+        cache.fetch(data_obj, Path(tmp_path, "second.txt"))
+
+        assert cache.hits == 0
+        assert cache.misses == 2
+        assert Path(tmp_path, "second.txt").read_text() == "File number 4"
+        assert cache.size == 13
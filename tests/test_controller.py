@@ -0,0 +1,214 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import gc
+import json
+from pathlib import Path
+from queue import Queue
+from subprocess import CalledProcessError
+from threading import Thread
+import weakref
+
+from partisan.irods import Collection
+
+from transponster.controller import Controller, ErrorReporter
+from transponster.input import iter_batches_from_collection
+from transponster.leases import LeaseStore
+from transponster.reports import FailureLog
+from transponster.retry import RetryPolicy
+from transponster.util import (
+    ErrorType,
+    FailedJobBatch,
+    JobBatch,
+    ScratchBudget,
+    Script,
+)
+
+
+class TestController:
+    def test_run(self, irods_inputs, irods_output_dir, scratch_folder, tmp_path):
+        """Test running the whole pipeline on a collection."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/copy_input.sh").resolve())
+        batches = iter_batches_from_collection(
+            Collection(irods_inputs), scratch_folder, batch_size=4
+        )
+
+        controller = Controller(
+            output_collection,
+            script,
+            batches,
+            False,
+            max_per_stage=2,
+            scratch_location=scratch_folder,
+            download_workers=2,
+            upload_workers=2,
+            processing_workers=2,
+            metrics_file=Path(tmp_path, "metrics.json"),
+        )
+        controller.run()
+
+        assert controller.error_queue.empty()
+        assert controller.upload_thread.count == 4
+        with open(Path(tmp_path, "metrics.json")) as metrics_file:
+            metrics = json.load(metrics_file)
+        assert metrics["stages"]["upload"]["batches"] == 4
+        assert metrics["script"]["runs"] == 4
+        assert controller.input_thread.n_batches == 4
+        assert sorted(obj.name for obj in output_collection.contents()) == sorted(
+            f"{i}.txt.out" for i in range(15)
+        )
+
+    def test_early_start(
+        self, irods_inputs, irods_output_dir, scratch_folder, tmp_path
+    ):
+        """Test processing inputs as they are listed in the manifest."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/read_manifest.sh").resolve())
+        batches = iter_batches_from_collection(
+            Collection(irods_inputs), scratch_folder, batch_size=5
+        )
+
+        controller = Controller(
+            output_collection,
+            script,
+            batches,
+            False,
+            scratch_location=scratch_folder,
+            download_workers=2,
+            early_start=True,
+            trace_file=Path(tmp_path, "trace.json"),
+        )
+        controller.run()
+
+        assert controller.error_queue.empty()
+        assert controller.upload_thread.count == 3
+        assert sorted(obj.name for obj in output_collection.contents()) == sorted(
+            f"{i}.txt.out" for i in range(15)
+        )
+        with open(Path(tmp_path, "trace.json")) as trace_file:
+            events = json.load(trace_file)["traceEvents"]
+        assert len([event for event in events if event.get("cat") == "process"]) == 3
+
+    def test_failure_log(
+        self, irods_inputs, irods_output_dir, scratch_folder, tmp_path
+    ):
+        """Test recording the batches which fail as they fail."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/fails_on_7_and_13.sh").resolve())
+        batches = iter_batches_from_collection(Collection(irods_inputs), scratch_folder)
+        failure_log = FailureLog(
+            Path(tmp_path, "failures.jsonl"), Path(tmp_path, "rerun.txt")
+        )
+
+        controller = Controller(
+            output_collection,
+            script,
+            batches,
+            False,
+            scratch_location=scratch_folder,
+            processing_workers=2,
+            failure_log=failure_log,
+        )
+        controller.run()
+        failure_log.close()
+
+        assert controller.error_queue.empty()
+        assert controller.n_failed == 2
+        assert {failure["reason"] for failure in controller.failures} == {
+            "PROCESSING_FAILED"
+        }
+        with open(Path(tmp_path, "failures.jsonl")) as log_file:
+            records = [json.loads(line) for line in log_file]
+        assert {record["reason"] for record in records} == {"PROCESSING_FAILED"}
+        assert sorted(Path(tmp_path, "rerun.txt").read_text().splitlines()) == [
+            f"{irods_inputs}/13.txt",
+            f"{irods_inputs}/7.txt",
+        ]
+
+    def test_retry_with_one_worker(
+        self, irods_inputs, irods_output_dir, scratch_folder, tmp_path
+    ):
+        """Test retrying batches with a single worker, a lease store and a budget."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/fails_once.sh").resolve())
+        batches = iter_batches_from_collection(
+            Collection(irods_inputs), scratch_folder, batch_size=4
+        )
+        store = LeaseStore(Path(tmp_path, "leases.sqlite"))
+
+        controller = Controller(
+            output_collection,
+            script,
+            batches,
+            False,
+            scratch_location=scratch_folder,
+            # Only one batch fits in scratch at a time
+            scratch_budget=ScratchBudget(1),
+            lease_store=store,
+            retry_policy=RetryPolicy({ErrorType.PROCESSING_FAILED: 1}, backoff=0.01),
+        )
+        thread = Thread(target=controller.run, daemon=True)
+        thread.start()
+        thread.join(60)
+        assert not thread.is_alive()
+
+        assert controller.n_failed == 0
+        assert controller.upload_thread.count == 4
+        assert controller.metrics.snapshot()["stages"]["processing"]["retried"] == 4
+        assert store.count_states() == {"done": 4}
+        store.close()
+        assert sorted(obj.name for obj in output_collection.contents()) == sorted(
+            f"{i}.txt.out" for i in range(15)
+        )
+
+
+class TestErrorReporter:
+    def test_drop_failed_batches(self, scratch_folder):
+        """Test that failed batches are not kept once they are reported."""
+
+        error_queue = Queue()
+        reporter = ErrorReporter(error_queue)
+        reporter.start()
+        batch = JobBatch(scratch_location=scratch_folder)
+        output = b"x" * 64 * 1024
+        error_queue.put(
+            FailedJobBatch(
+                batch,
+                CalledProcessError(1, "script", output, output),
+                ErrorType.PROCESSING_FAILED,
+            )
+        )
+        batch_ref = weakref.ref(batch)
+        del batch
+
+        failures = reporter.stop()
+        gc.collect()
+        assert batch_ref() is None
+        assert failures == [
+            {
+                "reason": "PROCESSING_FAILED",
+                "error": "Command 'script' returned non-zero exit status 1.",
+                "inputs": [],
+                "uploaded": [],
+            }
+        ]
@@ -0,0 +1,298 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import os
+from queue import Queue
+from time import sleep
+
+from partisan.irods import Collection, DataObject
+
+from transponster.download_thread import DownloadThread
+from transponster.retry import RetryPolicy
+from transponster.util import (
+    BatchObserver,
+    BatchState,
+    Channel,
+    ClosedException,
+    ErrorType,
+    FailedJobBatch,
+    MANIFEST_DONE,
+    MANIFEST_FAILED,
+    JobBatch,
+)
+
+
+class StateRecorder(BatchObserver):
+    """Records every state change."""
+
+    def __init__(self):
+        self.states = []
+
+    def batch_state_changed(self, batch, state):
+        self.states.append(state)
+
+
+def fail_once(obj):
+    """Make the next download of an input fail."""
+    download = obj.download
+
+    def failing_download(*args, **kwargs):
+        obj.download = download
+        raise OSError("Transfer failed")
+
+    obj.download = failing_download
+
+
+def slow_down(obj, seconds: float):
+    """Make the downloads of an input take longer."""
+    download = obj.download
+
+    def slow_download(*args, **kwargs):
+        sleep(seconds)
+        return download(*args, **kwargs)
+
+    obj.download = slow_download
+
+
+def drain(queue: Channel) -> list:
+    """Get every item from a closed Channel."""
+    items = []
+    while True:
+        try:
+            items.append(queue.get())
+        except ClosedException:
+            return items
+
+
+class TestDownloadThread:
+    def test_concurrent_download(self, irods_inputs, scratch_folder):
+        """Test downloading several batches with a pool of workers."""
+
+        to_download = Channel()
+        for obj in Collection(irods_inputs).iter_contents():
+            batch = JobBatch(scratch_location=scratch_folder)
+            batch.add_input_obj(obj)
+            to_download.put(batch)
+        to_download.close()
+
+        downloaded = Channel()
+        error_queue = Queue()
+        download_thread = DownloadThread(
+            to_download, downloaded, error_queue, scratch_folder, n_workers=4
+        )
+        download_thread.start()
+        download_thread.join()
+
+        batches = drain(downloaded)
+        assert len(batches) == 15
+        assert error_queue.empty()
+        for batch in batches:
+            for obj in batch.input_objs:
+                assert obj.is_local
+                assert obj.local_folder.joinpath(obj.local_name).exists()
+
+    def test_failed_object_fails_batch(self, irods_inputs, scratch_folder):
+        """Test that one missing object fails its whole batch."""
+
+        batch = JobBatch(scratch_location=scratch_folder)
+        batch.add_input_obj(DataObject(irods_inputs + "/1.txt"))
+        batch.add_input_obj(DataObject(irods_inputs + "/doesnotexist.txt"))
+        to_download = Channel()
+        to_download.put(batch)
+        to_download.close()
+
+        downloaded = Channel()
+        error_queue = Queue()
+        download_thread = DownloadThread(
+            to_download, downloaded, error_queue, scratch_folder, n_workers=2
+        )
+        download_thread.start()
+        download_thread.join()
+
+        assert drain(downloaded) == [None]
+        failed_batch: FailedJobBatch = error_queue.get()
+        assert failed_batch.reason == ErrorType.DOWNLOAD_FAILED
+        assert failed_batch.job_batch is batch
+
+    def test_retry_failed_batch(self, irods_inputs, scratch_folder):
+        """Test retrying a batch which failed to download, then giving up."""
+
+        batch = JobBatch(scratch_location=scratch_folder)
+        batch.add_input_obj(DataObject(irods_inputs + "/1.txt"))
+        batch.add_input_obj(DataObject(irods_inputs + "/doesnotexist.txt"))
+        to_download = Channel()
+        to_download.put(batch)
+        to_download.close()
+
+        downloaded = Channel()
+        error_queue = Queue()
+        observer = StateRecorder()
+        download_thread = DownloadThread(
+            to_download,
+            downloaded,
+            error_queue,
+            scratch_folder,
+            observer=observer,
+            retry_policy=RetryPolicy({ErrorType.DOWNLOAD_FAILED: 2}, backoff=0.01),
+        )
+        download_thread.start()
+        download_thread.join()
+
+        assert drain(downloaded) == [None]
+        assert error_queue.get().reason == ErrorType.DOWNLOAD_FAILED
+        assert observer.states == [
+            BatchState.DOWNLOADING,
+            BatchState.RETRYING,
+            BatchState.DOWNLOADING,
+            BatchState.RETRYING,
+            BatchState.DOWNLOADING,
+            BatchState.FAILED,
+        ]
+        # The input which arrived is not downloaded again
+        assert batch.input_objs[0].is_local
+
+    def test_retry_remaining_inputs(self, irods_inputs, scratch_folder):
+        """Test retrying only the input which failed after the others arrived."""
+
+        batch = JobBatch(scratch_location=scratch_folder)
+        for i in range(3):
+            batch.add_input_obj(DataObject(f"{irods_inputs}/{i}.txt"))
+        fail_once(batch.input_objs[2])
+        to_download = Channel()
+        to_download.put(batch)
+        to_download.close()
+
+        downloaded = Channel()
+        error_queue = Queue()
+        observer = StateRecorder()
+        download_thread = DownloadThread(
+            to_download,
+            downloaded,
+            error_queue,
+            scratch_folder,
+            observer=observer,
+            retry_policy=RetryPolicy({ErrorType.DOWNLOAD_FAILED: 1}, backoff=0.01),
+        )
+        download_thread.start()
+        download_thread.join()
+
+        # Inputs are only downloaded once, as a second download would raise
+        assert drain(downloaded) == [batch]
+        assert error_queue.empty()
+        assert observer.states == [
+            BatchState.DOWNLOADING,
+            BatchState.RETRYING,
+            BatchState.DOWNLOADING,
+            BatchState.DOWNLOADED,
+        ]
+        assert sorted(os.listdir(batch.input_folder_path)) == [
+            "0.txt",
+            "1.txt",
+            "2.txt",
+        ]
+
+    def test_early_start_retry(self, irods_inputs, scratch_folder):
+        """Test listing the inputs which arrived while a failed batch stopped."""
+
+        batch = JobBatch(scratch_location=scratch_folder)
+        for i in range(2):
+            batch.add_input_obj(DataObject(f"{irods_inputs}/{i}.txt"))
+        # Still downloading when the other input fails
+        slow_down(batch.input_objs[0], 0.2)
+        fail_once(batch.input_objs[1])
+        slow_down(batch.input_objs[1], 0.05)
+        to_download = Channel()
+        to_download.put(batch)
+        to_download.close()
+
+        downloaded = Channel()
+        error_queue = Queue()
+        download_thread = DownloadThread(
+            to_download,
+            downloaded,
+            error_queue,
+            scratch_folder,
+            n_workers=2,
+            early_start=True,
+            retry_policy=RetryPolicy({ErrorType.DOWNLOAD_FAILED: 1}, backoff=0.01),
+        )
+        download_thread.start()
+        download_thread.join()
+
+        assert drain(downloaded) == [batch]
+        assert error_queue.empty()
+        assert batch.wait_for_downloads() is None
+        assert batch.manifest_path.read_text().splitlines() == [
+            "input/0.txt",
+            "input/1.txt",
+            MANIFEST_DONE,
+        ]
+
+    def test_early_start(self, irods_inputs, scratch_folder):
+        """Test that inputs are listed in the manifest as they are downloaded."""
+
+        batch = JobBatch(scratch_location=scratch_folder)
+        for i in range(3):
+            batch.add_input_obj(DataObject(f"{irods_inputs}/{i}.txt"))
+        to_download = Channel()
+        to_download.put(batch)
+        to_download.close()
+
+        downloaded = Channel()
+        error_queue = Queue()
+        download_thread = DownloadThread(
+            to_download, downloaded, error_queue, scratch_folder, early_start=True
+        )
+        download_thread.start()
+        download_thread.join()
+
+        assert drain(downloaded) == [batch]
+        assert batch.wait_for_downloads() is None
+        assert batch.manifest_path.read_text().splitlines() == [
+            "input/0.txt",
+            "input/1.txt",
+            "input/2.txt",
+            MANIFEST_DONE,
+        ]
+
+    def test_early_start_failure(self, irods_inputs, scratch_folder):
+        """Test that a batch passed on early records a failed download."""
+
+        batch = JobBatch(scratch_location=scratch_folder)
+        batch.add_input_obj(DataObject(irods_inputs + "/1.txt"))
+        batch.add_input_obj(DataObject(irods_inputs + "/doesnotexist.txt"))
+        to_download = Channel()
+        to_download.put(batch)
+        to_download.close()
+
+        downloaded = Channel()
+        error_queue = Queue()
+        download_thread = DownloadThread(
+            to_download, downloaded, error_queue, scratch_folder, early_start=True
+        )
+        download_thread.start()
+        download_thread.join()
+
+        # The failure is reported by the processing thread instead
+        assert drain(downloaded) == [batch]
+        assert error_queue.empty()
+        assert batch.wait_for_downloads() is not None
+        assert batch.manifest_path.read_text().splitlines() == [
+            "input/1.txt",
+            MANIFEST_FAILED,
+        ]
@@ -20,14 +20,41 @@ from pathlib import Path
 from queue import Queue
 from math import ceil
 
-from partisan.irods import Collection
+import pytest
+from pytest import raises
+
+from partisan.icommands import iput, irm
+from partisan.irods import Collection, DataObject
 
 from transponster.input import (
+    Shard,
     gen_download_queue_from_collection,
     gen_download_queue_from_file,
+    iter_batches,
+    iter_batches_by_size,
+    iter_batches_from_collection,
     scan_input_file,
 )
-from transponster.util import JobBatch
+from transponster.input_thread import InputThread
+from transponster.util import Channel, ClosedException, JobBatch
+
+
+@pytest.fixture
+def irods_nested_inputs(tmp_path):
+    """A collection of inputs with nested subcollections."""
+
+    local_root = Path(tmp_path, "nested")
+    for relative_path in ["3.txt", "a/1.txt", "a/b/2.txt", "c/4.txt"]:
+        local_path = Path(local_root, relative_path)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        local_path.write_text(f"File {relative_path}")
+
+    remote_location = "/testZone/home/irods/"
+    iput(local_root, remote_location, recurse=True)
+    try:
+        yield remote_location + "nested"
+    finally:
+        irm(remote_location + "nested", recurse=True)
 
 
 class TestInput:
@@ -125,3 +152,172 @@ class TestInput:
                 count += 1
 
             assert n_batches == count
+
+    def test_iter_batches(self, scratch_folder):
+        """Test batches are generated lazily, without allocating scratch space."""
+
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(7)]
+
+        batches = list(iter_batches(iter(objs), scratch_folder, batch_size=3))
+
+        assert [len(batch.input_objs) for batch in batches] == [3, 3, 1]
+        assert not any(batch.is_allocated for batch in batches)
+
+    def test_iter_batches_by_size(self, scratch_folder):
+        """Test packing objects into batches up to a target size."""
+
+        class SizedObject:
+            def __init__(self, name, size):
+                self.name = name
+                self._size = size
+
+            def size(self):
+                return self._size
+
+        sizes = [40, 50, 20, 150, 10, 10, 10, 10, 90]
+        objs = [SizedObject(f"{i}.fast5", size) for i, size in enumerate(sizes)]
+
+        batches = list(iter_batches_by_size(objs, scratch_folder, 100))
+        assert [[obj.size for obj in batch.input_objs] for batch in batches] == [
+            [40, 50],
+            [20],
+            [150],
+            [10, 10, 10, 10],
+            [90],
+        ]
+
+        batches = list(iter_batches_by_size(objs, scratch_folder, 100, 2))
+        assert [[obj.size for obj in batch.input_objs] for batch in batches] == [
+            [40, 50],
+            [20],
+            [150],
+            [10, 10],
+            [10, 10],
+            [90],
+        ]
+
+    def test_batch_bytes_collection(self, irods_inputs, scratch_folder):
+        """Test batching by size with an input collection."""
+
+        collection = Collection(irods_inputs)
+        batches = list(
+            iter_batches_from_collection(collection, scratch_folder, batch_bytes=30)
+        )
+
+        # Each file is 13 or 14 bytes long, so two of them fit in a batch
+        assert [len(batch.input_objs) for batch in batches] == [2] * 7 + [1]
+        for batch in batches:
+            assert batch.input_size <= 30
+
+    def test_recursive_collection(self, irods_nested_inputs, scratch_folder):
+        """Test finding inputs in subcollections and keeping their layout."""
+
+        collection = Collection(irods_nested_inputs)
+
+        with raises(NotImplementedError):
+            list(iter_batches_from_collection(collection, scratch_folder))
+
+        batches = list(
+            iter_batches_from_collection(
+                collection, scratch_folder, batch_size=10, recursive=True
+            )
+        )
+        assert len(batches) == 1
+
+        batch = batches[0]
+        assert sorted(obj.local_name for obj in batch.input_objs) == [
+            "3.txt",
+            "a/1.txt",
+            "a/b/2.txt",
+            "c/4.txt",
+        ]
+
+        batch.allocate()
+        for obj in batch.input_objs:
+            obj.download()
+        assert Path(batch.input_folder_path, "a/b/2.txt").read_text() == (
+            "File a/b/2.txt"
+        )
+
+
+class TestShard:
+    def test_parse(self):
+        assert Shard.parse("3/50") == Shard(3, 50)
+        assert str(Shard(3, 50)) == "3/50"
+        for value in ["50/50", "-1/50", "3", "a/b", "0/0"]:
+            with raises(ValueError):
+                Shard.parse(value)
+
+    def test_shards_partition_inputs(self):
+        """Test that every input belongs to exactly one shard."""
+        paths = [f"/seq/POG123/pass/{i}.fast5" for i in range(200)]
+        shards = [Shard(i, 7) for i in range(7)]
+
+        for path in paths:
+            assert sum(shard.contains(path) for shard in shards) == 1
+        # All shards get a share
+        for shard in shards:
+            assert any(shard.contains(path) for path in paths)
+
+    def test_sharded_collection(self, irods_inputs, scratch_folder):
+        """Test that shards of a collection together hold all of its inputs."""
+        collection = Collection(irods_inputs)
+
+        names = []
+        for index in range(3):
+            shard_names = [
+                obj.local_name
+                for batch in iter_batches_from_collection(
+                    collection, scratch_folder, shard=Shard(index, 3)
+                )
+                for obj in batch.input_objs
+            ]
+            # The inputs of one collection are split between the shards
+            assert shard_names
+            names += shard_names
+
+        assert sorted(names) == sorted(f"{i}.txt" for i in range(15))
+
+
+class TestInputThread:
+    def test_input_thread(self, scratch_folder):
+        """Test the input thread streams batches and then counts them."""
+
+        objs = (DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(5))
+        to_download = Channel(maxsize=1)
+        input_thread = InputThread(iter_batches(objs, scratch_folder), to_download)
+
+        input_thread.start()
+        assert isinstance(to_download.get(), JobBatch)
+        assert input_thread.n_batches is None
+
+        received = 1
+        while True:
+            try:
+                to_download.get()
+            except ClosedException:
+                break
+            received += 1
+        input_thread.join()
+
+        assert received == 5
+        assert input_thread.n_batches == 5
+        assert input_thread.exception is None
+
+    def test_input_thread_listing_fails(self):
+        """Test the input thread closes its queue when listing fails."""
+
+        def failing_batches():
+            yield JobBatch()
+            raise NotImplementedError("Subcollections are not yet supported")
+
+        to_download = Channel()
+        input_thread = InputThread(failing_batches(), to_download)
+        input_thread.start()
+        input_thread.join()
+
+        assert isinstance(to_download.get(), JobBatch)
+        with raises(ClosedException):
+            to_download.get()
+        assert isinstance(input_thread.exception, NotImplementedError)
+        assert input_thread.n_batches == 1
@@ -0,0 +1,84 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+from pathlib import Path
+
+from partisan.irods import Collection, DataObject
+
+from transponster.controller import Controller
+from transponster.input import iter_batches, iter_batches_from_collection
+from transponster.journal import Journal
+from transponster.util import BatchState, Script
+
+
+class TestJournal:
+    def test_record_states(self, tmp_path, scratch_folder):
+        """Test that the last state of each batch is recorded."""
+
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(3)]
+        first, second, third = iter_batches(objs, scratch_folder)
+
+        journal = Journal(Path(tmp_path, "journal.sqlite"))
+        journal.batch_state_changed(first, BatchState.QUEUED)
+        journal.batch_state_changed(first, BatchState.UPLOADED)
+        journal.batch_state_changed(second, BatchState.FAILED)
+
+        assert journal.get_state(first) == BatchState.UPLOADED
+        assert journal.get_state(second) == BatchState.FAILED
+        assert journal.get_state(third) is None
+        assert journal.count_states() == {
+            BatchState.UPLOADED: 1,
+            BatchState.FAILED: 1,
+        }
+
+        # A new run with the same inputs sees the same batches
+        journal.close()
+        journal = Journal(Path(tmp_path, "journal.sqlite"))
+        remaining = list(journal.skip_uploaded(iter_batches(objs, scratch_folder)))
+        assert [batch.key for batch in remaining] == [second.key, third.key]
+
+    def test_resume(self, irods_inputs, irods_output_dir, tmp_path, scratch_folder):
+        """Test that resuming a run skips the batches it uploaded."""
+
+        journal = Journal(Path(tmp_path, "journal.sqlite"))
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/copy_input.sh").resolve())
+
+        # Only the first half of the inputs get processed in the first run
+        batches = iter_batches_from_collection(
+            Collection(irods_inputs), scratch_folder, batch_size=2
+        )
+        first_half = [batch for _, batch in zip(range(4), batches)]
+        Controller(output_collection, script, first_half, False, observer=journal).run()
+
+        assert journal.count_states() == {BatchState.UPLOADED: 4}
+
+        batches = iter_batches_from_collection(
+            Collection(irods_inputs), scratch_folder, batch_size=2
+        )
+        controller = Controller(
+            output_collection,
+            script,
+            journal.skip_uploaded(batches),
+            False,
+            observer=journal,
+        )
+        controller.run()
+
+        assert controller.input_thread.n_batches == 4
+        assert journal.count_states() == {BatchState.UPLOADED: 8}
@@ -0,0 +1,240 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import multiprocessing
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from time import sleep
+
+import pytest
+from partisan.irods import Collection, DataObject
+
+from transponster.controller import Controller
+from transponster.input import iter_batches, iter_batches_from_collection
+from transponster.leases import LeaseQueue, LeaseStore
+from transponster.util import (
+    BatchObserver,
+    BatchState,
+    ClosedException,
+    ErrorType,
+    Script,
+)
+
+N_OBJS = 40
+
+
+class RecordingObserver(BatchObserver):
+    """Records the changes of state of the batches."""
+
+    def __init__(self):
+        self.changes = []
+
+    def batch_state_changed(self, batch, state):
+        self.changes.append((batch.key, state))
+
+
+def lease_all(path, scratch_folder, results):
+    """Lease batches from the store until there are none left."""
+
+    store = LeaseStore(path)
+    queue = LeaseQueue(store, scratch_folder, poll_interval=0.01)
+    objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(N_OBJS)]
+    for batch in iter_batches(objs, scratch_folder, batch_size=2):
+        queue.put(batch)
+    queue.close()
+
+    leased = []
+    try:
+        while True:
+            batch = queue.get()
+            leased.append(batch.key)
+            store.batch_state_changed(batch, BatchState.UPLOADED)
+    except ClosedException:
+        pass
+    store.close()
+    results.put(leased)
+
+
+class TestLeaseStore:
+    def test_processes_share_batches(self, tmp_path, scratch_folder):
+        """Test that each batch is leased by exactly one of several processes."""
+
+        path = Path(tmp_path, "leases.sqlite")
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=lease_all, args=(path, scratch_folder, results)
+            )
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        leased = [results.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+
+        keys = [key for keys in leased for key in keys]
+        assert len(keys) == N_OBJS // 2
+        assert len(set(keys)) == len(keys)
+        assert LeaseStore(path).count_states() == {"done": N_OBJS // 2}
+
+    def test_batches_of_one_collection(self, tmp_path, scratch_folder):
+        """Test that batches of one collection are kept apart and rebuilt whole."""
+
+        path = Path(tmp_path, "leases.sqlite")
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(2)]
+        batches = list(iter_batches(objs, scratch_folder))
+
+        store = LeaseStore(path)
+        for batch in batches:
+            store.add(batch)
+        assert store.count_states() == {"pending": 2}
+
+        leased = [store.lease(scratch_folder) for _ in batches]
+        assert sorted(batch.key for batch in leased) == sorted(
+            batch.key for batch in batches
+        )
+        assert sorted(str(batch.input_objs[0].data_obj) for batch in leased) == [
+            "/seq/POG123/pass/0.fast5",
+            "/seq/POG123/pass/1.fast5",
+        ]
+        store.close()
+
+    def test_reclaim_expired_lease(self, tmp_path, scratch_folder):
+        """Test that a batch whose lease expired is leased again."""
+
+        path = Path(tmp_path, "leases.sqlite")
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(2)]
+        (batch,) = iter_batches(objs, scratch_folder, batch_size=2)
+
+        # A process which leases the batch and dies without renewing its lease
+        dead = LeaseStore(path, lease_seconds=0.5)
+        dead.add(batch)
+        dead.finish_listing()
+        assert dead.lease(scratch_folder).key == batch.key
+        dead.close()
+
+        store = LeaseStore(path, lease_seconds=0.5)
+        assert store.lease(scratch_folder) is None
+        assert not store.finished()
+
+        sleep(0.6)
+        reclaimed = store.lease(scratch_folder)
+        assert reclaimed.key == batch.key
+        assert [obj.local_name for obj in reclaimed.input_objs] == [
+            "0.fast5",
+            "1.fast5",
+        ]
+
+        # The live process keeps its lease
+        sleep(0.6)
+        assert store.lease(scratch_folder) is None
+        assert not store.finished()
+
+        store.batch_state_changed(reclaimed, BatchState.UPLOADED)
+        assert store.finished()
+        store.close()
+
+    def test_give_up_expired_leases(self, tmp_path, scratch_folder):
+        """Test that a batch whose last lease expired fails and is reported once."""
+
+        path = Path(tmp_path, "leases.sqlite")
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(4)]
+        expired, other = iter_batches(objs, scratch_folder, batch_size=2)
+
+        # A process which leases the first batch for the last time and dies,
+        # and one which leases the other batch and finishes it
+        dead = LeaseStore(path, lease_seconds=0.2, max_attempts=1)
+        other_store = LeaseStore(path, max_attempts=1)
+        dead.add(expired)
+        dead.add(other)
+        dead.finish_listing()
+        assert dead.lease(scratch_folder).key == expired.key
+        dead.close()
+        assert other_store.lease(scratch_folder).key == other.key
+        other_store.batch_state_changed(other, BatchState.UPLOADED)
+
+        store = LeaseStore(path, lease_seconds=0.2, max_attempts=1)
+        observer = RecordingObserver()
+        error_queue = Queue()
+        queue = LeaseQueue(
+            store,
+            scratch_folder,
+            poll_interval=0.01,
+            observer=observer,
+            error_queue=error_queue,
+        )
+        with pytest.raises(ClosedException):
+            queue.get()
+
+        failed_batch = error_queue.get_nowait()
+        assert error_queue.empty()
+        assert failed_batch.reason == ErrorType.LEASE_EXPIRED
+        assert failed_batch.job_batch.key == expired.key
+        assert observer.changes == [(expired.key, BatchState.FAILED)]
+        # The batch leased by the other process is not counted here
+        assert queue.n_given_up == queue.n_batches == 1
+        assert store.count_states() == {"done": 1, "failed": 1}
+        assert other_store.give_up(scratch_folder) == []
+        for open_store in (store, other_store):
+            open_store.close()
+
+    def test_controllers(
+        self, irods_inputs, irods_output_dir, tmp_path, scratch_folder
+    ):
+        """Test two controllers sharing out batches through a lease store."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/copy_input.sh").resolve())
+        path = Path(tmp_path, "leases.sqlite")
+
+        stores = [LeaseStore(path) for _ in range(2)]
+        controllers = [
+            Controller(
+                output_collection,
+                script,
+                iter_batches_from_collection(
+                    Collection(irods_inputs), scratch_folder, batch_size=2
+                ),
+                False,
+                scratch_location=scratch_folder,
+                lease_store=store,
+            )
+            for store in stores
+        ]
+        threads = [Thread(target=controller.run) for controller in controllers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for store in stores:
+            store.close()
+
+        assert sum(controller.upload_thread.count for controller in controllers) == 8
+        assert all(controller.n_failed == 0 for controller in controllers)
+        # Each controller counts only the batches it leased
+        assert sum(controller.n_batches for controller in controllers) == 8
+        assert all(
+            controller.n_done == controller.n_batches for controller in controllers
+        )
+        assert LeaseStore(path).count_states() == {"done": 8}
+        assert sorted(obj.name for obj in output_collection.contents()) == sorted(
+            f"{i}.txt.out" for i in range(15)
+        )
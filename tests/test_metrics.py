@@ -0,0 +1,116 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+from pathlib import Path
+
+from partisan.irods import DataObject
+
+from transponster.metrics import (
+    Metrics,
+    format_prometheus,
+    format_summary,
+    write_metrics,
+)
+from transponster.util import BatchState, Channel, JobBatch
+
+
+def make_batch(scratch_folder, *sizes: int) -> JobBatch:
+    batch = JobBatch(scratch_location=scratch_folder)
+    for i, size in enumerate(sizes):
+        batch.add_input_obj(DataObject(f"/testZone/{i}.txt"), size=size)
+    return batch
+
+
+class TestMetrics:
+    def test_batch_through_stages(self, scratch_folder):
+        """Test the counters of a batch going through the whole pipeline."""
+        metrics = Metrics()
+        queue = Channel()
+        queue.put(1)
+        metrics.add_queue("download", queue)
+
+        batch = make_batch(scratch_folder, 10, 20)
+        for state in [
+            BatchState.QUEUED,
+            BatchState.DOWNLOADING,
+            BatchState.DOWNLOADED,
+            BatchState.PROCESSING,
+        ]:
+            metrics.batch_state_changed(batch, state)
+
+        snapshot = metrics.snapshot()
+        assert snapshot["stages"]["download"]["batches"] == 1
+        assert snapshot["stages"]["download"]["bytes"] == 30
+        assert snapshot["stages"]["processing"]["in_flight"] == 1
+        assert snapshot["queues"]["download"]["depth"] == 1
+
+        Path(batch.output_folder_path, "out.txt").write_text("12345")
+        for state in [
+            BatchState.PROCESSED,
+            BatchState.UPLOADING,
+            BatchState.UPLOADED,
+        ]:
+            metrics.batch_state_changed(batch, state)
+
+        snapshot = metrics.snapshot()
+        for stage in snapshot["stages"].values():
+            assert stage["batches"] == 1
+            assert stage["in_flight"] == 0
+        assert snapshot["stages"]["upload"]["bytes"] == 5
+        assert snapshot["script"]["runs"] == 1
+
+    def test_failures(self, scratch_folder):
+        """Test that failures are counted against the stage they happened in."""
+        metrics = Metrics()
+
+        never_downloaded = make_batch(scratch_folder, 1)
+        metrics.batch_state_changed(never_downloaded, BatchState.QUEUED)
+        metrics.batch_state_changed(never_downloaded, BatchState.FAILED)
+
+        failed_script = make_batch(scratch_folder, 1)
+        for state in [
+            BatchState.QUEUED,
+            BatchState.DOWNLOADING,
+            BatchState.DOWNLOADED,
+            BatchState.PROCESSING,
+            BatchState.FAILED,
+        ]:
+            metrics.batch_state_changed(failed_script, state)
+
+        snapshot = metrics.snapshot()
+        assert snapshot["stages"]["download"]["failed"] == 1
+        assert snapshot["stages"]["processing"]["failed"] == 1
+        assert snapshot["stages"]["processing"]["in_flight"] == 0
+        assert snapshot["script"]["runs"] == 1
+
+    def test_write_metrics(self, tmp_path):
+        """Test writing metrics as JSON and in the Prometheus format."""
+        metrics = Metrics()
+        snapshot = metrics.snapshot()
+
+        write_metrics(snapshot, tmp_path / "status.json")
+        with open(tmp_path / "status.json") as status:
+            assert json.load(status)["stages"]["upload"]["batches"] == 0
+
+        write_metrics(snapshot, tmp_path / "transponster.prom")
+        content = (tmp_path / "transponster.prom").read_text()
+        assert content == format_prometheus(snapshot)
+        assert 'transponster_batches_total{stage="download"} 0' in content
+
+        assert "processing" in format_summary(snapshot)
@@ -3,15 +3,25 @@ from pathlib import Path
 from queue import Queue
 import shutil
 from subprocess import CalledProcessError
+from threading import Thread
 
 import pytest
+from partisan.irods import Collection
 
 from transponster.processing_thread import ProcessingThread
+from transponster.retry import RetryPolicy
+from transponster.upload_thread import UploadThread
 from transponster.util import (
+    BatchObserver,
+    BatchState,
+    Channel,
+    ErrorType,
     FailedJobBatch,
     LocalObject2,
+    OutputCompletion,
+    PersistentScript,
     Script,
-    WrappedQueue,
+    ScratchBudget,
     JobBatch,
 )
 
@@ -19,7 +29,7 @@ from transponster.util import (
 @pytest.fixture
 def setup_input_queue():
     """Setup a mock queue of input files."""
-    input_queue = WrappedQueue()
+    input_queue = Channel()
 
     for dirpath, _, filenames in os.walk("tests/data/datafiles"):
         filenames.sort()
@@ -48,8 +58,8 @@ class TestFailures:
     def test_script_executable_not_found(self, setup_input_queue):
         """Test a script failing due to a wrong shebang."""
         input_queue = setup_input_queue
-        assert isinstance(input_queue, WrappedQueue)
-        output_queue = WrappedQueue()
+        assert isinstance(input_queue, Channel)
+        output_queue = Channel()
         error_queue = Queue()
 
         script = Script("tests/data/scripts/shebang_not_found.sh")
@@ -68,8 +78,8 @@ class TestFailures:
     def test_script_fails_on_certain_files(self, setup_input_queue):
         """Test a script failing only on certain inputs."""
         input_queue = setup_input_queue
-        assert isinstance(input_queue, WrappedQueue)
-        output_queue = WrappedQueue()
+        assert isinstance(input_queue, Channel)
+        output_queue = Channel()
         errors_queue = Queue()
 
         script = Script(Path("tests/data/scripts/fails_on_7_and_13.sh").resolve())
@@ -94,12 +104,146 @@ class TestFailures:
 
         assert errors_queue.empty()
 
+    def test_retry_failed_script(self, setup_input_queue):
+        """Test running a script again on the batches it failed on."""
+        input_queue = setup_input_queue
+        output_queue = Channel()
+        errors_queue = Queue()
+
+        script = Script(Path("tests/data/scripts/fails_once.sh").resolve())
+
+        processing_thread = ProcessingThread(
+            input_queue,
+            output_queue,
+            errors_queue,
+            script,
+            n_workers=2,
+            retry_policy=RetryPolicy({ErrorType.PROCESSING_FAILED: 1}, backoff=0.01),
+        )
+
+        processing_thread.start()
+        processing_thread.done = True
+        processing_thread.join()
+
+        assert errors_queue.empty()
+        batches = []
+        while not output_queue.empty():
+            batches.append(output_queue.get())
+        assert len(batches) == 15
+        for batch in batches:
+            # The outputs of the failed run are cleared
+            assert sorted(os.listdir(batch.output_folder_path)) == [
+                f"{batch.input_objs[0].local_name}.out"
+            ]
+
+    def test_retry_keeps_inputs_reserved(self):
+        """Test that a batch being retried keeps the scratch space of its inputs."""
+
+        class CountingBudget(ScratchBudget):
+            def __init__(self, total):
+                super().__init__(total)
+                self.reserved = []
+
+            def reserve_inputs(self, batch):
+                self.reserved.append(batch)
+                super().reserve_inputs(batch)
+
+        budget = CountingBudget(10)
+        batches = []
+        for _ in range(2):
+            batch = JobBatch()
+            Path(batch.input_folder_path, "0.txt").write_text("0123456789")
+            batch.input_objs.append(
+                LocalObject2(
+                    None,
+                    "0.txt",
+                    batch.input_folder_path,
+                    is_local=True,
+                    is_remote=False,
+                    size=10,
+                )
+            )
+            batches.append(batch)
+        retried, waiting = batches
+        budget.reserve_inputs(retried)
+        # A batch waiting to be downloaded, which must not take the space of
+        # the inputs of the retried batch
+        reservation = Thread(target=budget.reserve_inputs, args=(waiting,))
+        used = []
+
+        class BudgetObserver(BatchObserver):
+            def batch_state_changed(self, batch, state):
+                if state == BatchState.RETRYING:
+                    reservation.start()
+                elif state == BatchState.PROCESSING:
+                    used.append((budget.used, waiting.reserved_bytes))
+
+        input_queue = Channel()
+        input_queue.put(retried)
+        input_queue.close()
+        output_queue = Channel()
+        errors_queue = Queue()
+        processing_thread = ProcessingThread(
+            input_queue,
+            output_queue,
+            errors_queue,
+            Script(Path("tests/data/scripts/fails_once.sh").resolve()),
+            retry_policy=RetryPolicy({ErrorType.PROCESSING_FAILED: 1}, backoff=0.01),
+            scratch_budget=budget,
+            observer=BudgetObserver(),
+        )
+        processing_thread.start()
+        processing_thread.join(30)
+
+        assert not processing_thread.is_alive()
+        assert errors_queue.empty()
+        assert output_queue.get() is retried
+        assert used == [(10, 0), (10, 0)]
+        # The space of its inputs is not reserved again for the retry
+        assert budget.reserved == [retried, waiting]
+        # Only its outputs are left once processed, until they are uploaded
+        assert budget.used == retried.reserved_bytes == 10
+        budget.release(retried)
+        reservation.join(30)
+        assert waiting.reserved_bytes == budget.used == 10
+
+    def test_unexpected_error(self, setup_input_queue):
+        """Test failing batches on errors other than those of the script."""
+
+        class FailingObserver(BatchObserver):
+            def batch_state_changed(self, batch, state):
+                if state == BatchState.PROCESSING:
+                    raise RuntimeError("Observer failed")
+
+        output_queue = Channel()
+        errors_queue = Queue()
+        script = Script(Path("tests/data/scripts/copy_input.sh").resolve())
+
+        processing_thread = ProcessingThread(
+            setup_input_queue,
+            output_queue,
+            errors_queue,
+            script,
+            observer=FailingObserver(),
+        )
+
+        processing_thread.start()
+        processing_thread.done = True
+        processing_thread.join()
+
+        assert processing_thread.retrier.pending == 0
+        for _ in range(15):
+            failed_batch: FailedJobBatch = errors_queue.get_nowait()
+            assert isinstance(failed_batch.exception, RuntimeError)
+            assert "Observer failed" in failed_batch.get_error_message()
+        assert errors_queue.empty()
+
     def test_not_executable(self, setup_input_queue):
         """Test running ProcessingThread with a non-executable script."""
 
         input_queue = setup_input_queue
-        assert isinstance(input_queue, WrappedQueue)
-        output_queue = WrappedQueue()
+        assert isinstance(input_queue, Channel)
+        output_queue = Channel()
         errors_queue = Queue()
 
         script = Script(Path("tests/data/scripts/not_executable.sh").resolve())
@@ -117,3 +261,176 @@ class TestFailures:
         while not errors_queue.empty():
             failed_batch: FailedJobBatch = errors_queue.get()
             assert isinstance(failed_batch.exception, PermissionError)
+
+
+class TestSlots:
+    def test_concurrent_slots(self, setup_input_queue):
+        """Test running scripts in several slots at once."""
+        input_queue = setup_input_queue
+        input_queue.close()
+        output_queue = Channel()
+        errors_queue = Queue()
+
+        script = Script(Path("tests/data/scripts/output_slot.sh").resolve())
+
+        processing_thread = ProcessingThread(
+            input_queue, output_queue, errors_queue, script, n_workers=3
+        )
+        processing_thread.start()
+        processing_thread.join()
+
+        assert errors_queue.empty()
+
+        n_batches = 0
+        while not output_queue.empty():
+            batch: JobBatch = output_queue.get()
+            with open(Path(batch.output_folder_path, "slot.txt")) as slot_file:
+                assert int(slot_file.read()) in range(3)
+            n_batches += 1
+
+        assert n_batches == 15
+
+
+class TestLogs:
+    def test_upload_logs(self, setup_input_queue):
+        """Test moving the logs of successful scripts to their outputs."""
+        input_queue = setup_input_queue
+        input_queue.close()
+        output_queue = Channel()
+        errors_queue = Queue()
+
+        script = Script(Path("tests/data/scripts/log_inputs.sh").resolve())
+        processing_thread = ProcessingThread(
+            input_queue, output_queue, errors_queue, script, upload_logs=True
+        )
+        processing_thread.start()
+        processing_thread.join()
+
+        assert errors_queue.empty()
+        batch = output_queue.get()
+        name = batch.input_objs[0].local_name
+        assert sorted(os.listdir(batch.output_folder_path)) == [
+            f"{name}.out",
+            f"{name}.stdout.log",
+        ]
+        assert (
+            Path(batch.output_folder_path, f"{name}.stdout.log").read_text()
+            == f"processing input/{name}\n"
+        )
+
+
+class TestPersistentScript:
+    def test_persistent_script(self, setup_input_queue):
+        """Test running batches through a persistent script which fails once and dies once."""
+        input_queue = setup_input_queue
+        input_queue.close()
+        output_queue = Channel()
+        errors_queue = Queue()
+
+        script = PersistentScript(Path("tests/data/scripts/persistent.sh").resolve())
+
+        processing_thread = ProcessingThread(
+            input_queue, output_queue, errors_queue, script
+        )
+        processing_thread.start()
+        processing_thread.join()
+
+        # Batches are processed in the order 0, 1, 10, ..., 13, 14, 2, ..., 7, 8, 9
+        failed_batch: FailedJobBatch = errors_queue.get()
+        working_dir = failed_batch.job_batch.tmp_dir.name
+        assert failed_batch.job_batch.input_objs[0].local_name == "13.txt"
+        assert failed_batch.exception.returncode == 3
+        assert failed_batch.exception.stderr == f"Working on {working_dir}\n".encode()
+
+        failed_batch = errors_queue.get()
+        working_dir = failed_batch.job_batch.tmp_dir.name
+        assert failed_batch.job_batch.input_objs[0].local_name == "7.txt"
+        assert failed_batch.exception.stderr == (
+            f"Working on {working_dir}\ncannot process 7.txt".encode()
+        )
+        assert errors_queue.empty()
+
+        pids = set()
+        while not output_queue.empty():
+            batch = output_queue.get()
+            if batch is not None:
+                pids.add(Path(batch.output_folder_path, "pid.txt").read_text())
+                # The output of the script is logged in the batch it ran
+                working_dir = batch.tmp_dir.name
+                assert (
+                    Path(working_dir, "stdout.log").read_text()
+                    == f"Processing {working_dir}\n"
+                )
+                assert (
+                    Path(working_dir, "stderr.log").read_text()
+                    == f"Working on {working_dir}\n"
+                )
+
+        # The script was restarted once after exiting on 13.txt
+        assert len(pids) == 2
+
+
+class TestStreamOutputs:
+    def test_upload_while_running(self, irods_output_dir, scratch_folder):
+        """Test that completed outputs are uploaded before the script exits."""
+        input_queue = Channel()
+        batch = JobBatch(scratch_location=scratch_folder)
+        input_queue.put(batch)
+        input_queue.close()
+        output_queue = Channel()
+        errors_queue = Queue()
+
+        output_collection = Collection(irods_output_dir)
+        upload_thread = UploadThread(output_collection, output_queue, errors_queue)
+        script = Script(Path("tests/data/scripts/stream_outputs.sh").resolve())
+        processing_thread = ProcessingThread(
+            input_queue,
+            output_queue,
+            errors_queue,
+            script,
+            stream_outputs=OutputCompletion.SENTINEL,
+            uploader=upload_thread,
+            poll_interval=0.1,
+        )
+        processing_thread.start()
+        upload_thread.start()
+        processing_thread.join()
+        upload_thread.join()
+
+        assert errors_queue.empty()
+        assert upload_thread.count == 1
+        names = sorted(obj.name for obj in output_collection.contents())
+        assert names == ["early.txt", "late.txt"]
+
+    def test_report_early_uploads_of_failed_batch(
+        self, irods_output_dir, scratch_folder
+    ):
+        """Test that the outputs uploaded before a batch failed are reported."""
+        input_queue = Channel()
+        batch = JobBatch(scratch_location=scratch_folder)
+        input_queue.put(batch)
+        input_queue.close()
+        output_queue = Channel()
+        errors_queue = Queue()
+
+        output_collection = Collection(irods_output_dir)
+        upload_thread = UploadThread(output_collection, output_queue, errors_queue)
+        script = Script(Path("tests/data/scripts/stream_then_fail.sh").resolve())
+        processing_thread = ProcessingThread(
+            input_queue,
+            output_queue,
+            errors_queue,
+            script,
+            stream_outputs=OutputCompletion.SENTINEL,
+            uploader=upload_thread,
+            poll_interval=0.1,
+        )
+        processing_thread.start()
+        upload_thread.start()
+        processing_thread.join()
+        upload_thread.join()
+
+        failed_batch: FailedJobBatch = errors_queue.get_nowait()
+        assert failed_batch.reason == ErrorType.PROCESSING_FAILED
+        assert failed_batch.uploaded == [str(Path(output_collection.path, "early.txt"))]
+        assert errors_queue.empty()
@@ -0,0 +1,132 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+from pathlib import Path
+from subprocess import CalledProcessError
+
+from partisan.irods import DataObject
+from pytest import raises
+
+from transponster.input import Shard, iter_batches
+from transponster.reports import (
+    FailureLog,
+    describe_failure,
+    make_error_report,
+    merge_error_reports,
+)
+from transponster.util import ErrorType, FailedJobBatch
+
+
+def shard_report(scratch_folder, index, count, names):
+    objs = [DataObject(f"/seq/POG123/pass/{name}") for name in names]
+    failed = [
+        describe_failure(
+            FailedJobBatch(
+                batch, CalledProcessError(1, "script"), ErrorType.PROCESSING_FAILED
+            )
+        )
+        for batch in iter_batches(objs, scratch_folder)
+    ]
+    return make_error_report(failed, 10, None, Shard(index, count))
+
+
+class TestErrorReports:
+    def test_make_report(self, scratch_folder):
+        report = shard_report(scratch_folder, 1, 3, ["1.fast5"])
+        assert report["shard"] == "1/3"
+        assert report["failed"] == [
+            {
+                "reason": "PROCESSING_FAILED",
+                "error": "Command 'script' returned non-zero exit status 1.",
+                "inputs": ["/seq/POG123/pass/1.fast5"],
+                "uploaded": [],
+            }
+        ]
+
+    def test_merge_reports(self, scratch_folder):
+        """Test merging reports, and finding shards without a report."""
+        reports = [
+            shard_report(scratch_folder, 2, 4, ["1.fast5", "2.fast5"]),
+            shard_report(scratch_folder, 0, 4, ["3.fast5"]),
+            shard_report(scratch_folder, 3, 4, []),
+        ]
+        reports[2]["input_error"] = "RodsError()"
+
+        merged = merge_error_reports(reports)
+        assert merged["shards"] == ["0/4", "2/4", "3/4"]
+        assert merged["missing_shards"] == [1]
+        assert merged["n_batches"] == 30
+        assert merged["input_errors"] == {"3/4": "RodsError()"}
+        assert len(merged["failed"]) == 3
+
+    def test_merge_different_counts(self, scratch_folder):
+        reports = [
+            shard_report(scratch_folder, 0, 2, []),
+            shard_report(scratch_folder, 0, 3, []),
+        ]
+        with raises(ValueError):
+            merge_error_reports(reports)
+
+
+class TestFailureLog:
+    def test_record(self, scratch_folder, tmp_path):
+        """Test appending failures to the failure log and the rerun list."""
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(3)]
+        first, second = iter_batches(objs, scratch_folder, batch_size=2)
+        log_path = Path(tmp_path, "failures.jsonl")
+        rerun_path = Path(tmp_path, "rerun.txt")
+
+        failure_log = FailureLog(log_path, rerun_path)
+        failure_log.record(
+            FailedJobBatch(
+                first,
+                CalledProcessError(1, "script", b"out", b"err"),
+                ErrorType.PROCESSING_FAILED,
+            )
+        )
+        # Written straight away
+        assert rerun_path.read_text().splitlines() == [
+            "/seq/POG123/pass/0.fast5",
+            "/seq/POG123/pass/1.fast5",
+        ]
+        failure_log.record(
+            FailedJobBatch(second, OSError("timed out"), ErrorType.UPLOAD_FAILED)
+        )
+        failure_log.close()
+
+        records = [json.loads(line) for line in log_path.read_text().splitlines()]
+        assert [record["reason"] for record in records] == [
+            "PROCESSING_FAILED",
+            "UPLOAD_FAILED",
+        ]
+        assert records[1]["inputs"] == ["/seq/POG123/pass/2.fast5"]
+        assert records[1]["logs"] == {}
+        logs = records[0]["logs"]
+        assert Path(logs["stdout"]).read_bytes() == b"out"
+        assert Path(logs["stderr"]).read_bytes() == b"err"
+        assert Path(logs["stdout"]).parent == Path(tmp_path, "failures.logs")
+
+        # Later runs append to the same files
+        failure_log = FailureLog(log_path, rerun_path)
+        failure_log.record(
+            FailedJobBatch(second, OSError("timed out"), ErrorType.UPLOAD_FAILED)
+        )
+        failure_log.close()
+        assert len(log_path.read_text().splitlines()) == 3
+        assert len(rerun_path.read_text().splitlines()) == 4
@@ -0,0 +1,132 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+from threading import Thread
+from time import sleep
+
+import pytest
+
+from transponster.retry import CircuitBreaker, Retrier, RetryPolicy
+from transponster.util import ErrorType, JobBatch
+
+
+def fail():
+    raise OSError("iRODS is down")
+
+
+class FakeClock:
+    """A clock which only moves when told to."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class TestRetryPolicy:
+    def test_parse(self):
+        """Test parsing the number of retries for each error type."""
+
+        policy = RetryPolicy.parse(["all=1", "UPLOAD_FAILED=3"], backoff=2)
+        assert policy.retries[ErrorType.DOWNLOAD_FAILED] == 1
+        assert policy.retries[ErrorType.UPLOAD_FAILED] == 3
+        assert policy.backoff == 2
+
+        with pytest.raises(ValueError):
+            RetryPolicy.parse(["download_failed"])
+        with pytest.raises(ValueError):
+            RetryPolicy.parse(["unknown=1"])
+
+    def test_delay(self):
+        """Test that the backoff doubles for each retry, up to the maximum."""
+
+        policy = RetryPolicy({ErrorType.UPLOAD_FAILED: 4}, backoff=10, max_backoff=25)
+        assert 5 <= policy.delay(ErrorType.UPLOAD_FAILED, 1) <= 10
+        assert 10 <= policy.delay(ErrorType.UPLOAD_FAILED, 2) <= 20
+        assert 12.5 <= policy.delay(ErrorType.UPLOAD_FAILED, 3) <= 25
+        assert policy.delay(ErrorType.UPLOAD_FAILED, 5) is None
+        assert policy.delay(ErrorType.DOWNLOAD_FAILED, 1) is None
+
+
+class TestRetrier:
+    def test_retry_unallocated_batch(self, scratch_folder):
+        """Test that retrying a batch does not allocate its scratch to log it."""
+
+        retrier = Retrier(RetryPolicy({ErrorType.DOWNLOAD_FAILED: 1}, backoff=0.01))
+        batch = JobBatch(scratch_location=scratch_folder)
+        retrier.enter(batch)
+
+        def resubmit():
+            raise OSError("Cannot resubmit")
+
+        assert retrier.retry(
+            batch, ErrorType.DOWNLOAD_FAILED, OSError("iRODS is down"), resubmit
+        )
+        retrier.wait()
+        assert not batch.is_allocated
+
+
+class TestCircuitBreaker:
+    def test_open_and_close(self):
+        """Test pausing transfers after failures, until a probe succeeds."""
+
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05, clock=clock)
+        for _ in range(2):
+            with pytest.raises(OSError):
+                breaker.call(fail)
+        assert breaker.is_open
+        assert breaker.n_opened == 1
+
+        # The probe fails, so transfers stay paused for another cooldown
+        clock.advance(0.05)
+        with pytest.raises(OSError):
+            breaker.call(fail)
+        assert breaker.is_open
+
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(breaker.call(lambda: "ok")))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        # No time passes on the clock, however long the transfers wait
+        sleep(0.2)
+        assert results == []
+        assert breaker.is_open
+
+        clock.advance(0.05)
+        for thread in threads:
+            thread.join()
+        assert results == ["ok"] * 3
+        assert not breaker.is_open
+        assert breaker.n_opened == 1
+
+    def test_disabled(self):
+        """Test that a breaker without a threshold never opens."""
+
+        breaker = CircuitBreaker()
+        for _ in range(10):
+            with pytest.raises(OSError):
+                breaker.call(fail)
+        assert not breaker.is_open
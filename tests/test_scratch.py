@@ -0,0 +1,114 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import gc
+import os
+from pathlib import Path
+import socket
+import subprocess
+
+from partisan.irods import Collection
+
+from transponster.controller import Controller
+from transponster.input import iter_batches_from_collection
+from transponster.scratch import ScratchCollector, remove_stale_scratch
+from transponster.util import (
+    SCRATCH_OWNER,
+    SCRATCH_PREFIX,
+    BatchState,
+    JobBatch,
+    Script,
+)
+
+
+def make_scratch(scratch: Path, name: str, owner: str = None) -> Path:
+    """Create a batch scratch directory with an input in it."""
+    path = Path(scratch, SCRATCH_PREFIX + name)
+    Path(path, "input").mkdir(parents=True)
+    Path(path, "input", "1.txt").write_text("1")
+    if owner is not None:
+        Path(path, SCRATCH_OWNER).write_text(owner)
+    return path
+
+
+class TestScratchCollector:
+    def test_free_failed_batches(self, tmp_path):
+        """Test freeing failed batches, except the first ones kept."""
+
+        collector = ScratchCollector(keep_failed=1)
+        batches = [JobBatch(scratch_location=tmp_path) for _ in range(3)]
+        paths = []
+        for batch in batches:
+            Path(batch.input_folder_path, "1.txt").write_text("1")
+            paths.append(Path(batch.tmp_dir.name))
+
+        collector.batch_state_changed(batches[0], BatchState.FAILED)
+        collector.batch_state_changed(batches[1], BatchState.FAILED)
+        collector.batch_state_changed(batches[2], BatchState.RETRYING)
+
+        assert collector.kept == [str(paths[0])]
+        assert not paths[1].exists()
+        assert paths[2].exists()
+        assert collector.freed_bytes == 1 + len(f"{socket.gethostname()}:{os.getpid()}")
+
+        # The kept batch outlives its JobBatch, and is not seen as stale
+        del batches
+        gc.collect()
+        assert paths[0].exists()
+        assert remove_stale_scratch(tmp_path) == 0
+        assert paths[0].exists()
+
+    def test_controller(self, irods_inputs, irods_output_dir, tmp_path):
+        """Test that failed batches do not hold on to scratch space."""
+
+        output_collection = Collection(irods_output_dir)
+        script = Script(Path("tests/data/scripts/fails_on_7_and_13.sh").resolve())
+        batches = iter_batches_from_collection(Collection(irods_inputs), tmp_path)
+
+        controller = Controller(
+            output_collection, script, batches, False, scratch_location=tmp_path
+        )
+        controller.run()
+
+        assert controller.n_failed == 2
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestRemoveStaleScratch:
+    def test_remove_stale_scratch(self, tmp_path):
+        """Test removing only the scratch of dead processes of this host."""
+
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        host = socket.gethostname()
+        stale = make_scratch(tmp_path, "stale", f"{host}:{dead.pid}")
+        live = make_scratch(tmp_path, "live", f"{host}:{os.getpid()}")
+        remote = make_scratch(tmp_path, "remote", f"not-{host}:{dead.pid}")
+        unmarked = make_scratch(tmp_path, "unmarked")
+        other = Path(tmp_path, "other")
+        other.mkdir()
+        Path(other, SCRATCH_OWNER).write_text(f"{host}:{dead.pid}")
+
+        freed = remove_stale_scratch(tmp_path)
+
+        assert freed == 1 + len(f"{host}:{dead.pid}")
+        assert not stale.exists()
+        assert live.exists()
+        assert remote.exists()
+        assert unmarked.exists()
+        assert other.exists()
@@ -0,0 +1,72 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+from pathlib import Path
+
+from partisan.irods import DataObject
+
+from transponster.input import iter_batches
+from transponster.trace import TraceRecorder
+from transponster.util import BatchState
+
+
+class TestTraceRecorder:
+    def test_overlapping_batches(self, tmp_path, scratch_folder):
+        """Test that batches in a stage at the same time get their own rows."""
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(2)]
+        first, second = iter_batches(objs, scratch_folder)
+
+        trace = TraceRecorder()
+        for batch in (first, second):
+            trace.batch_state_changed(batch, BatchState.QUEUED)
+            trace.batch_state_changed(batch, BatchState.DOWNLOADING)
+        trace.batch_state_changed(first, BatchState.DOWNLOADED)
+        trace.batch_state_changed(second, BatchState.FAILED)
+        trace.batch_state_changed(first, BatchState.PROCESSING)
+
+        trace_path = Path(tmp_path, "trace.json")
+        trace.write(trace_path)
+        with open(trace_path) as trace_file:
+            events = json.load(trace_file)["traceEvents"]
+
+        spans = {event["name"]: event for event in events if event["ph"] == "X"}
+        assert set(spans) == {"download 0", "download 1", "process 0"}
+        assert spans["download 0"]["tid"] != spans["download 1"]["tid"]
+        assert spans["download 1"]["args"]["failed"]
+        assert spans["process 0"]["args"]["unfinished"]
+        assert spans["download 0"]["args"]["first_input"] == (
+            "/seq/POG123/pass/0.fast5"
+        )
+        assert len([event for event in events if event["ph"] == "i"]) == 2
+        row_names = {event["args"]["name"] for event in events if event["ph"] == "M"}
+        assert {"download 0", "download 1", "process 0"} <= row_names
+
+    def test_unique_ids(self, scratch_folder):
+        """Test that batches queued after others finished get new ids."""
+        objs = [DataObject(f"/seq/POG123/pass/{i}.fast5") for i in range(3)]
+        first, second, third = iter_batches(objs, scratch_folder)
+
+        trace = TraceRecorder()
+        for batch in (first, second):
+            trace.batch_state_changed(batch, BatchState.QUEUED)
+        trace.batch_state_changed(first, BatchState.FAILED)
+        trace.batch_state_changed(third, BatchState.QUEUED)
+
+        names = [event["name"] for event in trace.events if event["ph"] == "i"]
+        assert names == ["queued 0", "queued 1", "queued 2"]
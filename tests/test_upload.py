@@ -16,13 +16,60 @@
 #
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
+from pathlib import Path
+from queue import Queue
+
 import pytest
+from partisan.irods import Collection
+
+from transponster.upload_thread import UploadThread
+from transponster.util import Channel, JobBatch
 
 
 @pytest.fixture
 def upload_queue():
-    pass
+    """A closed queue of batches which failed in previous stages."""
+    queue = Channel()
+    for _ in range(5):
+        queue.put(None)
+    queue.close()
+    return queue
+
+
+def test_failed_batches(upload_queue, irods_output_dir):
+    """Test that failed batches are counted without uploading anything."""
+    error_queue = Queue()
+    upload_thread = UploadThread(
+        Collection(irods_output_dir), upload_queue, error_queue, n_workers=2
+    )
+    upload_thread.start()
+    upload_thread.join()
+
+    assert upload_thread.count == 5
+    assert error_queue.empty()
+
+
+def test_concurrent_upload(irods_output_dir, scratch_folder):
+    """Test uploading the outputs of several batches with a pool of workers."""
+    queue = Channel()
+    batches = []
+    for i in range(4):
+        batch = JobBatch(scratch_location=scratch_folder)
+        for j in range(3):
+            with open(Path(batch.output_folder_path, f"{i}-{j}.txt"), "w") as out:
+                out.write(f"Output {j} of batch {i}")
+        batches.append(batch)
+        queue.put(batch)
+    queue.close()
 
+    output_collection = Collection(irods_output_dir)
+    error_queue = Queue()
+    upload_thread = UploadThread(output_collection, queue, error_queue, n_workers=3)
+    upload_thread.start()
+    upload_thread.join()
 
-def test_failed_batches(upload_queue):
-    pass
+    assert upload_thread.count == 4
+    assert error_queue.empty()
+    assert len(output_collection.contents()) == 12
+    for batch in batches:
+        assert not Path(batch.tmp_dir.name).exists()
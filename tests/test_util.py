@@ -16,35 +16,44 @@
 #
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 
 import os
-from subprocess import SubprocessError
+from queue import Empty, Full
+import shutil
+from subprocess import CalledProcessError, SubprocessError
 import threading
 from time import sleep
 from transponster.util import (
+    Channel,
     FailedJobBatch,
     JobBatch,
+    Limiter,
     LocalObject2,
+    SCRIPT_LOG_TAIL,
+    STDERR_LOG,
+    STDOUT_LOG,
+    ScratchBudget,
     Script,
-    WrappedQueue,
+    ScriptLog,
     ClosedException,
+    parse_scratch_budget,
 )
 from pytest import raises
 from partisan.irods import DataObject, Collection
 
 
-class TestWrappedQueue:
+class TestChannel:
     def test_empty_closed(self):
 
-        queue = WrappedQueue()
+        queue = Channel()
         queue.close()
         with raises(ClosedException):
             queue.get()
 
     def test_not_empty_closed(self):
 
-        queue = WrappedQueue()
+        queue = Channel()
         queue.put("Hello")
         queue.close()
         assert queue.get() == "Hello"
@@ -53,13 +62,13 @@ class TestWrappedQueue:
 
     def test_fail_put_to_closed_queue(self):
 
-        queue = WrappedQueue()
+        queue = Channel()
         queue.close()
         with raises(ClosedException):
             queue.put("Fail")
 
     def successfully_notify_closed():
-        queue = WrappedQueue()
+        queue = Channel()
 
         def worker():
             with raises(ClosedException):
@@ -72,6 +81,90 @@ class TestWrappedQueue:
         queue.close()
         thread.join()
 
+    def test_timeouts(self):
+
+        queue = Channel(maxsize=1)
+        with raises(Empty):
+            queue.get(timeout=0.01)
+        queue.put(1)
+        with raises(Full):
+            queue.put(2, timeout=0.01)
+
+        stats = queue.stats()
+        assert stats.depth == 1
+        assert stats.get_wait > 0
+        assert stats.put_wait > 0
+
+    def test_get_many(self):
+
+        queue = Channel()
+        for i in range(5):
+            queue.put(i)
+        queue.close()
+        assert queue.get_many(3) == [0, 1, 2]
+        assert queue.get_many(3) == [3, 4]
+        with raises(ClosedException):
+            queue.get_many(3)
+
+    def test_many_consumers(self):
+        """Test that every item is taken exactly once by concurrent consumers."""
+
+        queue = Channel(maxsize=4)
+        results = [[] for _ in range(4)]
+
+        def consumer(result):
+            while True:
+                try:
+                    result.append(queue.get())
+                except ClosedException:
+                    return
+
+        threads = [threading.Thread(target=consumer, args=(r,)) for r in results]
+        for thread in threads:
+            thread.start()
+        for i in range(200):
+            queue.put(i)
+        queue.close()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(sum(results, [])) == list(range(200))
+        stats = queue.stats()
+        assert stats.n_put == stats.n_got == 200
+        assert stats.max_depth <= 4
+
+
+class TestLimiter:
+    def test_raise_limit(self):
+        """Test that raising the limit lets waiting holders in."""
+        limiter = Limiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not acquired.wait(0.05)
+        limiter.limit = 2
+        assert acquired.wait(1)
+        thread.join()
+        assert limiter.in_use == 2
+
+    def test_lower_limit(self):
+        """Test that holders above a lowered limit keep their place."""
+        limiter = Limiter(2)
+        limiter.acquire()
+        limiter.acquire()
+        limiter.limit = 1
+        assert limiter.in_use == 2
+        limiter.release()
+        limiter.release()
+        with raises(ValueError):
+            limiter.release()
+
 
 class TestScript:
     def test_run(self, script_working_dir):
@@ -94,6 +187,53 @@ class TestScript:
         with raises(SubprocessError):
             script.run(script_working_dir)
 
+    def test_script_logs(self, script_working_dir):
+        """Test writing the output of a script to capped logs."""
+
+        script = Script("./tests/data/scripts/chatty.sh", log_size=1000)
+
+        with raises(CalledProcessError) as error:
+            script.run(script_working_dir)
+
+        # The error keeps the end of the output
+        assert error.value.stderr == b"oops\n"
+        assert error.value.stdout.endswith(b"line 9999\nline 10000\n")
+        assert len(error.value.stdout) == SCRIPT_LOG_TAIL
+
+        stdout = Path(script_working_dir, STDOUT_LOG).read_bytes()
+        assert stdout.startswith(b"line 1\nline 2\n")
+        assert b"bytes of output left out" in stdout
+        assert stdout.endswith(b"line 10000\n")
+        assert len(stdout) < 1000 + SCRIPT_LOG_TAIL + 100
+        assert Path(script_working_dir, STDERR_LOG).read_bytes() == b"oops\n"
+
+
+class TestScriptLog:
+    def test_cap(self, tmp_path):
+        """Test leaving out output beyond the cap, except for its end."""
+
+        log = ScriptLog(Path(tmp_path, "stdout.log"), max_bytes=10)
+        log.write(b"0123456")
+        log.write(b"789abcdef")
+        log.close()
+
+        assert log.tail == b"0123456789abcdef"
+        assert log.dropped == 6
+        assert Path(tmp_path, "stdout.log").read_bytes() == (
+            b"0123456789\n[transponster: 6 bytes of output left out, the last 6 "
+            b"follow]\nabcdef"
+        )
+
+    def test_no_cap(self, tmp_path):
+        """Test writing all the output without a cap."""
+
+        log = ScriptLog(Path(tmp_path, "stdout.log"))
+        log.write(b"x" * (SCRIPT_LOG_TAIL + 1))
+        log.close()
+
+        assert Path(tmp_path, "stdout.log").stat().st_size == SCRIPT_LOG_TAIL + 1
+        assert len(log.tail) == SCRIPT_LOG_TAIL
+
 
 class TestLocalObject2:
     """Tests for the TestLocalObject2 class"""
@@ -243,6 +383,51 @@ class TestJobBatch:
         assert not input_obj.is_local
         assert input_obj.is_remote
 
+    def test_key(self):
+        """Test that batches of different objects from a collection have different keys."""
+
+        class CollectionDataObject:
+            """A data object whose path is its collection, as in partisan."""
+
+            def __init__(self, path):
+                self.path = PurePosixPath(path).parent
+                self.name = PurePosixPath(path).name
+
+            def __str__(self):
+                return str(PurePosixPath(self.path, self.name))
+
+        keys = []
+        for name in ["1.txt", "2.txt", "1.txt"]:
+            job_batch = JobBatch()
+            job_batch.add_input_obj(
+                CollectionDataObject(f"/testZone/home/irods/datafiles/{name}")
+            )
+            keys.append(job_batch.key)
+
+        assert keys[0] != keys[1]
+        assert keys[0] == keys[2]
+
+    def test_lazy_allocation(self, tmp_path_factory):
+        """Test that the scratch directory is only created when needed."""
+        scratch: Path = tmp_path_factory.mktemp("tmp")
+        job_batch = JobBatch(scratch_location=scratch)
+        job_batch.add_input_obj(DataObject("/testZone/home/irods/datafiles/2.txt"))
+
+        assert not job_batch.is_allocated
+        assert job_batch.input_objs[0].local_folder is None
+        assert not any(scratch.iterdir())
+
+        job_batch.allocate()
+
+        assert job_batch.is_allocated
+        assert job_batch.input_objs[0].local_folder == job_batch.input_folder_path
+        assert os.path.isdir(job_batch.input_folder_path)
+        assert os.path.isdir(job_batch.output_folder_path)
+
+        job_batch.cleanup()
+
+        assert not any(scratch.iterdir())
+
     def test_input_folder_path(self, tmp_path_factory):
         """Test correct input folder path."""
         scratch: Path = tmp_path_factory.mktemp("tmp")
@@ -295,3 +480,82 @@ class TestFailedJobBatch:
         failed_batch = FailedJobBatch(job_batch, None, None)
 
         assert set(input_paths) == set(failed_batch.get_input_object_locations())
+
+
+def make_sized_batch(*sizes: int) -> JobBatch:
+    """Make a JobBatch whose inputs have known sizes."""
+    job_batch = JobBatch()
+    for i, size in enumerate(sizes):
+        job_batch.input_objs.append(LocalObject2(None, f"{i}.txt", None, size=size))
+    return job_batch
+
+
+class TestScratchBudget:
+    def test_reserve_waits_for_release(self):
+        """Test that reserving blocks until enough space is released."""
+
+        budget = ScratchBudget(100)
+        first = make_sized_batch(30, 40)
+        second = make_sized_batch(50)
+
+        budget.reserve_inputs(first)
+        assert budget.used == 70
+
+        reserved = threading.Event()
+
+        def reserve_second():
+            budget.reserve_inputs(second)
+            reserved.set()
+
+        thread = threading.Thread(target=reserve_second)
+        thread.start()
+        assert not reserved.wait(0.2)
+
+        budget.charge(first, 10)
+        budget.release_inputs(first)
+        assert reserved.wait(5)
+        thread.join()
+
+        assert budget.used == 60
+        budget.release(first, 10)
+        budget.release(second)
+        assert budget.used == 0
+        assert first.reserved_bytes == 0
+        assert second.reserved_bytes == 0
+
+    def test_oversized_batch(self):
+        """Test that a batch larger than the budget runs on its own."""
+
+        budget = ScratchBudget(10)
+        job_batch = make_sized_batch(25)
+
+        budget.reserve_inputs(job_batch)
+
+        assert budget.used == 25
+
+    def test_unlimited(self):
+        """Test that a budget without a total does not track anything."""
+
+        budget = ScratchBudget()
+        job_batch = make_sized_batch(25)
+
+        budget.reserve_inputs(job_batch)
+        budget.charge(job_batch, 10)
+
+        assert budget.used == 0
+        assert job_batch.reserved_bytes == 0
+
+    def test_parse(self, tmp_path):
+        """Test parsing budgets in bytes and percentages."""
+
+        assert parse_scratch_budget("1000", None) == 1000
+        assert parse_scratch_budget("2K", None) == 2048
+        assert parse_scratch_budget("1.5g", None) == int(1.5 * 1024**3)
+
+        total = shutil.disk_usage(tmp_path).total
+        assert parse_scratch_budget("50%", tmp_path) == total // 2
+
+        with raises(ValueError):
+            parse_scratch_budget("0", None)
+        with raises(ValueError):
+            parse_scratch_budget("150%", tmp_path)
@@ -0,0 +1,439 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Pipeline engine running the stages as coroutines on a single event loop."""
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import os
+from pathlib import Path
+from queue import Queue
+from shutil import rmtree
+from subprocess import CalledProcessError
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from partisan.irods import Collection
+from structlog import get_logger
+
+from transponster.cache import InputCache
+from transponster.controller import ErrorReporter, report_errors
+from transponster.metrics import Metrics, MetricsExporter, format_summary
+from transponster.reports import FailureLog
+from transponster.scratch import ScratchCollector
+from transponster.trace import TraceRecorder
+from transponster.util import (
+    BatchObserver,
+    BatchObservers,
+    BatchState,
+    ErrorType,
+    FailedJobBatch,
+    JobBatch,
+    STDERR_LOG,
+    STDOUT_LOG,
+    ScratchBudget,
+    Script,
+    ScriptLog,
+    get_folder_size,
+    move_logs_to_output,
+)
+
+LOGGER = get_logger()
+
+# Marks the end of the batches in a queue between stages
+_DONE = object()
+
+
+class AsyncController:
+    """Runs the pipeline with coroutines instead of one thread per stage.
+
+    Each stage is a group of worker coroutines connected by asyncio queues, so
+    that a stage with n workers has up to n batches in flight. Calls to iRODS,
+    which block, run in a pool of transfer_workers threads shared by all the
+    transfers of both the download and upload stages, and scripts run as
+    subprocesses of the event loop.
+
+    Batches go through the same states, and fail with the same FailedJobBatch
+    errors, as with Controller. count is the number of batches which were
+    uploaded or failed, like UploadThread.count.
+
+    Blocking calls on the local filesystem also run in the pool of transfer
+    threads, so that they do not hold up the event loop.
+    """
+
+    def __init__(
+        self,
+        output_collection: Collection,
+        script: Script,
+        batches: Iterable[JobBatch],
+        max_per_stage: int = 1,
+        download_workers: int = 1,
+        upload_workers: int = 1,
+        processing_workers: int = 1,
+        transfer_workers: int = 32,
+        scratch_budget: Optional[ScratchBudget] = None,
+        input_cache: Optional[InputCache] = None,
+        observer: Optional[BatchObserver] = None,
+        metrics_file: Optional[Path] = None,
+        metrics_interval: float = 10,
+        trace_file: Optional[Path] = None,
+        keep_failed: int = 0,
+        failure_log: Optional[FailureLog] = None,
+        upload_logs: bool = False,
+    ) -> None:
+        self.output_collection = output_collection
+        self.script = script
+        self.batches = batches
+        self.max_per_stage = max_per_stage
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.processing_workers = processing_workers
+        self.transfer_workers = transfer_workers
+        self.scratch_budget = (
+            scratch_budget if scratch_budget is not None else ScratchBudget()
+        )
+        self.input_cache = input_cache
+        self.upload_logs = upload_logs
+        self.error_queue = Queue()
+        self.error_reporter = ErrorReporter(self.error_queue, failure_log)
+        self.metrics = Metrics()
+        self.metrics_exporter = (
+            MetricsExporter(self.metrics, metrics_file, metrics_interval)
+            if metrics_file is not None
+            else None
+        )
+        self.trace_file = trace_file
+        self.trace = TraceRecorder() if trace_file is not None else None
+        self.scratch_collector = ScratchCollector(keep_failed)
+        self.observer = BatchObservers(
+            [
+                batch_observer
+                for batch_observer in [
+                    self.metrics,
+                    self.trace,
+                    observer,
+                    self.scratch_collector,
+                ]
+                if batch_observer is not None
+            ]
+        )
+        self.n_batches: Optional[int] = None
+        self.count = 0
+        self.failures: List[Dict[str, Any]] = []
+        self.input_exception: Optional[Exception] = None
+        self._transfers: Optional[ThreadPoolExecutor] = None
+        self._reservations: Optional[ThreadPoolExecutor] = None
+
+    def run(self):
+        """Run the pipeline until all the batches are done."""
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.start()
+        self.error_reporter.start()
+
+        # Waiting for scratch space blocks, so it has its own threads to leave
+        # the transfer threads free to finish the batches which will release it
+        with ThreadPoolExecutor(
+            self.transfer_workers, thread_name_prefix="transfer"
+        ) as self._transfers, ThreadPoolExecutor(
+            self.download_workers, thread_name_prefix="scratch"
+        ) as self._reservations:
+            asyncio.run(self._run())
+        self.failures = self.error_reporter.stop()
+
+        if self.input_cache is not None:
+            LOGGER.info(
+                f"Input cache: {self.input_cache.hits} hits, "
+                f"{self.input_cache.misses} misses"
+            )
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+        LOGGER.info("Summary:\n" + format_summary(self.metrics.snapshot()))
+        self.scratch_collector.log_summary()
+        if self.trace is not None:
+            self.trace.write(self.trace_file)
+            LOGGER.info(f"Wrote the timeline of the run to {self.trace_file}")
+
+        report_errors(self.n_failed, self.input_exception)
+
+    @property
+    def n_failed(self) -> int:
+        """Number of batches which failed."""
+        return len(self.failures)
+
+    async def _run(self):
+        queue_size = max(self.max_per_stage, self.processing_workers)
+        to_download = asyncio.Queue(max(self.max_per_stage, self.download_workers))
+        downloaded = asyncio.Queue(queue_size)
+        to_upload = asyncio.Queue(queue_size)
+
+        stages = [
+            (to_download, self._download, ErrorType.DOWNLOAD_FAILED),
+            (downloaded, self._process, ErrorType.PROCESSING_FAILED),
+            (to_upload, self._upload, ErrorType.UPLOAD_FAILED),
+        ]
+        n_workers = [
+            self.download_workers,
+            self.processing_workers,
+            self.upload_workers,
+        ]
+        workers = [
+            [
+                asyncio.create_task(
+                    self._worker(queue, step, error_type, next_queue, slot)
+                )
+                for slot in range(n_stage_workers)
+            ]
+            for (queue, step, error_type), n_stage_workers, next_queue in zip(
+                stages, n_workers, [downloaded, to_upload, None]
+            )
+        ]
+
+        await self._list_inputs(to_download)
+        # Each stage is told to stop once the one before it is done
+        for (queue, _, _), stage_workers in zip(stages, workers):
+            for _ in stage_workers:
+                await queue.put(_DONE)
+            await asyncio.gather(*stage_workers)
+
+    async def _list_inputs(self, to_download: asyncio.Queue):
+        """Queue the batches, which may need iRODS to be listed."""
+        iterator: Iterator[JobBatch] = iter(self.batches)
+        count = 0
+        try:
+            while True:
+                batch = await self._blocking(next, iterator, None)
+                if batch is None:
+                    break
+                await self._notify(batch, BatchState.QUEUED)
+                await to_download.put(batch)
+                count += 1
+        except Exception as exception:  # pylint: disable=broad-except
+            LOGGER.error(f"Listing inputs failed: {exception.__repr__()}")
+            self.input_exception = exception
+        self.n_batches = count
+
+    async def _worker(
+        self,
+        queue: asyncio.Queue,
+        step: Callable,
+        error_type: ErrorType,
+        next_queue: Optional[asyncio.Queue],
+        slot: int,
+    ):
+        """Run a stage on batches from a queue until told to stop.
+
+        A batch on which the stage raises an unexpected error fails with
+        error_type, rather than stopping the worker.
+        """
+        while True:
+            batch = await queue.get()
+            if batch is _DONE:
+                return
+            try:
+                passed_on = await step(batch, slot)
+            except Exception as exception:  # pylint: disable=broad-except
+                await self._fail(batch, exception.__repr__(), error_type)
+                passed_on = False
+            if passed_on and next_queue is not None:
+                await next_queue.put(batch)
+
+    async def _blocking(self, func: Callable, *args, **kwargs):
+        """Run a blocking call in the pool of transfer threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._transfers, partial(func, *args, **kwargs)
+        )
+
+    async def _notify(self, batch: JobBatch, state: BatchState):
+        """Tell the observers about a batch off the loop, as they may block."""
+        await self._blocking(self.observer.batch_state_changed, batch, state)
+
+    async def _download(self, batch: JobBatch, _slot: int) -> bool:
+        """Download all the inputs of a batch.
+
+        Returns:
+            Whether the batch should be passed on.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self._reservations, self.scratch_budget.reserve_inputs, batch
+            )
+        except Exception as exception:  # pylint: disable=broad-except
+            await self._fail(batch, exception.__repr__(), ErrorType.DOWNLOAD_FAILED)
+            return False
+
+        await self._blocking(batch.allocate)
+        LOGGER.info(f"Download: Got batch at folder {batch.tmp_dir.name}")
+        await self._notify(batch, BatchState.DOWNLOADING)
+        transfers = [
+            self._transfers.submit(obj.download, cache=self.input_cache)
+            for obj in batch.input_objs
+        ]
+        error = await _first_error(transfers)
+        if error is not None:
+            await self._fail(batch, error.__repr__(), ErrorType.DOWNLOAD_FAILED)
+            return False
+
+        await self._notify(batch, BatchState.DOWNLOADED)
+        return True
+
+    async def _run_script(self, working_dir: Path, batch: JobBatch, slot: int):
+        """Run the script on a batch, writing its output to the batch's logs.
+
+        Raises:
+            CalledProcessError if the script returns with a non-zero exit status,
+            with the end of its output.
+        """
+        command = [self.script.path, batch.input_folder_path]
+        stdout_log = ScriptLog(Path(working_dir, STDOUT_LOG), self.script.log_size)
+        stderr_log = ScriptLog(Path(working_dir, STDERR_LOG), self.script.log_size)
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                cwd=working_dir,
+                env=dict(os.environ, TRANSPONSTER_SLOT=str(slot)),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            await asyncio.gather(
+                _copy_output(process.stdout, stdout_log),
+                _copy_output(process.stderr, stderr_log),
+            )
+            await process.wait()
+        except BaseException:
+            # Do not leave the script running if its output could not be logged
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            stdout_log.close()
+            stderr_log.close()
+
+        if process.returncode != 0:
+            raise CalledProcessError(
+                process.returncode, command, stdout_log.tail, stderr_log.tail
+            )
+
+    async def _process(self, batch: JobBatch, slot: int) -> bool:
+        """Run the script on a batch.
+
+        Returns:
+            Whether the batch should be passed on.
+        """
+        working_dir = Path(batch.tmp_dir.name).resolve()
+        LOGGER.info(f"Running script on {working_dir} in slot {slot}")
+        await self._notify(batch, BatchState.PROCESSING)
+        try:
+            await self._run_script(working_dir, batch, slot)
+        except CalledProcessError as exception:
+            await self._fail(batch, exception, ErrorType.PROCESSING_FAILED)
+            return False
+        except FileNotFoundError as exception:
+            await self._fail(batch, exception, ErrorType.FILE_NOT_FOUND)
+            return False
+        except PermissionError as exception:
+            await self._fail(batch, exception, ErrorType.PERMISSION_ERROR)
+            return False
+
+        LOGGER.info(f"Finished running script on {working_dir}, removing input")
+        if self.upload_logs:
+            await self._blocking(move_logs_to_output, batch)
+        self.scratch_budget.charge(
+            batch, await self._blocking(get_folder_size, batch.output_folder_path)
+        )
+        await self._blocking(rmtree, batch.input_folder_path)
+        self.scratch_budget.release_inputs(batch)
+        await self._notify(batch, BatchState.PROCESSED)
+        return True
+
+    async def _upload(self, batch: JobBatch, _slot: int) -> bool:
+        """Upload all the outputs of a batch.
+
+        Returns:
+            Whether the batch should be passed on.
+        """
+        LOGGER.info(f"Upload: Got batch at folder {batch.tmp_dir.name}")
+        await self._notify(batch, BatchState.UPLOADING)
+        objs = await self._blocking(batch.get_output_objs, self.output_collection)
+        transfers = [
+            self._transfers.submit(self._upload_obj, batch, obj) for obj in objs
+        ]
+        error = await _first_error(transfers)
+        if error is not None:
+            await self._fail(batch, error.__repr__(), ErrorType.UPLOAD_FAILED)
+            return False
+
+        LOGGER.info(f"Upload: Finished batch at folder {batch.tmp_dir.name}")
+        await self._blocking(batch.cleanup)
+        self.scratch_budget.release(batch)
+        await self._notify(batch, BatchState.UPLOADED)
+        self.count += 1
+        return True
+
+    def _upload_obj(self, batch: JobBatch, obj):
+        """Upload an output object, then free its local copy."""
+        obj.upload()
+        obj.remove_local_file()
+        self.scratch_budget.release(batch, obj.size)
+
+    async def _fail(self, batch: JobBatch, exception, error_type: ErrorType):
+        """Report a batch which failed."""
+        self.scratch_budget.release(batch)
+        failed_batch = FailedJobBatch(batch, exception, error_type)
+        LOGGER.error(failed_batch.get_error_message())
+        await self._notify(batch, BatchState.FAILED)
+        self.error_queue.put(failed_batch)
+        self.count += 1
+
+
+async def _copy_output(stream: asyncio.StreamReader, log: ScriptLog):
+    """Add the output of a script to its log until the script closes it."""
+    while True:
+        data = await stream.read(64 * 1024)
+        if not data:
+            return
+        log.write(data)
+
+
+async def _first_error(transfers: List[Future]) -> Optional[BaseException]:
+    """Wait for transfers until they are all done or one of them fails.
+
+    Transfers which have not started yet when one fails are cancelled, and
+    those already running are waited for, as they may still write to the
+    scratch directory of the batch.
+
+    Args:
+        transfers: the transfers, running in a thread pool.
+
+    Returns:
+        The exception raised by the first transfer which failed, if any.
+    """
+    if not transfers:
+        return None
+    waiters = [asyncio.wrap_future(transfer) for transfer in transfers]
+    done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_EXCEPTION)
+    failed = [waiter for waiter in done if waiter.exception() is not None]
+    if not failed:
+        return None
+    for transfer in transfers:
+        transfer.cancel()
+    if pending:
+        await asyncio.wait(pending)
+    return failed[0].exception()
@@ -0,0 +1,187 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Adjust the concurrency of the stages of the pipeline while it runs."""
+from threading import Event, Thread
+from typing import List
+
+from structlog import get_logger
+
+from transponster.download_thread import DownloadThread
+from transponster.upload_thread import UploadThread
+from transponster.util import Channel, ScratchBudget
+
+
+class Autotuner(Thread):
+    """Adjusts the number of batches in flight in each stage to keep processing busy.
+
+    Every interval seconds, it looks at how long the stages waited for each
+    other during the interval:
+        - if processing waited for batches, downloads are not keeping up, so one
+          more batch is downloaded at a time and one more can wait to be
+          processed, unless the scratch budget is nearly used up;
+        - if processing waited for room in the upload queue, one more batch is
+          uploaded at a time;
+        - if downloads waited for room in the processing queue for most of the
+          interval, they are too far ahead, so one fewer batch is downloaded at a
+          time to free up scratch space.
+
+    Each decision is logged.
+    """
+
+    def __init__(
+        self,
+        download_thread: DownloadThread,
+        upload_thread: UploadThread,
+        processing_queue: Channel,
+        upload_queue: Channel,
+        scratch_budget: ScratchBudget,
+        interval: float = 30,
+        starved_fraction: float = 0.1,
+        ahead_fraction: float = 0.5,
+        scratch_headroom: float = 0.9,
+    ) -> None:
+        """Create an autotuner.
+
+        Args:
+            download_thread: the download stage to tune.
+            upload_thread: the upload stage to tune.
+            processing_queue: the queue from the download to the processing stage.
+            upload_queue: the queue from the processing to the upload stage.
+            scratch_budget: the scratch budget shared by the stages.
+            interval: the number of seconds between two adjustments.
+            starved_fraction: the fraction of an interval processing may wait
+                before downloads or uploads are increased.
+            ahead_fraction: the fraction of an interval downloads may wait for
+                processing before they are decreased.
+            scratch_headroom: the fraction of the scratch budget above which
+                downloads are not increased.
+        """
+        Thread.__init__(self, name="autotuner", daemon=True)
+        self.download_thread = download_thread
+        self.upload_thread = upload_thread
+        self.processing_queue = processing_queue
+        self.upload_queue = upload_queue
+        self.scratch_budget = scratch_budget
+        self.interval = interval
+        self.starved_fraction = starved_fraction
+        self.ahead_fraction = ahead_fraction
+        self.scratch_headroom = scratch_headroom
+        self.logger = get_logger()
+        self._min_processing_depth = processing_queue.maxsize
+        self._min_upload_depth = upload_queue.maxsize
+        self._last = self._waits()
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.step()
+
+    def stop(self):
+        """Stop adjusting the stages."""
+        self._stopped.set()
+        self.join()
+
+    def _waits(self) -> tuple:
+        processing_stats = self.processing_queue.stats()
+        upload_stats = self.upload_queue.stats()
+        return (
+            processing_stats.get_wait,
+            processing_stats.put_wait,
+            upload_stats.put_wait,
+        )
+
+    def step(self) -> List[str]:
+        """Look at the last interval and adjust the stages.
+
+        Returns:
+            The decisions which were made.
+        """
+        waits = self._waits()
+        starved, downloads_blocked, processing_blocked = (
+            now - last for now, last in zip(waits, self._last)
+        )
+        self._last = waits
+        decisions = []
+
+        if processing_blocked > self.starved_fraction * self.interval:
+            decisions.append(
+                self._set_upload_workers(
+                    self.upload_thread.n_workers + 1,
+                    f"processing waited {processing_blocked:.1f}s for uploads",
+                )
+            )
+
+        if starved > self.starved_fraction * self.interval:
+            if self._scratch_nearly_used():
+                decisions.append(
+                    f"processing waited {starved:.1f}s for downloads, but the "
+                    "scratch budget is nearly used up"
+                )
+            else:
+                decisions.append(
+                    self._set_download_workers(
+                        self.download_thread.n_workers + 1,
+                        f"processing waited {starved:.1f}s for downloads",
+                    )
+                )
+        elif downloads_blocked > self.ahead_fraction * self.interval:
+            decisions.append(
+                self._set_download_workers(
+                    self.download_thread.n_workers - 1,
+                    f"downloads waited {downloads_blocked:.1f}s for processing",
+                )
+            )
+
+        for decision in decisions:
+            self.logger.info(f"Autotune: {decision}")
+        return decisions
+
+    def _scratch_nearly_used(self) -> bool:
+        return (
+            self.scratch_budget.limited
+            and self.scratch_budget.used
+            >= self.scratch_headroom * self.scratch_budget.total
+        )
+
+    def _set_download_workers(self, n_workers: int, reason: str) -> str:
+        old = self.download_thread.n_workers
+        new = self.download_thread.set_workers(n_workers)
+        if new == old:
+            return f"{reason}, but already downloading {old} batches at a time"
+        # Room for the extra batches to wait for processing
+        self.processing_queue.resize(
+            max(self._min_processing_depth, self.processing_queue.maxsize + new - old)
+        )
+        return (
+            f"{reason}, downloading {new} batches at a time instead of {old}, "
+            f"with up to {self.processing_queue.maxsize} waiting to be processed"
+        )
+
+    def _set_upload_workers(self, n_workers: int, reason: str) -> str:
+        old = self.upload_thread.n_workers
+        new = self.upload_thread.set_workers(n_workers)
+        if new == old:
+            return f"{reason}, but already uploading {old} batches at a time"
+        self.upload_queue.resize(
+            max(self._min_upload_depth, self.upload_queue.maxsize + new - old)
+        )
+        return (
+            f"{reason}, uploading {new} batches at a time instead of {old}, "
+            f"with up to {self.upload_queue.maxsize} waiting to be uploaded"
+        )
@@ -0,0 +1,212 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Persistent local cache of input files."""
+from collections import OrderedDict
+from hashlib import sha256
+import os
+from os import PathLike
+from pathlib import Path
+from shutil import copyfile
+import socket
+import stat
+from threading import Lock, get_ident
+from time import time
+from typing import Optional
+
+from partisan.irods import DataObject
+from structlog import get_logger
+
+LOGGER = get_logger()
+
+_PARTIAL_SUFFIX = ".part"
+# Partial downloads of other hosts untouched for this long are abandoned
+_PARTIAL_MAX_AGE = 24 * 60 * 60
+
+
+class InputCache:
+    """A cache of downloaded inputs which persists across runs.
+
+    Entries are keyed by iRODS path and checksum, so a data object which has
+    been changed in iRODS is downloaded again. Cached files are made read-only
+    and hardlinked into the input folder of batches, falling back to a copy when
+    the cache is on a different filesystem. When the cache grows over its
+    maximum size, the least recently used entries are evicted.
+
+    Several processes may share the cache directory. Downloads are written to
+    partial files named after the host, process and thread downloading them,
+    which are only removed once that process is gone.
+    """
+
+    def __init__(self, directory: PathLike, max_bytes: Optional[int] = None) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._size = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Index the entries left by previous runs, least recently used first."""
+        entries = []
+        for path in self.directory.iterdir():
+            if path.name.endswith(_PARTIAL_SUFFIX):
+                if _is_abandoned(path):
+                    # Left over by an interrupted download
+                    path.unlink(missing_ok=True)
+                continue
+            try:
+                path_stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by another process meanwhile
+                continue
+            entries.append((path_stat.st_mtime, path.name, path_stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def key(data_obj: DataObject, checksum: str) -> str:
+        """Get the cache key for a data object."""
+        return sha256(f"{data_obj}\0{checksum}".encode()).hexdigest()
+
+    def fetch(self, data_obj: DataObject, destination: PathLike, tries: int = 5):
+        """Put a data object at destination, downloading it only if not cached.
+
+        Args:
+            data_obj: the data object to fetch.
+            destination: the local path for the data object.
+            tries: the max number of download tries to attempt.
+        """
+        checksum = data_obj.checksum()
+        if not checksum:
+            # Without a checksum there is no way to tell if an entry is stale
+            with self._lock:
+                self.misses += 1
+            data_obj.get(destination, tries=tries)
+            return
+
+        key = self.key(data_obj, checksum)
+        cached_path = Path(self.directory, key)
+
+        with self._lock:
+            hit = key in self._entries
+            if hit:
+                self._entries.move_to_end(key)
+
+        # Copying across filesystems is slow, so it is done without the lock
+        if hit:
+            try:
+                os.utime(cached_path)
+                _link_or_copy(cached_path, destination)
+            except FileNotFoundError:
+                # Evicted by another process sharing the cache
+                with self._lock:
+                    if key in self._entries:
+                        self._size -= self._entries.pop(key)
+            else:
+                with self._lock:
+                    self.hits += 1
+                LOGGER.debug(f"Cache hit for {data_obj}")
+                return
+
+        with self._lock:
+            self.misses += 1
+        LOGGER.debug(f"Cache miss for {data_obj}")
+        partial_path = Path(
+            self.directory,
+            f"{key}.{socket.gethostname()}.{os.getpid()}.{get_ident()}"
+            f"{_PARTIAL_SUFFIX}",
+        )
+        data_obj.get(partial_path, tries=tries)
+        os.chmod(partial_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(partial_path, cached_path)
+        size = cached_path.stat().st_size
+        _link_or_copy(cached_path, destination)
+
+        with self._lock:
+            if key not in self._entries:
+                self._size += size
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until under the maximum size.
+
+        Must be called with the lock held.
+        """
+        if self.max_bytes is None:
+            return
+
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            Path(self.directory, key).unlink(missing_ok=True)
+            self._size -= size
+            LOGGER.debug(f"Evicted {key} from the input cache")
+
+    @property
+    def size(self) -> int:
+        """Total size in bytes of the cached files."""
+        with self._lock:
+            return self._size
+
+
+def _is_abandoned(path: Path) -> bool:
+    """Whether a partial download was left by a process which is gone.
+
+    Processes of this host are checked. Those of other hosts cannot be, so
+    their partial downloads are abandoned once left untouched for a day.
+    """
+    try:
+        # Named <key>.<host>.<pid>.<thread>.part, and the key has no dots
+        _, owner = path.name[: -len(_PARTIAL_SUFFIX)].split(".", 1)
+        host, pid, _ = owner.rsplit(".", 2)
+        pid = int(pid)
+    except ValueError:
+        host, pid = None, None
+
+    if host == socket.gethostname():
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    try:
+        return time() - path.stat().st_mtime > _PARTIAL_MAX_AGE
+    except FileNotFoundError:
+        return False
+
+
+def _link_or_copy(source: Path, destination: PathLike):
+    """Hardlink source to destination, or copy it across filesystems."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        copyfile(source, destination)
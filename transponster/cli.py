@@ -26,11 +26,226 @@ parser = argparse.ArgumentParser("transponster")
 input_group = parser.add_mutually_exclusive_group(required=True)
 input_group.add_argument("-i", "--input_collection")
 input_group.add_argument("-f", "--input_list_file")
+parser.add_argument(
+    "-r",
+    "--recursive",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Also process the inputs in subcollections of the input collection.",
+)
+parser.add_argument("--listing_workers", type=int, default=4)
 parser.add_argument("-o", "--output_collection", required=True)
 parser.add_argument("-s", "--script", required=True)
+parser.add_argument(
+    "--persistent_script",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Start the script once per processing slot and send it one working "
+    "directory per line on stdin. See the README for the protocol.",
+)
+parser.add_argument(
+    "--script_log_size",
+    default="100M",
+    help="Largest amount of standard output, and of standard error, of the "
+    "script to write to stdout.log and stderr.log in the working directory of "
+    "each batch, with an optional K, M, G or T suffix. The end of the output is "
+    "always kept.",
+)
+parser.add_argument(
+    "--upload_logs",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Upload the logs of the script with the outputs of each batch which "
+    "succeeds, named after the first input of the batch.",
+)
+parser.add_argument(
+    "--early_start",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Start the script as soon as the first input of a batch is local. "
+    "The inputs are listed in inputs.txt as they arrive. See the README.",
+)
+parser.add_argument(
+    "--stream_outputs",
+    choices=["sentinel", "rename"],
+    help="Upload outputs while the script is still running. With 'sentinel', "
+    "an output is complete once a file of the same name ending in .done exists; "
+    "with 'rename', once it no longer ends in .partial.",
+)
 parser.add_argument("--scratch_location")
+parser.add_argument(
+    "--scratch_budget",
+    help="Scratch space that batches may use at once, in bytes (with an optional "
+    "K, M, G or T suffix) or as a percentage of the scratch filesystem, e.g. 80%%.",
+)
+parser.add_argument(
+    "--keep_failed",
+    type=int,
+    default=0,
+    help="Keep the scratch directories of the first N batches which fail after "
+    "the run, to look into them. The scratch of other failed batches is freed as "
+    "soon as they fail.",
+)
+parser.add_argument(
+    "--cache_location",
+    help="Directory of a local cache of inputs, kept across runs.",
+)
+parser.add_argument(
+    "--cache_size",
+    help="Maximum size of the input cache in bytes, with an optional K, M, G or T "
+    "suffix. Least recently used inputs are evicted beyond it.",
+)
+parser.add_argument(
+    "--journal",
+    help="SQLite file in which to record the progress of each batch.",
+)
+parser.add_argument(
+    "--resume",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Skip the batches which the journal records as uploaded. The inputs and "
+    "batching options must be the same as for the run being resumed.",
+)
+parser.add_argument(
+    "--shard",
+    help="Only process one share of the inputs, given as INDEX/COUNT with INDEX "
+    "from 0 to COUNT - 1. Inputs are shared out by a hash of their iRODS path, so "
+    "runs over every INDEX with the same COUNT process every input exactly once.",
+)
+parser.add_argument(
+    "--retries",
+    action="append",
+    default=[],
+    metavar="ERROR_TYPE=N",
+    help="Retry batches which fail with ERROR_TYPE up to N times, where "
+    "ERROR_TYPE is one of download_failed, processing_failed, upload_failed, "
+    "file_not_found, permission_error or all. Can be given several times.",
+)
+parser.add_argument(
+    "--retry_backoff",
+    type=float,
+    default=30,
+    help="Seconds to wait before the first retry of a batch, doubled for each "
+    "later retry up to 10 minutes.",
+)
+parser.add_argument(
+    "--circuit_breaker",
+    type=int,
+    help="Pause all transfers once this many of them failed within a minute, "
+    "until a single transfer succeeds again after --circuit_breaker_cooldown.",
+)
+parser.add_argument(
+    "--circuit_breaker_cooldown",
+    type=float,
+    default=60,
+    help="Seconds for which to pause transfers before trying again.",
+)
+parser.add_argument(
+    "--lease_store",
+    help="SQLite file, on a filesystem shared by several transponster processes "
+    "over the same inputs, through which they share out the batches as they go. "
+    "Each process leases one batch at a time, and batches whose lease expires, "
+    "for example because their process died, are leased again by another one.",
+)
+parser.add_argument(
+    "--lease_seconds",
+    type=float,
+    default=300,
+    help="How long a lease on a batch lasts unless its process renews it.",
+)
+parser.add_argument(
+    "--lease_max_attempts",
+    type=int,
+    default=3,
+    help="Number of times a batch may be leased before it fails, if its leases "
+    "keep expiring.",
+)
+parser.add_argument(
+    "--failure_log",
+    help="File to which to append each batch which fails as a line of JSON, as "
+    "soon as it fails. The end of the output of failed scripts is written to a "
+    "directory named after it with a .logs suffix.",
+)
+parser.add_argument(
+    "--rerun_list",
+    help="File to which to append the inputs of each batch which fails, as soon "
+    "as it fails, to pass back to transponster with --input_list_file.",
+)
+parser.add_argument(
+    "--error_report",
+    help="File to which to write the batches which failed as JSON at the end of "
+    "the run. Reports of runs over different shards can be merged with "
+    "transponster-merge-reports.",
+)
+parser.add_argument(
+    "--engine",
+    choices=["threads", "asyncio"],
+    default="threads",
+    help="Run each stage in its own threads, or all of them on an asyncio event "
+    "loop with a shared pool of transfer threads. The asyncio engine does not "
+    "support persistent scripts, streaming outputs, early start, autotune, the "
+    "progress bar, lease stores, retries or the circuit breaker.",
+)
+parser.add_argument(
+    "--transfer_workers",
+    type=int,
+    default=32,
+    help="Number of iRODS transfers run at the same time by the asyncio engine.",
+)
+parser.add_argument(
+    "--autotune",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Adjust the number of batches downloaded and uploaded at the same time "
+    "while running, starting from --download_workers and --upload_workers, to "
+    "keep the processing stage busy within the scratch budget.",
+)
+parser.add_argument(
+    "--autotune_interval",
+    type=float,
+    default=30,
+    help="Number of seconds between two adjustments in autotune mode.",
+)
+parser.add_argument(
+    "--autotune_max_workers",
+    type=int,
+    default=16,
+    help="Largest number of batches autotune mode may download or upload at the "
+    "same time.",
+)
+parser.add_argument(
+    "--metrics_file",
+    help="File to which to write live metrics of the stages of the pipeline. "
+    "Files ending in .prom are written for the Prometheus node exporter's "
+    "textfile collector, others as JSON.",
+)
+parser.add_argument(
+    "--metrics_interval",
+    type=float,
+    default=10,
+    help="Number of seconds between two writes of the metrics file.",
+)
+parser.add_argument(
+    "--trace_file",
+    help="File to which to write the timeline of every batch through the stages "
+    "of the pipeline at the end of the run, as Chrome trace event JSON which "
+    "can be loaded into Perfetto.",
+)
 parser.add_argument("-n", "--max_items_per_stage", type=int, default=1)
-parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument(
+    "--batch_size",
+    type=int,
+    help="Number of items per batch (default 1), or the maximum number of items "
+    "per batch when used with --batch_bytes.",
+)
+parser.add_argument(
+    "--batch_bytes",
+    help="Group inputs into batches of roughly this total size in bytes, with an "
+    "optional K, M, G or T suffix.",
+)
+parser.add_argument("--download_workers", type=int, default=1)
+parser.add_argument("--upload_workers", type=int, default=1)
+parser.add_argument("--processing_workers", type=int, default=1)
 parser.add_argument(
     "-p", "--progress_bar", action=argparse.BooleanOptionalAction, default=False
 )
@@ -24,25 +24,43 @@ from pathlib import Path
 from queue import Queue
 import threading
 from time import sleep
+from typing import Any, Dict, Iterable, List, Optional, Union
 
 from structlog import get_logger
 from partisan.irods import Collection
 from progressbar import ProgressBar
 import progressbar
+from transponster.autotune import Autotuner
+from transponster.cache import InputCache
 from transponster.download_thread import DownloadThread
+from transponster.input_thread import InputThread
+from transponster.leases import LeaseQueue, LeaseStore
+from transponster.metrics import Metrics, MetricsExporter, format_summary
 from transponster.processing_thread import ProcessingThread
+from transponster.reports import FailureLog, describe_failure
+from transponster.retry import CircuitBreaker, RetryPolicy
+from transponster.scratch import ScratchCollector
+from transponster.trace import TraceRecorder
 from transponster.upload_thread import UploadThread
 
 
-from transponster.util import FailedJobBatch, Script, WrappedQueue
+from transponster.util import (
+    BatchObserver,
+    BatchObservers,
+    Channel,
+    FailedJobBatch,
+    JobBatch,
+    OutputCompletion,
+    ScratchBudget,
+    Script,
+)
 
 
 @dataclass
 class Controller:
     """Controller for the different threads."""
 
-    n_batches: int
-    input_queue: Queue = Queue()
+    input_queue: Union[Channel, LeaseQueue]
     _downloaded: int = 0
     _processed: int = 0
     _uploaded: int = 0
@@ -52,18 +70,37 @@ class Controller:
         self,
         output_collection: Collection,
         script: Script,
-        input_queue: Queue,
-        n_batches: int,
+        batches: Iterable[JobBatch],
         progressbar_enabled: bool,
         max_per_stage: int = 1,
         scratch_location: Path = None,
+        download_workers: int = 1,
+        upload_workers: int = 1,
+        processing_workers: int = 1,
+        scratch_budget: Optional[ScratchBudget] = None,
+        input_cache: Optional[InputCache] = None,
+        observer: Optional[BatchObserver] = None,
+        stream_outputs: Optional[OutputCompletion] = None,
+        early_start: bool = False,
+        metrics_file: Optional[Path] = None,
+        metrics_interval: float = 10,
+        trace_file: Optional[Path] = None,
+        autotune: bool = False,
+        autotune_interval: float = 30,
+        max_workers: Optional[int] = None,
+        lease_store: Optional[LeaseStore] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        keep_failed: int = 0,
+        failure_log: Optional[FailureLog] = None,
+        upload_logs: bool = False,
     ) -> None:
-        self.input_queue = input_queue
-        self.n_batches = n_batches
         self.done = False
+        self.input_cache = input_cache
         if progressbar_enabled:
+            # The total is filled in once all the inputs have been listed
             self._progressbar: ProgressBar = ProgressBar(
-                max_value=n_batches,
+                max_value=progressbar.UnknownLength,
                 widgets=[
                     progressbar.widgets.PercentageLabelBar(),
                     progressbar.SimpleProgress(),
@@ -74,26 +111,109 @@ class Controller:
             )
         self._progressbar_enabled = progressbar_enabled
 
-        # Set up the stages of the pipeline
+        # Set up the stages of the pipeline. Every processing slot should have a
+        # batch ready for it, and somewhere to put its results.
 
-        processing_queue = WrappedQueue(maxsize=max_per_stage)
-        output_queue = WrappedQueue(maxsize=max_per_stage)
         self.error_queue = Queue()
+        self.error_reporter = ErrorReporter(self.error_queue, failure_log)
+        self.failures: List[Dict[str, Any]] = []
 
+        self.metrics = Metrics()
+        self.metrics_exporter = (
+            MetricsExporter(self.metrics, metrics_file, metrics_interval)
+            if metrics_file is not None
+            else None
+        )
+        self.trace_file = trace_file
+        self.trace = TraceRecorder() if trace_file is not None else None
+        self.scratch_collector = ScratchCollector(keep_failed)
+        observer = BatchObservers(
+            [
+                batch_observer
+                for batch_observer in [
+                    self.metrics,
+                    self.trace,
+                    observer,
+                    lease_store,
+                    self.scratch_collector,
+                ]
+                if batch_observer is not None
+            ]
+        )
+
+        queue_size = max(max_per_stage, processing_workers)
+        if lease_store is not None:
+            # Batches are shared with other processes through the lease store,
+            # and only queued here once leased by this process
+            self.input_queue = LeaseQueue(
+                lease_store,
+                scratch_location,
+                observer=observer,
+                error_queue=self.error_queue,
+            )
+            input_observer = None
+        else:
+            self.input_queue = Channel(maxsize=max(max_per_stage, download_workers))
+            input_observer = observer
+        self.processing_queue = Channel(maxsize=queue_size)
+        self.output_queue = Channel(maxsize=queue_size)
+        self.metrics.add_queue("download", self.input_queue)
+        self.metrics.add_queue("processing", self.processing_queue)
+        self.metrics.add_queue("upload", self.output_queue)
+
+        self.input_thread = InputThread(
+            batches, self.input_queue, observer=input_observer
+        )
         self.download_thread = DownloadThread(
             self.input_queue,
-            processing_queue,
+            self.processing_queue,
             self.error_queue,
             scratch_location,
-        )
-        self.processing_thread = ProcessingThread(
-            processing_queue, output_queue, self.error_queue, script
+            n_workers=download_workers,
+            scratch_budget=scratch_budget,
+            cache=input_cache,
+            observer=observer,
+            early_start=early_start,
+            max_workers=max_workers if autotune else None,
+            retry_policy=retry_policy,
+            breaker=breaker,
         )
         self.upload_thread = UploadThread(
             output_collection,
-            output_queue,
+            self.output_queue,
+            self.error_queue,
+            n_workers=upload_workers,
+            scratch_budget=scratch_budget,
+            observer=observer,
+            max_workers=max_workers if autotune else None,
+            retry_policy=retry_policy,
+            breaker=breaker,
+        )
+        self.processing_thread = ProcessingThread(
+            self.processing_queue,
+            self.output_queue,
             self.error_queue,
-            self.n_batches,
+            script,
+            n_workers=processing_workers,
+            scratch_budget=scratch_budget,
+            observer=observer,
+            stream_outputs=stream_outputs,
+            uploader=self.upload_thread,
+            early_start=early_start,
+            retry_policy=retry_policy,
+            upload_logs=upload_logs,
+        )
+        self.autotuner = (
+            Autotuner(
+                self.download_thread,
+                self.upload_thread,
+                self.processing_queue,
+                self.output_queue,
+                self.download_thread.scratch_budget,
+                interval=autotune_interval,
+            )
+            if autotune
+            else None
         )
 
     def run(self):
@@ -101,50 +221,165 @@ class Controller:
 
         logger: Logger = get_logger()
 
+        self.error_reporter.start()
+        self.input_thread.start()
         self.download_thread.start()
         self.processing_thread.start()
         self.upload_thread.start()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.start()
+        if self.autotuner is not None:
+            self.autotuner.start()
 
         if self._progressbar_enabled:
             progress_thread = threading.Thread(target=self._progress_bar_worker)
             progress_thread.start()
 
+        self.input_thread.join()
+        logger.debug("Controller sees input thread is done")
         self.download_thread.join()
         logger.debug("Controller sees download thread is done")
         self.processing_thread.done = True
         self.processing_thread.join()
         self.upload_thread.done = True
         self.upload_thread.join()
+        self.failures = self.error_reporter.stop()
         self.done = True
         if self._progressbar_enabled:
             progress_thread.join()
 
-        if self.error_queue.empty():
-            logger.info("All jobs completed successfully!")
-            return
+        if self.input_cache is not None:
+            logger.info(
+                f"Input cache: {self.input_cache.hits} hits, "
+                f"{self.input_cache.misses} misses"
+            )
 
-        # Error reporting
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+        if self.autotuner is not None:
+            self.autotuner.stop()
+            logger.info(
+                f"Autotune: finished downloading {self.download_thread.n_workers} "
+                f"and uploading {self.upload_thread.n_workers} batches at a time"
+            )
+        logger.info("Summary:\n" + format_summary(self.metrics.snapshot()))
+        self.scratch_collector.log_summary()
+        if self.trace is not None:
+            self.trace.write(self.trace_file)
+            logger.info(f"Wrote the timeline of the run to {self.trace_file}")
 
-        message = "The following errors occured:\n\n"
+        report_errors(self.n_failed, self.input_thread.exception)
 
-        while not self.error_queue.empty():
-            failed_batch: FailedJobBatch = self.error_queue.get()
+    @property
+    def n_failed(self) -> int:
+        """Number of batches which failed."""
+        return len(self.failures)
 
-            inputs = failed_batch.get_input_object_locations()
+    @property
+    def n_batches(self) -> Optional[int]:
+        """Number of batches in the run, or None until they are all listed.
 
-            message += f"Error: {failed_batch.get_error_message()}\n"
-            message += "\t Error occured for the following inputs:\n"
-            for fname in inputs:
-                message += f"\t\t{fname}\n"
+        With a lease store, only the batches of this process are counted.
+        """
+        if isinstance(self.input_queue, LeaseQueue):
+            return self.input_queue.n_batches
+        return self.input_thread.n_batches
 
-            message += "\n"
+    @property
+    def n_done(self) -> int:
+        """Number of batches uploaded or failed so far."""
+        count = self.upload_thread.count
+        if isinstance(self.input_queue, LeaseQueue):
+            # These never entered the pipeline
+            count += self.input_queue.n_given_up
+        return count
 
-        logger.error(message)
+    @property
+    def input_exception(self) -> Optional[Exception]:
+        """The reason why listing the inputs failed, if it did."""
+        return self.input_thread.exception
 
     def _progress_bar_worker(self):
 
         self._progressbar.start()
         while not self.done:
             sleep(0.5)
-            self._progressbar.update(value=self.upload_thread.count)
+            n_batches = self.n_batches
+            if n_batches is not None and n_batches != self._progressbar.max_value:
+                self._progressbar.max_value = n_batches
+            self._progressbar.update(value=self.n_done)
         self._progressbar.finish()
+
+
+class ErrorReporter(threading.Thread):
+    """Reports the batches which fail as they arrive on the error queue.
+
+    Each of them is logged with its inputs and recorded in the failure log, if
+    any, as soon as it fails, rather than all at the end of the run. Only a
+    short description of each failure is kept afterwards, without the batch or
+    the output of its script.
+    """
+
+    def __init__(self, error_queue: Queue, failure_log: Optional[FailureLog] = None):
+        threading.Thread.__init__(self, name="error-reporter", daemon=True)
+        self.error_queue = error_queue
+        self.failure_log = failure_log
+        self.failures: List[Dict[str, Any]] = []
+        self.logger: Logger = get_logger()
+
+    def run(self):
+        while True:
+            failed_batch: Optional[FailedJobBatch] = self.error_queue.get()
+            if failed_batch is None:
+                break
+            self.failures.append(describe_failure(failed_batch))
+            inputs = failed_batch.get_input_object_locations()
+            self.logger.error(
+                f"Batch failed with {failed_batch.reason.name} for inputs: "
+                + ", ".join(inputs)
+            )
+            if failed_batch.uploaded:
+                self.logger.warning(
+                    "Outputs of the failed batch left in iRODS: "
+                    + ", ".join(failed_batch.uploaded)
+                )
+            if self.failure_log is not None:
+                try:
+                    self.failure_log.record(failed_batch)
+                except OSError as exception:
+                    self.logger.error(f"Could not record failure: {exception}")
+
+    def stop(self) -> List[Dict[str, Any]]:
+        """Report the failures left on the queue, and stop.
+
+        Must only be called once nothing else puts failures on the queue.
+
+        Returns:
+            The descriptions of the batches which failed.
+        """
+        self.error_queue.put(None)
+        self.join()
+        return self.failures
+
+
+def report_errors(n_failed: int, input_exception: Optional[Exception] = None):
+    """Log how many batches failed, and whether listing the inputs failed.
+
+    Args:
+        n_failed: the number of batches which failed.
+        input_exception: the reason why listing the inputs failed, if it did.
+    """
+    logger: Logger = get_logger()
+
+    if input_exception is not None:
+        logger.error(
+            "Not all inputs were processed as listing them failed: "
+            f"{input_exception.__repr__()}"
+        )
+
+    if not n_failed:
+        if input_exception is None:
+            logger.info("All jobs completed successfully!")
+        return
+
+    logger.error(f"{n_failed} batches failed")
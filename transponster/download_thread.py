@@ -17,56 +17,302 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 """Download thread."""
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    FIRST_EXCEPTION,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from functools import partial
 from pathlib import Path
 from queue import Queue
 from threading import Thread
+from typing import Dict, Optional, Set, Tuple
 from structlog import get_logger
 
-from transponster.util import ErrorType, FailedJobBatch, JobBatch, WrappedQueue
+from transponster.cache import InputCache
+from transponster.retry import CircuitBreaker, Retrier, RetryPolicy
+from transponster.util import (
+    BatchObserver,
+    BatchState,
+    Channel,
+    ClosedException,
+    ErrorType,
+    FailedJobBatch,
+    JobBatch,
+    Limiter,
+    LocalObject2,
+    ScratchBudget,
+)
 
 
 class DownloadThread(Thread):
-    """Download thread."""
+    """Download thread.
+
+    Up to n_workers batches are downloaded at the same time, and the objects of
+    those batches are fetched by a shared pool of n_workers transfers. A batch is
+    only passed on once all of its inputs are local, unless early_start is set,
+    in which case it is passed on as soon as its first input is local and its
+    other inputs are added to its manifest as they arrive.
+
+    Inputs are taken from the local input cache when one is given.
+
+    Before a batch starts downloading, space for its inputs is reserved in the
+    scratch budget, waiting for other batches to free it if needed.
+
+    The number of batches in flight can be changed with set_workers() while the
+    thread runs, up to max_workers.
+
+    Batches which fail to download are retried according to the retry policy,
+    fetching only the inputs which are not local yet. Transfers go through the
+    circuit breaker, which pauses them while iRODS is failing.
+    """
 
     def __init__(
         self,
-        to_download: Queue,
-        downloaded: WrappedQueue,
+        to_download: Channel,
+        downloaded: Channel,
         error_queue: Queue,
         scratch_location: Path,
+        n_workers: int = 1,
+        scratch_budget: Optional[ScratchBudget] = None,
+        cache: Optional[InputCache] = None,
+        observer: Optional[BatchObserver] = None,
+        early_start: bool = False,
+        max_workers: Optional[int] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
     ) -> None:
         Thread.__init__(self)
         self.to_download = to_download
         self.downloaded = downloaded
         self.error_queue = error_queue
         self.scratch_location = scratch_location
+        self.n_workers = n_workers
+        self.max_workers = max(max_workers or n_workers, n_workers)
+        self.scratch_budget = (
+            scratch_budget if scratch_budget is not None else ScratchBudget()
+        )
+        self.cache = cache
+        self.observer = observer if observer is not None else BatchObserver()
+        self.early_start = early_start
         self.logger = get_logger()
+        self.retrier = Retrier(retry_policy, self.observer)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._in_flight = Limiter(n_workers)
+        self._batch_pool: Optional[ThreadPoolExecutor] = None
+        self._obj_pool: Optional[ThreadPoolExecutor] = None
+
+    def set_workers(self, n_workers: int) -> int:
+        """Change the number of batches downloaded at the same time.
+
+        Args:
+            n_workers: the new number of batches, clamped to [1, max_workers].
+
+        Returns:
+            The new number of batches.
+        """
+        self.n_workers = min(max(n_workers, 1), self.max_workers)
+        self._in_flight.limit = self.n_workers
+        return self.n_workers
 
     def run(self):
 
-        while not self.to_download.empty():
+        # The batch pool must be shut down first as its tasks use the object pool
+        with ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix="download-obj"
+        ) as obj_pool, ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix="download-batch"
+        ) as batch_pool:
+            self._batch_pool = batch_pool
+            self._obj_pool = obj_pool
 
-            self.logger.info("Getting next obj to download")
-            batch: JobBatch = self.to_download.get()
-            errored = False
-            self.logger.info(f"Download: Got batch at folder {batch.tmp_dir.name}")
-            for obj in batch.input_objs:
+            while True:
+
+                self.logger.info("Getting next obj to download")
                 try:
-                    obj.download()
-                except Exception as exception:
-                    errored = True
-                    failed_batch = FailedJobBatch(
-                        batch, exception.__repr__(), ErrorType.DOWNLOAD_FAILED
-                    )
-                    self.logger.error(failed_batch.get_error_message())
-                    self.error_queue.put(failed_batch)
+                    batch: JobBatch = self.to_download.get()
+                except ClosedException:
                     break
 
-            if not errored:
-                self.logger.info("Finished downloading files in batch")
-                self.downloaded.put(batch)
-            else:
-                self.downloaded.put(None)
+                self.retrier.enter(batch)
+                # Only wait for a slot once there is a batch for it, so that a
+                # batch being retried can take it meanwhile
+                self._in_flight.acquire()
+                self._start_batch(batch)
+
+            # Batches waiting to be retried still need the pools
+            self.retrier.wait()
 
         self.downloaded.close()
         self.logger.info("Download thread done")
+
+    def _start_batch(self, batch: JobBatch):
+        """Reserve scratch space for a batch and start downloading it.
+
+        The caller must hold one of the download slots, which is released once
+        the batch is done downloading.
+
+        Args:
+            batch: the batch to download.
+        """
+        try:
+            self.scratch_budget.reserve_inputs(batch)
+        except Exception as exception:
+            self._fail_batch(batch, exception)
+            self._in_flight.release()
+            return
+
+        self._batch_pool.submit(self._download_batch, batch, self._obj_pool)
+
+    def _retry_batch(self, batch: JobBatch):
+        """Start downloading a failed batch again, once a slot is free."""
+        self._in_flight.acquire()
+        self._start_batch(batch)
+
+    def _download_batch(self, batch: JobBatch, obj_pool: ThreadPoolExecutor):
+        """Download all the inputs of a batch and pass it on.
+
+        Args:
+            batch: the batch to download.
+            obj_pool: the executor in which to run the object transfers.
+        """
+        try:
+            batch.allocate()
+            self.logger.info(f"Download: Got batch at folder {batch.tmp_dir.name}")
+            self.observer.batch_state_changed(batch, BatchState.DOWNLOADING)
+            # Inputs which arrived before a failed attempt are kept
+            objs = [obj for obj in batch.input_objs if not obj.is_local]
+            futures = [
+                obj_pool.submit(self.breaker.call, obj.download, cache=self.cache)
+                for obj in objs
+            ]
+            if self.early_start:
+                self._stream_batch(batch, dict(zip(futures, objs)))
+                return
+
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+
+            failed = [future for future in done if future.exception() is not None]
+            if failed:
+                for future in not_done:
+                    future.cancel()
+                # Transfers already running may still write to the input folder
+                wait(not_done)
+                self._fail_batch(batch, failed[0].exception(), retry=True)
+                return
+
+            self.logger.info("Finished downloading files in batch")
+            self.observer.batch_state_changed(batch, BatchState.DOWNLOADED)
+            self.downloaded.put(batch)
+            self.retrier.leave(batch)
+        except Exception as exception:  # pylint: disable=broad-except
+            # Fail the batch rather than lose the error in its future
+            if self.retrier.holds(batch):
+                self._fail_batch(batch, exception)
+        finally:
+            self._in_flight.release()
+
+    def _stream_batch(self, batch: JobBatch, objs: Dict[Future, LocalObject2]):
+        """Pass a batch on once its first input is local, then list the others.
+
+        Args:
+            batch: the batch being downloaded.
+            objs: the inputs of the batch being transferred, by transfer, in order.
+        """
+        passed_on = False
+        error = None
+        retry = True
+        not_done = set(objs)
+        try:
+            while not_done and error is None:
+                done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+                n_listed, error = self._list_inputs(batch, objs, done)
+
+                # Inputs listed with or before a failure can still be processed
+                if n_listed and not passed_on:
+                    self.logger.info("Downloaded first file in batch, passing it on")
+                    self.observer.batch_state_changed(batch, BatchState.DOWNLOADED)
+                    self.downloaded.put(batch)
+                    self.retrier.leave(batch)
+                    passed_on = True
+        except Exception as exception:  # pylint: disable=broad-except
+            # Once passed on, the batch must still be told its downloads failed
+            error = exception
+            retry = False
+
+        if error is not None:
+            for future in not_done:
+                future.cancel()
+            # Transfers already running may still write to the input folder
+            wait(not_done)
+            try:
+                # A retry does not download them again, so they must be listed now
+                self._list_inputs(batch, objs, not_done)
+            except OSError:
+                retry = False
+            if not passed_on:
+                self._fail_batch(batch, error, retry=retry)
+                return
+
+        self.logger.info("Finished downloading files in batch")
+        batch.finish_downloads(error)
+        if not passed_on:
+            # Only possible for a batch without any inputs
+            self.observer.batch_state_changed(batch, BatchState.DOWNLOADED)
+            self.downloaded.put(batch)
+            self.retrier.leave(batch)
+
+    @staticmethod
+    def _list_inputs(
+        batch: JobBatch, objs: Dict[Future, LocalObject2], done: Set[Future]
+    ) -> Tuple[int, Optional[BaseException]]:
+        """List the inputs which arrived in the manifest, in the order of the batch.
+
+        Args:
+            batch: the batch being downloaded.
+            objs: the inputs of the batch being transferred, by transfer, in order.
+            done: the finished transfers.
+
+        Returns:
+            The number of inputs listed, and the first error of the transfers
+            which failed, if any.
+        """
+        n_listed = 0
+        error = None
+        for future, obj in objs.items():
+            if future not in done or future.cancelled():
+                continue
+            if future.exception() is not None:
+                error = error if error is not None else future.exception()
+                continue
+            batch.add_to_manifest(obj)
+            n_listed += 1
+        return n_listed, error
+
+    def _fail_batch(self, batch: JobBatch, exception: Exception, retry: bool = False):
+        """Report a batch which could not be downloaded, unless it will be retried.
+
+        Args:
+            batch: the batch which failed.
+            exception: the reason why it failed.
+            retry: whether the batch may be retried.
+        """
+        self.scratch_budget.release(batch)
+        if retry and self.retrier.retry(
+            batch,
+            ErrorType.DOWNLOAD_FAILED,
+            exception,
+            partial(self._retry_batch, batch),
+        ):
+            return
+
+        failed_batch = FailedJobBatch(
+            batch, exception.__repr__(), ErrorType.DOWNLOAD_FAILED
+        )
+        self.logger.error(failed_batch.get_error_message())
+        self.observer.batch_state_changed(batch, BatchState.FAILED)
+        self.error_queue.put(failed_batch)
+        self.downloaded.put(None)
+        self.retrier.leave(batch)
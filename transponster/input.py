@@ -16,9 +16,14 @@
 #
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from hashlib import sha256
 from os import PathLike
+from pathlib import PurePosixPath
 from queue import Queue
-from typing import List
+from typing import Iterable, Iterator, List, Optional
 
 from structlog import get_logger
 
@@ -29,10 +34,313 @@ from transponster.util import JobBatch
 LOGGER = get_logger()
 
 
-def scan_input_file(path: PathLike) -> List[PathLike]:
+@dataclass(frozen=True)
+class Shard:
+    """One of count disjoint shares of the inputs, numbered from 0.
+
+    Inputs are assigned to shards by a hash of their iRODS path, so that every
+    run with the same count assigns them the same way, whatever the order in
+    which they are listed.
+    """
+
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if self.count <= 0 or not 0 <= self.index < self.count:
+            raise ValueError(f"Invalid shard {self}")
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        """Parse a shard written as INDEX/COUNT, e.g. 3/50."""
+        try:
+            index, count = value.split("/")
+            return cls(int(index), int(count))
+        except ValueError as error:
+            raise ValueError(
+                f"Invalid shard {value}, expected INDEX/COUNT with "
+                "0 <= INDEX < COUNT"
+            ) from error
+
+    def contains(self, path: PathLike) -> bool:
+        """Whether an iRODS path belongs to this shard."""
+        digest = sha256(str(path).encode()).digest()
+        return int.from_bytes(digest[:8], "big") % self.count == self.index
+
+    def filter(self, objs: Iterable[DataObject]) -> Iterator[DataObject]:
+        """Keep only the objects which belong to this shard."""
+        # The path of a DataObject is its collection, its string the full path
+        return (obj for obj in objs if self.contains(str(obj)))
+
+
+def iter_input_file(path: PathLike) -> Iterator[str]:
+    """Iterate over the iRODS paths listed in a file, without reading it all.
+
+    Args:
+        path: The path to the file containing the newline-separated iRODS locations.
+
+    Returns:
+        An iterator over the non-empty lines of the file.
+    """
 
     with open(path, "r") as input_file:
-        return [s.strip() for s in input_file.readlines()]
+        for line in input_file:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def scan_input_file(path: PathLike) -> List[PathLike]:
+
+    return list(iter_input_file(path))
+
+
+def get_local_name(obj: DataObject, root: Optional[Collection] = None) -> str:
+    """Get the name of the local copy of an input, relative to the input folder.
+
+    Args:
+        obj: the input data object.
+        root: the Collection in which the inputs were found. If set, the path of
+            the object relative to it is kept in the input folder.
+
+    Returns:
+        The name of the local copy.
+    """
+    if root is None:
+        return obj.name
+
+    # The path of a DataObject is the collection which holds it
+    path = PurePosixPath(obj.path, obj.name)
+    return str(path.relative_to(PurePosixPath(root.path)))
+
+
+def iter_batches(
+    objs: Iterable[DataObject],
+    scratch_location: PathLike,
+    batch_size: int = 1,
+    root: Optional[Collection] = None,
+) -> Iterator[JobBatch]:
+    """Group iRODS data objects into batches as they are found.
+
+    Args:
+        objs: the data objects to process.
+        scratch_location: PathLike for the scratch space location.
+        batch_size: the number of items per batch.
+        root: the Collection in which the objects were found, to keep their
+            relative paths in the input folder.
+
+    Returns:
+        An iterator over the batches.
+    """
+    job_batch = JobBatch(scratch_location=scratch_location)
+
+    for obj in objs:
+
+        LOGGER.info(f"Adding {obj.name} to a job batch")
+
+        job_batch.add_input_obj(obj, local_name=get_local_name(obj, root))
+
+        if len(job_batch.input_objs) == batch_size:
+            yield job_batch
+            job_batch = JobBatch(scratch_location=scratch_location)
+
+    if job_batch.input_objs:
+        yield job_batch
+
+
+def iter_batches_by_size(
+    objs: Iterable[DataObject],
+    scratch_location: PathLike,
+    batch_bytes: int,
+    max_batch_size: Optional[int] = None,
+    root: Optional[Collection] = None,
+) -> Iterator[JobBatch]:
+    """Group iRODS data objects into batches of roughly equal total size.
+
+    Objects are added to a batch until the next one would take it over
+    batch_bytes. An object larger than batch_bytes gets a batch of its own.
+
+    Args:
+        objs: the data objects to process.
+        scratch_location: PathLike for the scratch space location.
+        batch_bytes: the target total size of the inputs of a batch.
+        max_batch_size: the maximum number of items per batch, if any.
+        root: the Collection in which the objects were found, to keep their
+            relative paths in the input folder.
+
+    Returns:
+        An iterator over the batches.
+    """
+    job_batch = JobBatch(scratch_location=scratch_location)
+    total = 0
+
+    for obj in objs:
+
+        size = obj.size()
+        if job_batch.input_objs and (
+            total + size > batch_bytes or len(job_batch.input_objs) == max_batch_size
+        ):
+            yield job_batch
+            job_batch = JobBatch(scratch_location=scratch_location)
+            total = 0
+
+        LOGGER.info(f"Adding {obj.name} ({size} bytes) to a job batch")
+
+        job_batch.add_input_obj(obj, size=size, local_name=get_local_name(obj, root))
+        total += size
+
+    if job_batch.input_objs:
+        yield job_batch
+
+
+def group_batches(
+    objs: Iterable[DataObject],
+    scratch_location: PathLike,
+    batch_size: Optional[int] = None,
+    batch_bytes: Optional[int] = None,
+    root: Optional[Collection] = None,
+) -> Iterator[JobBatch]:
+    """Group iRODS data objects into batches by count, or by size if batch_bytes is set.
+
+    Args:
+        objs: the data objects to process.
+        scratch_location: PathLike for the scratch space location.
+        batch_size: the number of items per batch (1 if not set), or the maximum
+            number of items per batch when batching by size.
+        batch_bytes: the target total size of the inputs of a batch, if any.
+        root: the Collection in which the objects were found, to keep their
+            relative paths in the input folder.
+
+    Returns:
+        An iterator over the batches.
+    """
+    if batch_bytes is not None:
+        return iter_batches_by_size(
+            objs, scratch_location, batch_bytes, batch_size, root
+        )
+
+    return iter_batches(objs, scratch_location, batch_size or 1, root)
+
+
+def iter_collection_objs(input_collection: Collection) -> Iterator[DataObject]:
+    """Iterate over the data objects of a Collection as they are listed.
+
+    Args:
+        input_collection: the iRODS Collection in which to search.
+
+    Returns:
+        An iterator over the data objects in the Collection.
+    """
+    for obj in input_collection.iter_contents():
+
+        if isinstance(obj, Collection):
+            raise NotImplementedError(
+                f"Collection {obj.path} found. Use recursive mode to process "
+                "subcollections"
+            )
+
+        yield obj
+
+
+def iter_collection_objs_recursive(
+    input_collection: Collection, n_workers: int = 4
+) -> Iterator[DataObject]:
+    """Iterate over the data objects of a Collection and all its subcollections.
+
+    Up to n_workers collections are listed at the same time. Results are still
+    returned in a breadth-first order which does not depend on how long each
+    listing takes, so batches are the same from one run to the next.
+
+    Args:
+        input_collection: the iRODS Collection in which to search.
+        n_workers: the maximum number of collections listed at the same time.
+
+    Returns:
+        An iterator over the data objects in the Collection tree.
+    """
+    with ThreadPoolExecutor(n_workers, thread_name_prefix="listing") as pool:
+        listings = deque([pool.submit(input_collection.contents)])
+
+        while listings:
+            for item in listings.popleft().result():
+
+                if isinstance(item, Collection):
+                    LOGGER.info(f"Found subcollection {item.path}")
+                    listings.append(pool.submit(item.contents))
+                    continue
+
+                yield item
+
+
+def iter_batches_from_collection(
+    input_collection: Collection,
+    scratch_location: PathLike,
+    batch_size: Optional[int] = None,
+    batch_bytes: Optional[int] = None,
+    recursive: bool = False,
+    listing_workers: int = 4,
+    shard: Optional[Shard] = None,
+) -> Iterator[JobBatch]:
+    """Generate batches to be downloaded from an iRODS Collection.
+
+    Args:
+        input_collection: the iRODS Collection in which to search.
+        scratch_location: PathLike for the scratch space location.
+        batch_size: the number of items per batch (1 if not set), or the maximum
+            number of items per batch when batching by size.
+        batch_bytes: the target total size of the inputs of a batch, if any.
+        recursive: whether to search subcollections. Their inputs keep their path
+            relative to input_collection in the input folder.
+        listing_workers: the maximum number of collections listed at the same
+            time when searching recursively.
+        shard: the share of the inputs to batch, if not all of them.
+
+    Returns:
+        An iterator over the batches.
+    """
+    if recursive:
+        objs = iter_collection_objs_recursive(input_collection, listing_workers)
+    else:
+        objs = iter_collection_objs(input_collection)
+    if shard is not None:
+        objs = shard.filter(objs)
+
+    return group_batches(
+        objs,
+        scratch_location,
+        batch_size,
+        batch_bytes,
+        root=input_collection if recursive else None,
+    )
+
+
+def iter_batches_from_file(
+    file: PathLike,
+    scratch_location: PathLike,
+    batch_size: Optional[int] = None,
+    batch_bytes: Optional[int] = None,
+    shard: Optional[Shard] = None,
+) -> Iterator[JobBatch]:
+    """Generate batches of items listed in a file, to be downloaded from iRODS.
+
+    Args:
+        file: The path to the file containing the newline-separated iRODS locations.
+        scratch_location: PathLike for the scratch space location.
+        batch_size: the number of items per batch (1 if not set), or the maximum
+            number of items per batch when batching by size.
+        batch_bytes: the target total size of the inputs of a batch, if any.
+        shard: the share of the inputs to batch, if not all of them.
+
+    Returns:
+        An iterator over the batches.
+    """
+    objs = (DataObject(path) for path in iter_input_file(file))
+    if shard is not None:
+        objs = shard.filter(objs)
+    return group_batches(objs, scratch_location, batch_size, batch_bytes)
 
 
 def gen_download_queue_from_collection(
@@ -54,22 +362,9 @@ def gen_download_queue_from_collection(
     """
     n_batches = 0
 
-    collection_contents = input_collection.contents()
-
-    for start_index in range(0, len(collection_contents), batch_size):
-
-        end_index = min(start_index + batch_size, len(collection_contents))
-        job_batch = JobBatch(scratch_location=scratch_location)
-        for obj in collection_contents[start_index:end_index]:
-
-            if isinstance(obj, Collection):
-                raise NotImplementedError(
-                    f"Collection {obj.path} found. Subcollections are not yet supported"
-                )
-
-            LOGGER.info(f"Adding {obj.name} to a job batch")
-
-            job_batch.add_input_obj(obj)
+    for job_batch in iter_batches_from_collection(
+        input_collection, scratch_location, batch_size
+    ):
 
         LOGGER.info(f"Adding {job_batch} to download_queue")
         download_queue.put(job_batch)
@@ -96,20 +391,9 @@ def gen_download_queue_from_file(
     Returns:
         The number of batches added to the download queue.
     """
-
-    input_paths: List[PathLike] = scan_input_file(file)
     n_batches = 0
-    for start_index in range(0, len(input_paths), batch_size):
-
-        end_index = min(start_index + batch_size, len(input_paths))
-        job_batch = JobBatch(scratch_location=scratch_location)
-        for path in input_paths[start_index:end_index]:
-
-            obj = DataObject(path)
-
-            LOGGER.info(f"Adding {obj.name} to a job batch")
 
-            job_batch.add_input_obj(obj)
+    for job_batch in iter_batches_from_file(file, scratch_location, batch_size):
 
         LOGGER.info(f"Adding {job_batch} to download_queue")
         download_queue.put(job_batch)
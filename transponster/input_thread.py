@@ -0,0 +1,80 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Input thread."""
+from threading import Lock, Thread
+from typing import Iterable, Optional
+
+from structlog import get_logger
+
+from transponster.util import BatchObserver, BatchState, Channel, JobBatch
+
+
+class InputThread(Thread):
+    """Find the inputs and feed batches to the download thread as they are listed.
+
+    The total number of batches is only known once listing is finished, at which
+    point it is available as n_batches.
+    """
+
+    def __init__(
+        self,
+        batches: Iterable[JobBatch],
+        to_download: Channel,
+        observer: Optional[BatchObserver] = None,
+    ) -> None:
+        Thread.__init__(self)
+        self.batches = batches
+        self.to_download = to_download
+        self.exception: Optional[Exception] = None
+        self.observer = observer if observer is not None else BatchObserver()
+        self.logger = get_logger()
+        self._count = 0
+        self._count_lock = Lock()
+        self._n_batches: Optional[int] = None
+
+    def run(self):
+
+        try:
+            for batch in self.batches:
+                self.logger.info(f"Adding {batch} to download queue")
+                self.observer.batch_state_changed(batch, BatchState.QUEUED)
+                self.to_download.put(batch)
+                with self._count_lock:
+                    self._count += 1
+        except Exception as exception:
+            self.logger.error(f"Failed to list inputs: {exception!r}")
+            self.exception = exception
+        finally:
+            with self._count_lock:
+                self._n_batches = self._count
+            self.to_download.close()
+
+        self.logger.info(f"Input thread done, found {self.count} batches")
+
+    @property
+    def count(self) -> int:
+        """Count of batches found so far."""
+        with self._count_lock:
+            return self._count
+
+    @property
+    def n_batches(self) -> Optional[int]:
+        """Total number of batches, or None if listing is not finished."""
+        with self._count_lock:
+            return self._n_batches
@@ -0,0 +1,103 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Persistent journal of batch states, used to resume interrupted runs."""
+from os import PathLike
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Dict, Iterable, Iterator, Optional
+
+from structlog import get_logger
+
+from transponster.util import BatchObserver, BatchState, JobBatch
+
+LOGGER = get_logger()
+
+
+class Journal(BatchObserver):
+    """Records the state of every batch in an SQLite database.
+
+    Batches are identified by JobBatch.key, so a rerun with the same inputs and
+    batching options sees the same batches as the run that was interrupted.
+    """
+
+    def __init__(self, path: PathLike) -> None:
+        self.path = path
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS batches (
+                    key TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    inputs TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+
+    def batch_state_changed(self, batch: JobBatch, state: BatchState):
+        inputs = "\n".join(str(obj.data_obj) for obj in batch.input_objs)
+        with self._lock, self._connection:
+            self._connection.execute(
+                """INSERT INTO batches (key, state, inputs, updated)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE
+                SET state = excluded.state, updated = excluded.updated""",
+                (batch.key, state.name, inputs, time()),
+            )
+
+    def get_state(self, batch: JobBatch) -> Optional[BatchState]:
+        """Get the last recorded state of a batch, or None if it was never seen."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM batches WHERE key = ?", (batch.key,)
+            ).fetchone()
+        return BatchState[row[0]] if row is not None else None
+
+    def skip_uploaded(self, batches: Iterable[JobBatch]) -> Iterator[JobBatch]:
+        """Filter out the batches which were already uploaded by a previous run.
+
+        Args:
+            batches: the batches to filter.
+
+        Returns:
+            An iterator over the batches which still need to be processed.
+        """
+        skipped = 0
+        for batch in batches:
+            if self.get_state(batch) == BatchState.UPLOADED:
+                skipped += 1
+                continue
+            yield batch
+
+        LOGGER.info(f"Skipped {skipped} batches already uploaded by a previous run")
+
+    def count_states(self) -> Dict[BatchState, int]:
+        """Count the batches in each state."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT state, COUNT(*) FROM batches GROUP BY state"
+            ).fetchall()
+        return {BatchState[state]: count for state, count in rows}
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,386 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Sharing batches between several transponster processes through a lease store.
+
+Every process lists the inputs and adds the batches to a shared SQLite
+database, in which each batch is pending, leased by one process, done, or
+failed. Processes lease pending batches one at a time, and renew their leases
+with a heartbeat while they work on them. A lease which is not renewed, for
+example because its process died, expires and the batch can then be leased by
+another process, up to a maximum number of times after which the batch fails.
+"""
+import json
+import os
+import socket
+import sqlite3
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import monotonic, sleep, time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from partisan.irods import DataObject
+from structlog import get_logger
+
+from transponster.util import (
+    BatchObserver,
+    BatchState,
+    ChannelStats,
+    ClosedException,
+    ErrorType,
+    FailedJobBatch,
+    JobBatch,
+)
+
+LOGGER = get_logger()
+
+
+class LeaseStore(BatchObserver):
+    """A store of batches shared by several processes, which lease them.
+
+    As a BatchObserver, it marks the batches leased by this process as done
+    once uploaded, or as failed.
+    """
+
+    def __init__(
+        self,
+        path: os.PathLike,
+        lease_seconds: float = 300,
+        max_attempts: int = 3,
+    ) -> None:
+        """Open a lease store, creating it if needed.
+
+        Args:
+            path: the SQLite database, on a filesystem shared by all processes.
+            lease_seconds: how long a lease lasts without being renewed.
+            max_attempts: the number of times a batch may be leased before it is
+                given up on, if its leases keep expiring.
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS batches (
+                    key TEXT PRIMARY KEY,
+                    inputs TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    owner TEXT,
+                    expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS batches_state ON batches (state)"
+            )
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS listing (
+                    owner TEXT PRIMARY KEY
+                )"""
+            )
+        self._stopped = Event()
+        self._heartbeat = Thread(target=self._beat, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def add(self, batch: JobBatch):
+        """Add a batch, unless another process already did.
+
+        Args:
+            batch: the batch to add.
+        """
+        inputs = json.dumps(
+            [[str(obj.data_obj), obj.local_name, obj.size] for obj in batch.input_objs]
+        )
+        with self._lock:
+            self._connection.execute(
+                """INSERT INTO batches (key, inputs, state) VALUES (?, ?, 'pending')
+                ON CONFLICT (key) DO NOTHING""",
+                (batch.key, inputs),
+            )
+
+    def finish_listing(self):
+        """Record that all the batches have been added."""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO listing (owner) VALUES (?)", (self.owner,)
+            )
+
+    def lease(
+        self, scratch_location: Optional[os.PathLike] = None
+    ) -> Optional[JobBatch]:
+        """Lease a pending batch, or one whose lease expired.
+
+        Args:
+            scratch_location: the scratch location of the batch.
+
+        Returns:
+            The leased batch, or None if there is no batch to lease right now.
+        """
+        now = time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    """SELECT key, inputs, owner FROM batches
+                    WHERE state = 'pending'
+                    OR (state = 'leased' AND expires < ? AND attempts < ?)
+                    LIMIT 1""",
+                    (now, self.max_attempts),
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        """UPDATE batches
+                        SET state = 'leased', owner = ?, expires = ?,
+                        attempts = attempts + 1
+                        WHERE key = ?""",
+                        (self.owner, now + self.lease_seconds, row[0]),
+                    )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        key, inputs, previous_owner = row
+        if previous_owner is not None:
+            LOGGER.warning(f"Reclaimed batch {key} from {previous_owner}")
+        return self._make_batch(inputs, scratch_location)
+
+    def give_up(self, scratch_location: Optional[os.PathLike] = None) -> List[JobBatch]:
+        """Mark as failed the batches whose last lease expired.
+
+        Only one process marks each of them, so that they are reported once.
+
+        Args:
+            scratch_location: the scratch location of the batches.
+
+        Returns:
+            The batches marked as failed by this call.
+        """
+        now = time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    """SELECT key, inputs, owner FROM batches
+                    WHERE state = 'leased' AND expires < ? AND attempts >= ?""",
+                    (now, self.max_attempts),
+                ).fetchall()
+                self._connection.executemany(
+                    """UPDATE batches SET state = 'failed', expires = NULL
+                    WHERE key = ?""",
+                    [(key,) for key, _, _ in rows],
+                )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        batches = []
+        for key, inputs, owner in rows:
+            LOGGER.error(
+                f"Gave up on batch {key} after {self.max_attempts} leases expired, "
+                f"the last one held by {owner}"
+            )
+            batches.append(self._make_batch(inputs, scratch_location))
+        return batches
+
+    @staticmethod
+    def _make_batch(inputs: str, scratch_location: Optional[os.PathLike]) -> JobBatch:
+        batch = JobBatch(scratch_location=scratch_location)
+        for path, local_name, size in json.loads(inputs):
+            batch.add_input_obj(DataObject(path), size=size, local_name=local_name)
+        return batch
+
+    def finished(self) -> bool:
+        """Whether all the batches have been added, and none is left to lease.
+
+        Leased batches are not finished, as their lease may still expire. Those
+        whose last lease expired are until give_up() marks them as failed.
+        """
+        with self._lock:
+            listed = self._connection.execute(
+                "SELECT COUNT(*) FROM listing"
+            ).fetchone()[0]
+            (remaining,) = self._connection.execute(
+                """SELECT COUNT(*) FROM batches
+                WHERE state IN ('pending', 'leased')"""
+            ).fetchone()
+        return listed > 0 and remaining == 0
+
+    def count_states(self) -> Dict[str, int]:
+        """Count the batches in each state."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT state, COUNT(*) FROM batches GROUP BY state"
+            ).fetchall()
+        return dict(rows)
+
+    def batch_state_changed(self, batch: JobBatch, state: BatchState):
+        if state not in (BatchState.UPLOADED, BatchState.FAILED):
+            return
+        new_state = "done" if state == BatchState.UPLOADED else "failed"
+        with self._lock:
+            self._connection.execute(
+                """UPDATE batches SET state = ?, expires = NULL
+                WHERE key = ? AND owner = ? AND state = 'leased'""",
+                (new_state, batch.key, self.owner),
+            )
+
+    def renew(self):
+        """Renew the leases held by this process."""
+        with self._lock:
+            self._connection.execute(
+                """UPDATE batches SET expires = ?
+                WHERE owner = ? AND state = 'leased'""",
+                (time() + self.lease_seconds, self.owner),
+            )
+
+    def _beat(self):
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as error:
+                LOGGER.warning(f"Could not renew leases: {error}")
+
+    def close(self):
+        """Stop renewing leases and close the store."""
+        self._stopped.set()
+        self._heartbeat.join()
+        with self._lock:
+            self._connection.close()
+
+
+class LeaseQueue:
+    """Queue-like adapter between the stages of the pipeline and a lease store.
+
+    Batches put into it by the input thread are added to the store, and closing
+    it records that listing is finished. get() leases the next batch from the
+    store, waiting for one if all the remaining batches are leased by live
+    processes, and raises ClosedException once there are none left.
+
+    Batches are only queued in this process once leased by it, so that nothing
+    is kept about the batches which other processes lease. Batches whose leases
+    all expired are failed and reported by the process which finds them.
+    """
+
+    def __init__(
+        self,
+        store: LeaseStore,
+        scratch_location: Optional[os.PathLike] = None,
+        poll_interval: float = 1,
+        observer: Optional[BatchObserver] = None,
+        error_queue: Optional[Queue] = None,
+    ) -> None:
+        self.store = store
+        self.scratch_location = scratch_location
+        self.poll_interval = poll_interval
+        self.observer = observer if observer is not None else BatchObserver()
+        self.error_queue = error_queue if error_queue is not None else Queue()
+        self._lock = Lock()
+        self._n_put = 0
+        self._n_got = 0
+        self._n_given_up = 0
+        self._exhausted = False
+        self._get_wait = 0.0
+
+    def put(self, batch: JobBatch):
+        """Add a batch to the store."""
+        self.store.add(batch)
+        with self._lock:
+            self._n_put += 1
+
+    def close(self):
+        """Record that listing is finished."""
+        self.store.finish_listing()
+
+    def get(self) -> JobBatch:
+        """Lease the next batch.
+
+        Raises:
+            ClosedException: once all the batches are done or failed.
+        """
+        start = monotonic()
+        try:
+            while True:
+                for batch in self.store.give_up(self.scratch_location):
+                    self._fail_batch(batch)
+                batch = self.store.lease(self.scratch_location)
+                if batch is not None:
+                    self.observer.batch_state_changed(batch, BatchState.QUEUED)
+                    with self._lock:
+                        self._n_got += 1
+                    return batch
+                if self.store.finished():
+                    with self._lock:
+                        self._exhausted = True
+                    raise ClosedException("No batches left in the lease store")
+                sleep(self.poll_interval)
+        finally:
+            with self._lock:
+                self._get_wait += monotonic() - start
+
+    def _fail_batch(self, batch: JobBatch):
+        failed_batch = FailedJobBatch(
+            batch,
+            f"No process finished it in {self.store.max_attempts} leases",
+            ErrorType.LEASE_EXPIRED,
+        )
+        self.observer.batch_state_changed(batch, BatchState.FAILED)
+        self.error_queue.put(failed_batch)
+        with self._lock:
+            self._n_given_up += 1
+
+    @property
+    def n_given_up(self) -> int:
+        """Number of batches this process failed after their leases expired."""
+        with self._lock:
+            return self._n_given_up
+
+    @property
+    def n_batches(self) -> Optional[int]:
+        """Number of batches leased or given up on by this process.
+
+        None until there are no batches left in the store, as other processes
+        may still give some back.
+        """
+        with self._lock:
+            return self._n_got + self._n_given_up if self._exhausted else None
+
+    def empty(self) -> bool:
+        """Whether there is no batch to lease right now."""
+        return self.store.count_states().get("pending", 0) == 0
+
+    def stats(self) -> ChannelStats:
+        """Counters of this process, with the pending batches as the depth."""
+        with self._lock:
+            return ChannelStats(
+                self.store.count_states().get("pending", 0),
+                0,
+                self._n_put,
+                self._n_got,
+                0.0,
+                self._get_wait,
+            )
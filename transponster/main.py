@@ -19,7 +19,6 @@
 """Main script for Transponster"""
 
 from pathlib import Path
-from queue import Queue
 
 # To control the logging level, needs to be imported before partisan.irods
 # pylint: disable=wrong-import-order
@@ -27,28 +26,113 @@ from transponster.cli import args
 from partisan.irods import Collection
 
 # pylint: disable=ungrouped-imports
+from transponster.async_controller import AsyncController
+from transponster.cache import InputCache
 from transponster.controller import Controller
-from transponster.util import Script
+from transponster.journal import Journal
+from transponster.leases import LeaseStore
+from transponster.reports import (
+    FailureLog,
+    make_error_report,
+    write_error_report,
+)
+from transponster.retry import CircuitBreaker, RetryPolicy
+from transponster.scratch import remove_stale_scratch
+from transponster.util import (
+    OutputCompletion,
+    PersistentScript,
+    ScratchBudget,
+    Script,
+    parse_scratch_budget,
+    parse_size,
+)
 from transponster.input import (
-    gen_download_queue_from_collection,
-    gen_download_queue_from_file,
+    Shard,
+    iter_batches_from_collection,
+    iter_batches_from_file,
 )
 
 
-def main():
-    """Entry point."""
+def check_args():
+    """Check that the command line arguments are consistent."""
 
     if args.max_items_per_stage <= 0:
         raise Exception("max_items_per_stage must be strictly positive.")
 
-    if args.batch_size <= 0:
-        raise Exception("batch_size must be strictly positive")
+    for option in [
+        "batch_size",
+        "download_workers",
+        "upload_workers",
+        "processing_workers",
+        "listing_workers",
+        "autotune_interval",
+        "autotune_max_workers",
+        "metrics_interval",
+        "transfer_workers",
+        "lease_seconds",
+        "lease_max_attempts",
+        "retry_backoff",
+        "circuit_breaker",
+        "circuit_breaker_cooldown",
+    ]:
+        value = getattr(args, option)
+        if value is not None and value <= 0:
+            raise Exception(f"{option} must be strictly positive")
+
+    if args.keep_failed < 0:
+        raise Exception("keep_failed must not be negative")
+
+    if args.engine == "asyncio":
+        unsupported = [
+            option
+            for option, enabled in [
+                ("persistent_script", args.persistent_script),
+                ("stream_outputs", args.stream_outputs is not None),
+                ("early_start", args.early_start),
+                ("autotune", args.autotune),
+                ("progress_bar", args.progress_bar),
+                ("lease_store", args.lease_store is not None),
+                ("retries", bool(args.retries)),
+                ("circuit_breaker", args.circuit_breaker is not None),
+            ]
+            if enabled
+        ]
+        if unsupported:
+            raise Exception(
+                f"The asyncio engine does not support {', '.join(unsupported)}"
+            )
+
+    if args.resume and args.journal is None:
+        raise Exception("resume requires a journal")
+
+
+def main():
+    """Entry point."""
+
+    check_args()
+
+    batch_bytes = parse_size(args.batch_bytes) if args.batch_bytes is not None else None
 
     scratch_location = (
         Path(args.scratch_location).resolve()
         if args.scratch_location is not None
         else None
     )
+    # Nothing else removes the scratch directories of runs which crashed
+    remove_stale_scratch(scratch_location)
+    scratch_budget = ScratchBudget(
+        parse_scratch_budget(args.scratch_budget, scratch_location)
+        if args.scratch_budget is not None
+        else None
+    )
+    input_cache = (
+        InputCache(
+            Path(args.cache_location).resolve(),
+            parse_size(args.cache_size) if args.cache_size is not None else None,
+        )
+        if args.cache_location is not None
+        else None
+    )
     input_collection_path = args.input_collection
 
     # Check script exists
@@ -56,7 +140,13 @@ def main():
     if not script_path.exists():
         raise Exception(f"Script {script_path} does not exist, exiting")
 
-    script = Script(script_path)
+    script_class = PersistentScript if args.persistent_script else Script
+    script = script_class(script_path, parse_size(args.script_log_size))
+    stream_outputs = (
+        OutputCompletion(args.stream_outputs)
+        if args.stream_outputs is not None
+        else None
+    )
 
     output_collection = Collection(args.output_collection)
     if not output_collection.exists():
@@ -64,12 +154,16 @@ def main():
             f"Error: Output Collection {args.output_collection} does not exsits."
         )
 
-    download_queue = Queue()
-    n_batches = 0
+    shard = Shard.parse(args.shard) if args.shard is not None else None
 
+    # Inputs are listed lazily by the controller's input thread
     if args.input_list_file is not None:
-        n_batches = gen_download_queue_from_file(
-            args.input_list_file, download_queue, scratch_location, args.batch_size
+        batches = iter_batches_from_file(
+            args.input_list_file,
+            scratch_location,
+            args.batch_size,
+            batch_bytes,
+            shard=shard,
         )
     elif args.input_collection is not None:
         input_collection = Collection(args.input_collection)
@@ -77,24 +171,122 @@ def main():
             raise Exception(
                 f"Error: Input Collection {input_collection_path} does not exist."
             )
-        n_batches = gen_download_queue_from_collection(
-            input_collection, download_queue, scratch_location, args.batch_size
+        batches = iter_batches_from_collection(
+            input_collection,
+            scratch_location,
+            args.batch_size,
+            batch_bytes,
+            recursive=args.recursive,
+            listing_workers=args.listing_workers,
+            shard=shard,
         )
     else:
         # Should never get here
         raise Exception("No input locations were provided")
 
-    controller = Controller(
-        output_collection,
-        script,
-        download_queue,
-        n_batches,
-        args.progress_bar,
-        args.max_items_per_stage,
-        scratch_location,
+    journal = Journal(Path(args.journal).resolve()) if args.journal else None
+    if args.resume:
+        batches = journal.skip_uploaded(batches)
+
+    metrics_file = (
+        Path(args.metrics_file).resolve() if args.metrics_file is not None else None
+    )
+    trace_file = (
+        Path(args.trace_file).resolve() if args.trace_file is not None else None
     )
 
-    controller.run()
+    failure_log = (
+        FailureLog(
+            Path(args.failure_log).resolve() if args.failure_log else None,
+            Path(args.rerun_list).resolve() if args.rerun_list else None,
+        )
+        if args.failure_log is not None or args.rerun_list is not None
+        else None
+    )
+    retry_policy = RetryPolicy.parse(args.retries, backoff=args.retry_backoff)
+    breaker = CircuitBreaker(
+        args.circuit_breaker, cooldown=args.circuit_breaker_cooldown
+    )
+    lease_store = (
+        LeaseStore(
+            Path(args.lease_store).resolve(),
+            args.lease_seconds,
+            args.lease_max_attempts,
+        )
+        if args.lease_store is not None
+        else None
+    )
+
+    if args.engine == "asyncio":
+        controller = AsyncController(
+            output_collection,
+            script,
+            batches,
+            args.max_items_per_stage,
+            download_workers=args.download_workers,
+            upload_workers=args.upload_workers,
+            processing_workers=args.processing_workers,
+            transfer_workers=args.transfer_workers,
+            scratch_budget=scratch_budget,
+            input_cache=input_cache,
+            observer=journal,
+            metrics_file=metrics_file,
+            metrics_interval=args.metrics_interval,
+            trace_file=trace_file,
+            keep_failed=args.keep_failed,
+            failure_log=failure_log,
+            upload_logs=args.upload_logs,
+        )
+    else:
+        controller = Controller(
+            output_collection,
+            script,
+            batches,
+            args.progress_bar,
+            args.max_items_per_stage,
+            scratch_location,
+            download_workers=args.download_workers,
+            upload_workers=args.upload_workers,
+            processing_workers=args.processing_workers,
+            scratch_budget=scratch_budget,
+            input_cache=input_cache,
+            observer=journal,
+            stream_outputs=stream_outputs,
+            early_start=args.early_start,
+            metrics_file=metrics_file,
+            metrics_interval=args.metrics_interval,
+            autotune=args.autotune,
+            autotune_interval=args.autotune_interval,
+            max_workers=args.autotune_max_workers,
+            trace_file=trace_file,
+            lease_store=lease_store,
+            retry_policy=retry_policy,
+            breaker=breaker,
+            keep_failed=args.keep_failed,
+            failure_log=failure_log,
+            upload_logs=args.upload_logs,
+        )
+
+    try:
+        controller.run()
+    finally:
+        if journal is not None:
+            journal.close()
+        if lease_store is not None:
+            lease_store.close()
+        if failure_log is not None:
+            failure_log.close()
+
+    if args.error_report is not None:
+        write_error_report(
+            make_error_report(
+                controller.failures,
+                controller.n_batches,
+                controller.input_exception,
+                shard,
+            ),
+            Path(args.error_report).resolve(),
+        )
 
 
 if __name__ == "__main__":
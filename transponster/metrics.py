@@ -0,0 +1,383 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Live metrics of the stages of the pipeline."""
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Dict, List, Optional
+
+from structlog import get_logger
+
+from transponster.util import (
+    BatchObserver,
+    BatchState,
+    Channel,
+    JobBatch,
+    get_folder_size,
+)
+
+LOGGER = get_logger()
+
+STAGES = ("download", "processing", "upload")
+
+_STAGE_STARTS = {
+    BatchState.DOWNLOADING: "download",
+    BatchState.PROCESSING: "processing",
+    BatchState.UPLOADING: "upload",
+}
+_STAGE_ENDS = {
+    BatchState.DOWNLOADED: "download",
+    BatchState.PROCESSED: "processing",
+    BatchState.UPLOADED: "upload",
+}
+_NEXT_STAGE = {
+    BatchState.QUEUED: "download",
+    BatchState.DOWNLOADED: "processing",
+    BatchState.PROCESSED: "upload",
+}
+
+
+@dataclass
+class StageMetrics:
+    """Counters for one stage of the pipeline."""
+
+    batches: int = 0
+    failed: int = 0
+    retried: int = 0
+    bytes: int = 0
+    in_flight: int = 0
+    busy: float = 0.0
+    busy_since: Optional[float] = None
+    batch_seconds: float = 0.0
+
+
+@dataclass
+class _BatchRecord:
+    stage: str
+    started: Optional[float] = None
+    bytes: int = 0
+
+
+class Metrics(BatchObserver):
+    """Counts the batches and bytes going through each stage of the pipeline.
+
+    A stage is busy while at least one batch is in it, and idle otherwise. The
+    time spent in a stage by each batch is also added up, which divided by the
+    number of workers of the stage and the elapsed time gives its utilisation.
+    Bytes are counted as the inputs downloaded, the outputs produced by the
+    script, and the outputs uploaded. The time spent in the processing stage by
+    each batch is the wall time of its script.
+    """
+
+    def __init__(self) -> None:
+        self.started = monotonic()
+        self.stages = {name: StageMetrics() for name in STAGES}
+        self.queues: Dict[str, Channel] = {}
+        self.script_runs = 0
+        self.script_seconds = 0.0
+        self.script_max_seconds = 0.0
+        self._batches: Dict[JobBatch, _BatchRecord] = {}
+        self._lock = Lock()
+
+    def add_queue(self, name: str, queue: Channel):
+        """Report the depth and waiting times of a queue between stages.
+
+        Args:
+            name: the name of the stage the queue feeds.
+            queue: the queue.
+        """
+        self.queues[name] = queue
+
+    def batch_state_changed(self, batch: JobBatch, state: BatchState):
+        size = 0
+        if state == BatchState.DOWNLOADED:
+            size = _input_size(batch)
+        elif state in (BatchState.PROCESSED, BatchState.UPLOADING):
+            # The outputs are removed once uploaded
+            size = get_folder_size(batch.output_folder_path)
+
+        now = monotonic()
+        with self._lock:
+            record = self._batches.get(batch)
+            if state in _STAGE_STARTS:
+                record = _BatchRecord(_STAGE_STARTS[state], now, size)
+                self._batches[batch] = record
+                self._enter(self.stages[record.stage], now)
+            elif state in _STAGE_ENDS and record is not None:
+                stage = self.stages[_STAGE_ENDS[state]]
+                stage.batches += 1
+                stage.bytes += size if state != BatchState.UPLOADED else record.bytes
+                self._leave(record, now)
+            elif state == BatchState.FAILED:
+                if record is None:
+                    # Failed before it started downloading
+                    record = _BatchRecord("download")
+                self.stages[record.stage].failed += 1
+                self._leave(record, now)
+            elif state == BatchState.RETRYING and record is not None:
+                self.stages[record.stage].retried += 1
+                self._leave(record, now)
+                # It starts the same stage again once retried
+                self._batches[batch] = _BatchRecord(record.stage)
+
+            if state in _NEXT_STAGE:
+                self._batches[batch] = _BatchRecord(_NEXT_STAGE[state])
+            elif state in (BatchState.UPLOADED, BatchState.FAILED):
+                self._batches.pop(batch, None)
+
+    @staticmethod
+    def _enter(stage: StageMetrics, now: float):
+        if stage.in_flight == 0:
+            stage.busy_since = now
+        stage.in_flight += 1
+
+    def _leave(self, record: _BatchRecord, now: float):
+        if record.started is None:
+            return
+        stage = self.stages[record.stage]
+        stage.batch_seconds += now - record.started
+        stage.in_flight -= 1
+        if stage.in_flight == 0:
+            stage.busy += now - stage.busy_since
+            stage.busy_since = None
+        if record.stage == "processing":
+            duration = now - record.started
+            self.script_runs += 1
+            self.script_seconds += duration
+            self.script_max_seconds = max(self.script_max_seconds, duration)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Get the current value of all the metrics."""
+        now = monotonic()
+        with self._lock:
+            elapsed = now - self.started
+            stages = {}
+            for name, stage in self.stages.items():
+                busy = stage.busy
+                if stage.busy_since is not None:
+                    busy += now - stage.busy_since
+                stages[name] = {
+                    "batches": stage.batches,
+                    "failed": stage.failed,
+                    "retried": stage.retried,
+                    "bytes": stage.bytes,
+                    "in_flight": stage.in_flight,
+                    "busy_seconds": busy,
+                    "idle_seconds": elapsed - busy,
+                    "batch_seconds": stage.batch_seconds,
+                    "bytes_per_second": stage.bytes / busy if busy > 0 else 0.0,
+                }
+            script = {
+                "runs": self.script_runs,
+                "total_seconds": self.script_seconds,
+                "mean_seconds": (
+                    self.script_seconds / self.script_runs if self.script_runs else 0.0
+                ),
+                "max_seconds": self.script_max_seconds,
+            }
+
+        queues = {}
+        for name, queue in self.queues.items():
+            stats = queue.stats()
+            queues[name] = {
+                "depth": stats.depth,
+                "max_depth": stats.max_depth,
+                "put": stats.n_put,
+                "got": stats.n_got,
+                "put_wait_seconds": stats.put_wait,
+                "get_wait_seconds": stats.get_wait,
+            }
+
+        return {
+            "elapsed_seconds": elapsed,
+            "stages": stages,
+            "script": script,
+            "queues": queues,
+        }
+
+
+def _input_size(batch: JobBatch) -> int:
+    """Size of the inputs of a batch, without asking iRODS for unknown sizes."""
+    size = 0
+    for obj in batch.input_objs:
+        if obj.size is not None:
+            size += obj.size
+        elif obj.is_local:
+            size += os.path.getsize(Path(obj.local_folder, obj.local_name))
+    return size
+
+
+_PROMETHEUS_STAGE_METRICS = [
+    ("batches", "batches_total", "counter", "Batches which went through a stage."),
+    ("failed", "failed_batches_total", "counter", "Batches which failed in a stage."),
+    (
+        "retried",
+        "retried_batches_total",
+        "counter",
+        "Times batches failed in a stage and were retried.",
+    ),
+    ("bytes", "bytes_total", "counter", "Bytes which went through a stage."),
+    ("in_flight", "in_flight_batches", "gauge", "Batches currently in a stage."),
+    ("busy_seconds", "busy_seconds_total", "counter", "Time a stage was busy."),
+    ("idle_seconds", "idle_seconds_total", "counter", "Time a stage was idle."),
+    (
+        "batch_seconds",
+        "batch_seconds_total",
+        "counter",
+        "Time spent in a stage, added up over all batches.",
+    ),
+]
+_PROMETHEUS_QUEUE_METRICS = [
+    ("depth", "queue_depth", "gauge", "Batches waiting for a stage."),
+    ("max_depth", "queue_max_depth", "gauge", "Most batches waiting for a stage."),
+    (
+        "put_wait_seconds",
+        "queue_put_wait_seconds_total",
+        "counter",
+        "Time spent waiting for room in the queue to a stage.",
+    ),
+    (
+        "get_wait_seconds",
+        "queue_get_wait_seconds_total",
+        "counter",
+        "Time a stage spent waiting for batches.",
+    ),
+]
+_PROMETHEUS_SCRIPT_METRICS = [
+    ("runs", "script_runs_total", "counter", "Number of script runs."),
+    ("total_seconds", "script_seconds_total", "counter", "Wall time of the script."),
+    ("max_seconds", "script_max_seconds", "gauge", "Longest wall time of a script."),
+]
+
+
+def format_prometheus(snapshot: Dict[str, Any]) -> str:
+    """Format metrics in the Prometheus text exposition format.
+
+    Args:
+        snapshot: the metrics, as returned by Metrics.snapshot().
+    """
+    lines: List[str] = []
+
+    def add(name: str, kind: str, doc: str, samples: List[tuple]):
+        lines.append(f"# HELP transponster_{name} {doc}")
+        lines.append(f"# TYPE transponster_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"transponster_{name}{labels} {value}")
+
+    add(
+        "elapsed_seconds",
+        "gauge",
+        "Time since the run started.",
+        [("", snapshot["elapsed_seconds"])],
+    )
+    for key, name, kind, doc in _PROMETHEUS_STAGE_METRICS:
+        samples = [
+            (f'{{stage="{stage}"}}', values[key])
+            for stage, values in snapshot["stages"].items()
+        ]
+        add(name, kind, doc, samples)
+    for key, name, kind, doc in _PROMETHEUS_QUEUE_METRICS:
+        samples = [
+            (f'{{stage="{stage}"}}', values[key])
+            for stage, values in snapshot["queues"].items()
+        ]
+        add(name, kind, doc, samples)
+    for key, name, kind, doc in _PROMETHEUS_SCRIPT_METRICS:
+        add(name, kind, doc, [("", snapshot["script"][key])])
+
+    return "\n".join(lines) + "\n"
+
+
+def format_summary(snapshot: Dict[str, Any]) -> str:
+    """Format metrics as a table for the end of a run.
+
+    Args:
+        snapshot: the metrics, as returned by Metrics.snapshot().
+    """
+    header = (
+        f"{'stage':<12}{'batches':>9}{'failed':>8}{'retried':>9}{'MiB':>10}{'MiB/s':>9}"
+        f"{'busy s':>9}{'idle s':>9}{'max queued':>12}{'starved s':>11}"
+    )
+    rows = [header, "-" * len(header)]
+    for name, stage in snapshot["stages"].items():
+        queue = snapshot["queues"].get(name, {})
+        rows.append(
+            f"{name:<12}{stage['batches']:>9}{stage['failed']:>8}{stage['retried']:>9}"
+            f"{stage['bytes'] / 2**20:>10.1f}{stage['bytes_per_second'] / 2**20:>9.2f}"
+            f"{stage['busy_seconds']:>9.1f}{stage['idle_seconds']:>9.1f}"
+            f"{queue.get('max_depth', 0):>12}{queue.get('get_wait_seconds', 0):>11.1f}"
+        )
+    script = snapshot["script"]
+    rows.append(
+        f"Script: {script['runs']} runs, {script['mean_seconds']:.1f}s mean, "
+        f"{script['max_seconds']:.1f}s max. "
+        f"Elapsed: {snapshot['elapsed_seconds']:.1f}s"
+    )
+    return "\n".join(rows)
+
+
+def write_metrics(snapshot: Dict[str, Any], path: Path):
+    """Write metrics to a file, replacing it atomically.
+
+    Files ending in '.prom' are written in the Prometheus text format, for the
+    textfile collector of the node exporter, and others as JSON.
+
+    Args:
+        snapshot: the metrics, as returned by Metrics.snapshot().
+        path: the file to write.
+    """
+    if path.suffix == ".prom":
+        content = format_prometheus(snapshot)
+    else:
+        content = json.dumps(snapshot, indent=2) + "\n"
+
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+        tmp_file.write(content)
+    os.replace(tmp_path, path)
+
+
+class MetricsExporter(Thread):
+    """Writes metrics to a file every interval seconds until stopped."""
+
+    def __init__(self, metrics: Metrics, path: Path, interval: float = 10) -> None:
+        Thread.__init__(self, name="metrics-exporter", daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self._write()
+        self._write()
+
+    def stop(self):
+        """Write the metrics one last time and stop."""
+        self._stopped.set()
+        self.join()
+
+    def _write(self):
+        try:
+            write_metrics(self.metrics.snapshot(), self.path)
+        except OSError as exception:
+            LOGGER.warning(f"Could not write metrics to {self.path}: {exception}")
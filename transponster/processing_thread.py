@@ -17,92 +17,298 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 """Processing thread."""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import mkdir
 from pathlib import Path
 from queue import Queue
 from subprocess import SubprocessError
-from threading import Thread
+from threading import Event, Thread
 from shutil import rmtree
+from typing import Optional, Set
 
 from structlog import get_logger
 
+from transponster.retry import Retrier, RetryPolicy
 from transponster.util import (
+    BatchObserver,
+    BatchState,
+    Channel,
     ClosedException,
     ErrorType,
     FailedJobBatch,
     JobBatch,
+    OutputCompletion,
+    ScratchBudget,
     Script,
-    WrappedQueue,
+    find_completed_outputs,
+    get_folder_size,
+    move_logs_to_output,
+    remove_sentinels,
 )
+from transponster.upload_thread import UploadThread
 
 
 class ProcessingThread(Thread):
-    """Run scripts on inputs and send to upload thread."""
+    """Run scripts on inputs and send to upload thread.
+
+    Up to n_workers scripts are run at the same time. Each of them runs in a
+    slot numbered from 0 to n_workers - 1, which is passed on to the script.
+
+    Once a script is done, the scratch budget is charged for the outputs of its
+    batch and the space used by the inputs is released.
+
+    If stream_outputs is set, the output folder of a running script is polled
+    every poll_interval seconds, and the outputs which the script marks as
+    complete are handed to the upload thread straight away.
+
+    If early_start is set, batches are expected to arrive before all of their
+    inputs are local. A script which finishes before its batch is fully
+    downloaded is only considered successful once all the downloads are.
+
+    If upload_logs is set, the logs of the script are moved to the output folder
+    of its batch once it succeeds, named after the first input of the batch, to
+    be uploaded with the outputs.
+
+    Batches whose script fails are run again according to the retry policy, in
+    a clean output folder. Batches which failed to download with early_start
+    set are not retried here.
+    """
 
     def __init__(
         self,
-        downloaded: WrappedQueue,
-        to_upload: WrappedQueue,
+        downloaded: Channel,
+        to_upload: Channel,
         error_queue: Queue,
         script_to_run: Script,
+        n_workers: int = 1,
+        scratch_budget: Optional[ScratchBudget] = None,
+        observer: Optional[BatchObserver] = None,
+        stream_outputs: Optional[OutputCompletion] = None,
+        uploader: Optional[UploadThread] = None,
+        poll_interval: float = 1.0,
+        early_start: bool = False,
+        retry_policy: Optional[RetryPolicy] = None,
+        upload_logs: bool = False,
     ):
         Thread.__init__(self)
 
+        if stream_outputs is not None and uploader is None:
+            raise ValueError("Streaming outputs requires an upload thread")
+
         self.downloaded = downloaded
         self.to_upload = to_upload
         self.error_queue = error_queue
         self.script = script_to_run
+        self.n_workers = n_workers
+        self.scratch_budget = (
+            scratch_budget if scratch_budget is not None else ScratchBudget()
+        )
+        self.observer = observer if observer is not None else BatchObserver()
+        self.stream_outputs = stream_outputs
+        self.uploader = uploader
+        self.poll_interval = poll_interval
+        self.early_start = early_start
+        self.upload_logs = upload_logs
         self.done = False
         self.logger = get_logger()
+        self.retrier = Retrier(retry_policy, self.observer)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._free_slots = Queue()
+        for slot in range(n_workers):
+            self._free_slots.put(slot)
 
     def run(self):
 
-        while not (self.downloaded.empty() and self.done):
-            self.logger.info("Waiting for next batch to process")
-            try:
-                job_batch: JobBatch = self.downloaded.get()
-            except ClosedException:
-                self.done = True
-                break
+        with ThreadPoolExecutor(
+            self.n_workers, thread_name_prefix="processing"
+        ) as pool:
+            self._pool = pool
+
+            while not (self.downloaded.empty() and self.done):
+                self.logger.info("Waiting for next batch to process")
+                try:
+                    job_batch: JobBatch = self.downloaded.get()
+                except ClosedException:
+                    self.done = True
+                    break
+
+                if job_batch is not None:
+                    self.retrier.enter(job_batch)
+                # Only wait for a slot once there is a batch for it, so that a
+                # batch being retried can take it meanwhile
+                slot = self._free_slots.get()
+                pool.submit(self._process_batch, job_batch, slot)
+
+            # Batches waiting to be retried still need the pool
+            self.retrier.wait()
+
+        self.script.close()
+        self.to_upload.close()
+        self.logger.info("Processing thread done")
+
+    def _process_batch(self, job_batch: JobBatch, slot: int):
+        """Run the script on a batch and send it to the upload thread.
 
+        Args:
+            job_batch: the batch to process, or None if it failed to download.
+            slot: the processing slot the script runs in.
+        """
+        try:
             if job_batch is None:
                 self.logger.info("Processing: Batch is empty do to previous error")
                 self.to_upload.put(None)
-                continue
+                return
             self.logger.info(
                 f"Processing: Got batch at folder {job_batch.tmp_dir.name}"
             )
             working_dir = Path(job_batch.tmp_dir.name).resolve()
             input_folder_path = job_batch.input_folder_path
 
-            self.logger.info(f"Running script on {working_dir}")
+            self.logger.info(f"Running script on {working_dir} in slot {slot}")
+            self.observer.batch_state_changed(job_batch, BatchState.PROCESSING)
+            failure = None
             try:
-                self.script.run(working_dir)
+                self._run_script(job_batch, working_dir, slot)
             except SubprocessError as exception:
-                self.put_failed_batch(job_batch, exception, ErrorType.PROCESSING_FAILED)
-                continue
+                failure = (exception, ErrorType.PROCESSING_FAILED)
             except FileNotFoundError as exception:
-                self.put_failed_batch(job_batch, exception, ErrorType.FILE_NOT_FOUND)
-                continue
+                failure = (exception, ErrorType.FILE_NOT_FOUND)
             except PermissionError as exception:
-                self.put_failed_batch(job_batch, exception, ErrorType.PERMISSION_ERROR)
+                failure = (exception, ErrorType.PERMISSION_ERROR)
+
+            if self.early_start:
+                # A missing input is the more useful error if the script failed
+                # because of it
+                download_error = job_batch.wait_for_downloads()
+                if download_error is not None:
+                    failure = (download_error, ErrorType.DOWNLOAD_FAILED)
+
+            if failure is not None:
+                exception, error_type = failure
+                if error_type != ErrorType.DOWNLOAD_FAILED and self.retrier.retry(
+                    job_batch,
+                    error_type,
+                    exception,
+                    partial(self._retry_batch, job_batch),
+                ):
+                    return
+                self.put_failed_batch(job_batch, exception, error_type)
+                return
 
             self.logger.info(
                 f"Finished running script on {working_dir}, removing input"
             )
+            if self.upload_logs:
+                move_logs_to_output(job_batch)
+            # Outputs being uploaded early were charged when they were claimed
+            claimed = (
+                self.uploader.early_upload_paths(job_batch)
+                if self.uploader is not None
+                else set()
+            )
+            self.scratch_budget.charge(
+                job_batch, get_folder_size(job_batch.output_folder_path, claimed)
+            )
             # Delete input file once done
             rmtree(input_folder_path)
+            self.scratch_budget.release_inputs(job_batch)
 
             # Send the batch to the upload_thread
+            self.observer.batch_state_changed(job_batch, BatchState.PROCESSED)
             self.to_upload.put(job_batch)
+            self.retrier.leave(job_batch)
+        except Exception as exception:  # pylint: disable=broad-except
+            # Fail the batch rather than lose the error in its future
+            if job_batch is not None and self.retrier.holds(job_batch):
+                if self.early_start:
+                    # Downloads may still write to the input folder
+                    job_batch.wait_for_downloads()
+                self.put_failed_batch(job_batch, exception, ErrorType.PROCESSING_FAILED)
+        finally:
+            self._free_slots.put(slot)
 
-        self.to_upload.close()
-        self.logger.info("Processing thread done")
+    def _reset_batch(self, job_batch: JobBatch):
+        """Clear the outputs of a failed script run, keeping the inputs."""
+        if self.uploader is not None:
+            self.uploader.abandon_early_uploads(job_batch)
+        rmtree(job_batch.output_folder_path)
+        mkdir(job_batch.output_folder_path)
+        # The inputs stay reserved, so that the batch never waits for space again
+        self.scratch_budget.release_outputs(job_batch)
+
+    def _retry_batch(self, job_batch: JobBatch):
+        """Run the script on a batch again, once a slot is free."""
+        try:
+            self._reset_batch(job_batch)
+        except OSError as exception:
+            self.put_failed_batch(job_batch, exception, ErrorType.PROCESSING_FAILED)
+            return
+        slot = self._free_slots.get()
+        self._pool.submit(self._process_batch, job_batch, slot)
+
+    def _run_script(self, job_batch: JobBatch, working_dir: Path, slot: int):
+        """Run the script, uploading its completed outputs as it runs if enabled.
+
+        Args:
+            job_batch: the batch to process.
+            working_dir: the working directory of the batch.
+            slot: the processing slot the script runs in.
+        """
+        if self.stream_outputs is None:
+            self.script.run(working_dir, slot=slot)
+            return
+
+        script_done = Event()
+        watcher = Thread(
+            target=self._watch_outputs,
+            args=(job_batch, script_done),
+            name=f"output-watcher-{slot}",
+        )
+        watcher.start()
+        try:
+            self.script.run(working_dir, slot=slot)
+        finally:
+            script_done.set()
+            watcher.join()
+
+        if self.stream_outputs == OutputCompletion.SENTINEL:
+            remove_sentinels(job_batch.output_folder_path)
+
+    def _watch_outputs(self, job_batch: JobBatch, script_done: Event):
+        """Hand completed outputs to the upload thread until the script is done.
+
+        Args:
+            job_batch: the batch being processed.
+            script_done: set once the script has exited.
+        """
+        claimed: Set[Path] = set()
+        while not script_done.wait(self.poll_interval):
+            for path in find_completed_outputs(
+                job_batch.output_folder_path, self.stream_outputs
+            ):
+                if path in claimed:
+                    continue
+                try:
+                    self.uploader.upload_early(job_batch, path)
+                except OSError as exception:
+                    # It will be uploaded with the rest of the batch instead
+                    self.logger.warning(f"Could not upload {path} early: {exception}")
+                    continue
+                claimed.add(path)
 
     def put_failed_batch(
         self, batch: JobBatch, exception: Exception, error_type: ErrorType
     ):
 
-        failed_batch = FailedJobBatch(batch, exception, error_type)
+        uploaded = []
+        if self.uploader is not None:
+            self.uploader.abandon_early_uploads(batch)
+            uploaded = self.uploader.pop_uploaded(batch)
+        self.scratch_budget.release(batch)
+        failed_batch = FailedJobBatch(batch, exception, error_type, uploaded)
         self.logger.error(failed_batch.get_error_message())
+        self.observer.batch_state_changed(batch, BatchState.FAILED)
         self.error_queue.put(failed_batch)
         self.to_upload.put(None)
+        self.retrier.leave(batch)
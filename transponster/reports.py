@@ -0,0 +1,234 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Machine-readable reports of the batches which failed in a run.
+
+Runs over different shards of the same inputs each write their own report,
+which can then be merged with:
+
+    transponster-merge-reports shard-*.json -o merged.json --rerun_list rerun.txt
+
+The rerun list holds the iRODS paths of the inputs of every failed batch, one
+per line, and can be passed back to transponster with --input_list_file.
+
+A run can also append each batch to a JSON lines failure log and to a rerun
+list as soon as it fails, so that failures can be followed during the run.
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+from os import PathLike
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from structlog import get_logger
+
+from transponster.input import Shard
+from transponster.util import FailedJobBatch
+
+LOGGER = get_logger()
+
+
+def make_error_report(
+    failures: List[Dict[str, Any]],
+    n_batches: Optional[int] = None,
+    input_exception: Optional[Exception] = None,
+    shard: Optional[Shard] = None,
+) -> Dict[str, Any]:
+    """Describe the failures of a run.
+
+    Args:
+        failures: the descriptions of the batches which failed, from
+            describe_failure.
+        n_batches: the number of batches in the run, if they were all listed.
+        input_exception: the reason why listing the inputs failed, if it did.
+        shard: the share of the inputs the run was given, if not all of them.
+    """
+    return {
+        "shard": str(shard) if shard is not None else None,
+        "n_batches": n_batches,
+        "input_error": (
+            input_exception.__repr__() if input_exception is not None else None
+        ),
+        "failed": failures,
+    }
+
+
+def describe_failure(failed_batch: FailedJobBatch) -> Dict[str, Any]:
+    """Describe a batch which failed, with the iRODS paths of its inputs.
+
+    The outputs it uploaded before it failed, which are left in iRODS, are
+    listed too.
+    """
+    return {
+        "reason": failed_batch.reason.name,
+        "error": str(failed_batch.exception),
+        "inputs": [str(obj.data_obj) for obj in failed_batch.job_batch.input_objs],
+        "uploaded": failed_batch.uploaded,
+    }
+
+
+class FailureLog:
+    """Records each batch which fails as soon as it does.
+
+    Each failure is appended as a line of JSON to the failure log, with the
+    time, the reason, the error, the inputs and the paths of the end of the
+    output of the script if it failed. The output is written next to the
+    failure log, in a directory named after it with a '.logs' suffix, as the
+    scratch directory of the batch, with its full logs, is removed. The inputs are
+    also appended to the rerun list, one per line. Both files are appended to,
+    so that several runs can share them.
+    """
+
+    def __init__(
+        self,
+        path: Optional[PathLike] = None,
+        rerun_list: Optional[PathLike] = None,
+    ) -> None:
+        """Open the failure log and the rerun list.
+
+        Args:
+            path: the JSON lines failure log, if any.
+            rerun_list: the list of the inputs of the batches which failed, if any.
+        """
+        self.path = Path(path) if path is not None else None
+        self.logs_dir = self.path.with_suffix(".logs") if path is not None else None
+        # pylint: disable=consider-using-with
+        self._log = open(path, "a", encoding="utf-8") if path is not None else None
+        self._rerun_list = (
+            open(rerun_list, "a", encoding="utf-8") if rerun_list is not None else None
+        )
+        self._lock = Lock()
+
+    def record(self, failed_batch: FailedJobBatch):
+        """Append a failed batch to the failure log and to the rerun list."""
+        record = describe_failure(failed_batch)
+        with self._lock:
+            if self._log is not None:
+                record = {
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    **record,
+                    "logs": self._write_logs(failed_batch),
+                }
+                self._log.write(json.dumps(record) + "\n")
+                self._log.flush()
+            if self._rerun_list is not None:
+                for path in record["inputs"]:
+                    self._rerun_list.write(path + "\n")
+                self._rerun_list.flush()
+
+    def _write_logs(self, failed_batch: FailedJobBatch) -> Dict[str, str]:
+        """Write the end of the output of a failed script, returning its paths."""
+        logs = {}
+        for stream in ("stdout", "stderr"):
+            output = getattr(failed_batch.exception, stream, None)
+            if not output:
+                continue
+            self.logs_dir.mkdir(exist_ok=True)
+            path = Path(self.logs_dir, f"{failed_batch.job_batch.key}.{stream}")
+            path.write_bytes(output if isinstance(output, bytes) else output.encode())
+            logs[stream] = str(path)
+        return logs
+
+    def close(self):
+        """Close the failure log and the rerun list."""
+        with self._lock:
+            for log_file in (self._log, self._rerun_list):
+                if log_file is not None:
+                    log_file.close()
+
+
+def write_error_report(report: Dict[str, Any], path: PathLike):
+    """Write an error report as JSON."""
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+def merge_error_reports(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge the error reports of runs over the shards of the same inputs.
+
+    Args:
+        reports: the reports to merge.
+
+    Returns:
+        A report of all the failures, which also lists the shards which have no
+        report or whose inputs could not all be listed.
+
+    Raises:
+        ValueError: if the reports are not for shards of the same number of shares.
+    """
+    shards = [Shard.parse(report["shard"]) for report in reports if report["shard"]]
+    counts = {shard.count for shard in shards}
+    if len(counts) > 1 or (shards and len(shards) != len(reports)):
+        raise ValueError("Reports are not for shards of the same inputs")
+
+    seen = {shard.index for shard in shards}
+    missing = sorted(set(range(counts.pop())) - seen) if counts else []
+    n_batches = [report["n_batches"] for report in reports]
+
+    return {
+        "shards": [str(shard) for shard in sorted(shards, key=lambda s: s.index)],
+        "missing_shards": missing,
+        "n_batches": None if None in n_batches else sum(n_batches),
+        "input_errors": {
+            report["shard"]: report["input_error"]
+            for report in reports
+            if report["input_error"] is not None
+        },
+        "failed": [failed for report in reports for failed in report["failed"]],
+    }
+
+
+def main():
+    """Entry point for merging error reports."""
+    parser = argparse.ArgumentParser(
+        description="Merge the error reports of transponster runs over shards."
+    )
+    parser.add_argument("reports", nargs="+", help="Error reports to merge.")
+    parser.add_argument("-o", "--output", required=True, help="Merged report.")
+    parser.add_argument(
+        "--rerun_list",
+        help="File to which to write the inputs of the failed batches, for "
+        "--input_list_file.",
+    )
+    args = parser.parse_args()
+
+    reports = []
+    for path in args.reports:
+        with open(path, encoding="utf-8") as report_file:
+            reports.append(json.load(report_file))
+
+    merged = merge_error_reports(reports)
+    write_error_report(merged, args.output)
+
+    if args.rerun_list is not None:
+        with open(args.rerun_list, "w", encoding="utf-8") as rerun_list:
+            for failed in merged["failed"]:
+                for path in failed["inputs"]:
+                    rerun_list.write(path + "\n")
+
+    for index in merged["missing_shards"]:
+        LOGGER.warning(f"No report for shard {index}")
+    for shard, error in merged["input_errors"].items():
+        LOGGER.warning(f"Not all inputs of shard {shard} were listed: {error}")
+    LOGGER.info(f"{len(merged['failed'])} batches failed")
+
+
+if __name__ == "__main__":
+    main()
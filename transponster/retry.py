@@ -0,0 +1,274 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Retrying failed batches, and pausing transfers while iRODS is failing."""
+from collections import deque
+from dataclasses import dataclass, field
+import random
+from threading import Condition, Timer
+from time import monotonic
+from typing import Callable, Deque, Dict, List, Optional, TypeVar
+
+from structlog import get_logger
+
+from transponster.util import (
+    BatchObserver,
+    BatchState,
+    ErrorType,
+    JobBatch,
+)
+
+LOGGER = get_logger()
+
+T = TypeVar("T")
+
+
+@dataclass
+class RetryPolicy:
+    """How many times to retry a batch for each type of error, and how long to wait.
+
+    The n-th retry of a batch waits for backoff * 2^(n - 1) seconds, up to
+    max_backoff, scaled by a random factor between 0.5 and 1 so that batches
+    which failed together are not all retried at the same time.
+    """
+
+    retries: Dict[ErrorType, int] = field(default_factory=dict)
+    backoff: float = 30
+    max_backoff: float = 600
+
+    @classmethod
+    def parse(cls, specs: List[str], **kwargs) -> "RetryPolicy":
+        """Create a policy from specifications such as download_failed=3.
+
+        Args:
+            specs: ERROR_TYPE=N specifications, where ERROR_TYPE is the name of
+                an ErrorType in any case, or 'all' for every type.
+            kwargs: passed on to the constructor.
+
+        Raises:
+            ValueError: if a specification is invalid.
+        """
+        retries = {}
+        for spec in specs:
+            name, sep, count = spec.partition("=")
+            if not sep or not count.isdigit():
+                raise ValueError(f"Invalid retries {spec}, expected ERROR_TYPE=N")
+            if name.lower() == "all":
+                types = list(ErrorType)
+            elif name.upper() in ErrorType.__members__:
+                types = [ErrorType[name.upper()]]
+            else:
+                raise ValueError(
+                    f"Unknown error type {name}, expected one of "
+                    f"{', '.join(t.name.lower() for t in ErrorType)} or all"
+                )
+            for error_type in types:
+                retries[error_type] = int(count)
+        return cls(retries, **kwargs)
+
+    def delay(self, error_type: ErrorType, attempt: int) -> Optional[float]:
+        """Time to wait before a retry, or None if the batch should not be retried.
+
+        Args:
+            error_type: the error the batch failed with.
+            attempt: the number of the retry, starting at 1.
+        """
+        if attempt > self.retries.get(error_type, 0):
+            return None
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1)
+
+
+class Retrier:
+    """Retries the failed batches of a stage of the pipeline after a backoff.
+
+    Retries are scheduled on timers, so that a batch waiting to be retried does
+    not hold up the others. The stage tells the retrier when batches enter and
+    leave it, so that it can wait for all of them, including those waiting to be
+    retried, before shutting down.
+    """
+
+    def __init__(
+        self,
+        policy: Optional[RetryPolicy] = None,
+        observer: Optional[BatchObserver] = None,
+    ) -> None:
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.observer = observer if observer is not None else BatchObserver()
+        self._attempts: Dict[JobBatch, Dict[ErrorType, int]] = {}
+        self._condition = Condition()
+
+    def enter(self, batch: JobBatch):
+        """Record that a batch entered the stage."""
+        with self._condition:
+            self._attempts[batch] = {}
+
+    def leave(self, batch: JobBatch):
+        """Record that a batch left the stage, whether it was passed on or failed."""
+        with self._condition:
+            self._attempts.pop(batch, None)
+            self._condition.notify_all()
+
+    def holds(self, batch: JobBatch) -> bool:
+        """Whether a batch is in the stage, including waiting to be retried."""
+        with self._condition:
+            return batch in self._attempts
+
+    def retry(
+        self,
+        batch: JobBatch,
+        error_type: ErrorType,
+        exception: Exception,
+        resubmit: Callable[[], None],
+    ) -> bool:
+        """Schedule a retry of a failed batch, if the policy allows it.
+
+        Args:
+            batch: the batch which failed.
+            error_type: the error it failed with.
+            exception: the reason why it failed.
+            resubmit: called once the backoff is over to run the batch again.
+
+        Returns:
+            Whether the batch will be retried. If not, it should be failed.
+        """
+        with self._condition:
+            attempts = self._attempts.setdefault(batch, {})
+            attempt = attempts.get(error_type, 0) + 1
+            delay = self.policy.delay(error_type, attempt)
+            if delay is None:
+                return False
+            attempts[error_type] = attempt
+
+        LOGGER.warning(
+            f"Retrying batch {batch.key} ({error_type.name}, "
+            f"attempt {attempt}) in {delay:.1f}s after {exception!r}"
+        )
+        self.observer.batch_state_changed(batch, BatchState.RETRYING)
+        timer = Timer(delay, self._resubmit, (batch, resubmit))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _resubmit(self, batch: JobBatch, resubmit: Callable[[], None]):
+        try:
+            resubmit()
+        except Exception as exception:  # pylint: disable=broad-except
+            LOGGER.error(f"Could not retry batch {batch.key}: {exception!r}")
+            self.leave(batch)
+
+    @property
+    def pending(self) -> int:
+        """Number of batches in the stage."""
+        with self._condition:
+            return len(self._attempts)
+
+    def wait(self):
+        """Wait until every batch which entered the stage has left it."""
+        with self._condition:
+            self._condition.wait_for(lambda: not self._attempts)
+
+
+class CircuitBreaker:
+    """Pauses iRODS transfers while they are failing.
+
+    Once threshold transfers have failed within window seconds, the breaker
+    opens and transfers wait for cooldown seconds. A single transfer is then let
+    through as a probe: the breaker closes again if it succeeds, and stays open
+    for another cooldown if it fails. Without a threshold, it never opens.
+
+    Time is read from clock, in seconds, which is time.monotonic by default.
+    """
+
+    def __init__(
+        self,
+        threshold: Optional[int] = None,
+        window: float = 60,
+        cooldown: float = 60,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.clock = clock
+        self.n_opened = 0
+        self._failures: Deque[float] = deque()
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._condition = Condition()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether transfers are paused."""
+        with self._condition:
+            return self._opened_at is not None
+
+    def call(self, function: Callable[..., T], *args, **kwargs) -> T:
+        """Run a transfer once the breaker lets it through, and record its outcome."""
+        self._wait()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self._record_failure()
+            raise
+        self._record_success()
+        return result
+
+    def _wait(self):
+        with self._condition:
+            while self._opened_at is not None:
+                remaining = self._opened_at + self.cooldown - self.clock()
+                if remaining > 0 or self._probing:
+                    self._condition.wait(remaining if remaining > 0 else None)
+                    continue
+                self._probing = True
+                LOGGER.info("Circuit breaker: probing iRODS with one transfer")
+                return
+
+    def _record_success(self):
+        with self._condition:
+            if self._opened_at is not None:
+                LOGGER.info("Circuit breaker: closed, resuming transfers")
+            self._opened_at = None
+            self._probing = False
+            self._failures.clear()
+            self._condition.notify_all()
+
+    def _record_failure(self):
+        if self.threshold is None:
+            return
+        now = self.clock()
+        with self._condition:
+            if self._probing:
+                # The probe failed, so keep transfers paused for another cooldown
+                self._probing = False
+                self._opened_at = now
+                LOGGER.warning("Circuit breaker: probe failed, staying open")
+                self._condition.notify_all()
+                return
+
+            self._failures.append(now)
+            while self._failures[0] < now - self.window:
+                self._failures.popleft()
+            if self._opened_at is None and len(self._failures) >= self.threshold:
+                self._opened_at = now
+                self.n_opened += 1
+                LOGGER.warning(
+                    f"Circuit breaker: {len(self._failures)} transfers failed in "
+                    f"{self.window}s, pausing transfers for {self.cooldown}s"
+                )
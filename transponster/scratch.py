@@ -0,0 +1,129 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Freeing the scratch space of failed batches and of crashed runs."""
+import os
+from pathlib import Path
+from shutil import rmtree
+import tempfile
+import socket
+from threading import Lock
+from typing import Optional
+
+from structlog import get_logger
+
+from transponster.util import (
+    SCRATCH_OWNER,
+    SCRATCH_PREFIX,
+    BatchObserver,
+    BatchState,
+    JobBatch,
+    get_folder_size,
+)
+
+LOGGER = get_logger()
+
+
+class ScratchCollector(BatchObserver):
+    """Removes the scratch directory of each batch as soon as it fails.
+
+    The scratch directories of the first keep_failed batches which fail are
+    kept instead, after the end of the run, so that they can be looked into.
+    """
+
+    def __init__(self, keep_failed: int = 0) -> None:
+        self.keep_failed = keep_failed
+        self.kept = []
+        self.freed_bytes = 0
+        self._lock = Lock()
+
+    def batch_state_changed(self, batch: JobBatch, state: BatchState):
+        if state != BatchState.FAILED or not batch.is_allocated:
+            return
+
+        with self._lock:
+            keep = len(self.kept) < self.keep_failed
+            if keep:
+                self.kept.append(batch.tmp_dir.name)
+        if keep:
+            batch.keep()
+            LOGGER.info(f"Keeping the scratch of failed batch at {batch.tmp_dir.name}")
+            return
+
+        size = get_folder_size(Path(batch.tmp_dir.name))
+        batch.cleanup()
+        with self._lock:
+            self.freed_bytes += size
+
+    def log_summary(self):
+        """Log the space freed and the scratch directories kept."""
+        with self._lock:
+            if self.freed_bytes:
+                LOGGER.info(
+                    f"Freed {self.freed_bytes} bytes of scratch from failed batches"
+                )
+            for path in self.kept:
+                LOGGER.info(f"Kept the scratch of a failed batch at {path}")
+
+
+def _is_stale(owner: str) -> bool:
+    """Whether the process named by a scratch owner marker is gone."""
+    host, _, pid = owner.strip().rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        # Processes on other hosts cannot be checked
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def remove_stale_scratch(scratch_location: Optional[os.PathLike] = None) -> int:
+    """Remove the scratch directories of batches whose process is gone.
+
+    Only directories marked as owned by a process of this host which no longer
+    exists are removed, so that runs sharing the scratch location, and batches
+    kept after failing, are left alone.
+
+    Args:
+        scratch_location: the scratch location of the batches, by default the
+            temporary directory.
+
+    Returns:
+        The number of bytes freed.
+    """
+    if scratch_location is None:
+        scratch_location = tempfile.gettempdir()
+
+    freed = 0
+    for path in Path(scratch_location).glob(f"{SCRATCH_PREFIX}*"):
+        try:
+            owner = Path(path, SCRATCH_OWNER).read_text()
+        except OSError:
+            continue
+        if not _is_stale(owner):
+            continue
+
+        size = get_folder_size(path)
+        LOGGER.info(f"Removing stale scratch directory {path} of {owner}")
+        rmtree(path, ignore_errors=True)
+        freed += size
+    return freed
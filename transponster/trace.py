@@ -0,0 +1,173 @@
+# Copyright (c) 2022 Genome Research Ltd.
+#
+# Author: Adam Blanchet <ab59@sanger.ac.uk>
+#
+# This file is part of transponster.
+#
+# transponster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Timeline of the batches going through the pipeline, for trace viewers."""
+from itertools import count
+import json
+import os
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Any, Dict, List, Set
+
+from transponster.util import BatchObserver, BatchState, JobBatch
+
+_STAGE_STARTS = {
+    BatchState.DOWNLOADING: "download",
+    BatchState.PROCESSING: "process",
+    BatchState.UPLOADING: "upload",
+}
+_STAGE_ENDS = {BatchState.DOWNLOADED, BatchState.PROCESSED, BatchState.UPLOADED}
+
+# Events of each stage are shown in their own group of rows
+_STAGE_TIDS = {"queue": 0, "download": 100, "process": 200, "upload": 300}
+
+
+class TraceRecorder(BatchObserver):
+    """Records when each batch enters and leaves each stage.
+
+    The timeline is written in the Chrome trace event format, which can be
+    loaded into Perfetto or chrome://tracing. Each stage has as many rows as it
+    had batches in it at once, so that the overlap between batches and between
+    stages can be seen at a glance. Batches are numbered in the order in which
+    they were queued.
+    """
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self._ids: Dict[JobBatch, int] = {}
+        # Ids are never reused, as those of finished batches are forgotten
+        self._next_id = count()
+        self._open: Dict[JobBatch, tuple] = {}
+        self._busy_rows: Dict[str, Set[int]] = {stage: set() for stage in _STAGE_TIDS}
+        self._n_rows: Dict[str, int] = {stage: 0 for stage in _STAGE_TIDS}
+        self._lock = Lock()
+
+    def batch_state_changed(self, batch: JobBatch, state: BatchState):
+        now = self._timestamp()
+        with self._lock:
+            if batch not in self._ids:
+                self._ids[batch] = next(self._next_id)
+            batch_id = self._ids[batch]
+
+            if batch in self._open and (
+                state in _STAGE_ENDS
+                or state in (BatchState.FAILED, BatchState.RETRYING)
+            ):
+                self._close_span(batch, now, state)
+
+            if state == BatchState.QUEUED:
+                self.events.append(
+                    {
+                        "name": f"queued {batch_id}",
+                        "cat": "queue",
+                        "ph": "i",
+                        "s": "t",
+                        "ts": now,
+                        "pid": os.getpid(),
+                        "tid": _STAGE_TIDS["queue"],
+                        "args": self._batch_args(batch),
+                    }
+                )
+                self._n_rows["queue"] = 1
+            elif state in _STAGE_STARTS:
+                stage = _STAGE_STARTS[state]
+                row = self._take_row(stage)
+                self._open[batch] = (stage, row, now)
+
+            if state in (BatchState.UPLOADED, BatchState.FAILED):
+                del self._ids[batch]
+
+    def _close_span(self, batch: JobBatch, now: float, state: BatchState):
+        stage, row, start = self._open.pop(batch)
+        self._busy_rows[stage].discard(row)
+        event = self._span(batch, stage, row, start, now)
+        if state == BatchState.FAILED:
+            event["args"]["failed"] = True
+            event["cname"] = "terrible"
+        elif state == BatchState.RETRYING:
+            event["args"]["retried"] = True
+            event["cname"] = "bad"
+        self.events.append(event)
+
+    def _span(
+        self, batch: JobBatch, stage: str, row: int, start: float, end: float
+    ) -> Dict[str, Any]:
+        return {
+            "name": f"{stage} {self._ids[batch]}",
+            "cat": stage,
+            "ph": "X",
+            "ts": start,
+            "dur": end - start,
+            "pid": os.getpid(),
+            "tid": _STAGE_TIDS[stage] + row,
+            "args": self._batch_args(batch),
+        }
+
+    def _take_row(self, stage: str) -> int:
+        busy = self._busy_rows[stage]
+        row = 0
+        while row in busy:
+            row += 1
+        busy.add(row)
+        self._n_rows[stage] = max(self._n_rows[stage], row + 1)
+        return row
+
+    @staticmethod
+    def _batch_args(batch: JobBatch) -> Dict[str, Any]:
+        args: Dict[str, Any] = {"inputs": len(batch.input_objs)}
+        if batch.input_objs:
+            args["first_input"] = str(batch.input_objs[0].data_obj)
+        return args
+
+    def _timestamp(self) -> float:
+        """Microseconds since the recorder was created."""
+        return (perf_counter() - self.started) * 1e6
+
+    def write(self, path: Path):
+        """Write the timeline in the Chrome trace event format.
+
+        Batches which are still in a stage are shown as if they left it now.
+
+        Args:
+            path: the JSON file to write.
+        """
+        now = self._timestamp()
+        with self._lock:
+            events = list(self.events)
+            for batch, (stage, row, start) in self._open.items():
+                event = self._span(batch, stage, row, start, now)
+                event["args"]["unfinished"] = True
+                events.append(event)
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": _STAGE_TIDS[stage] + row,
+                    "args": {"name": f"{stage} {row}"},
+                }
+                for stage, n_rows in self._n_rows.items()
+                for row in range(n_rows)
+            ]
+
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump(
+                {"traceEvents": metadata + events, "displayTimeUnit": "ms"}, trace_file
+            )
@@ -18,79 +18,268 @@
 # this program. If not, see <http://www.gnu.org/licenses/>.
 """Upload thread."""
 
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from functools import partial
+from pathlib import Path
 from queue import Queue
 from threading import Lock, Thread
+from typing import Dict, List, Optional, Set, Tuple
 
 from partisan.irods import Collection
 from structlog import get_logger
 
 
+from transponster.retry import CircuitBreaker, Retrier, RetryPolicy
 from transponster.util import (
+    BatchObserver,
+    BatchState,
+    Channel,
     ClosedException,
     ErrorType,
     FailedJobBatch,
     JobBatch,
-    WrappedQueue,
+    Limiter,
+    LocalObject2,
+    ScratchBudget,
 )
 
 
 class UploadThread(Thread):
-    """Upload files to iRODS."""
+    """Upload files to iRODS.
+
+    Up to n_workers batches are uploaded at the same time, and their outputs are
+    pushed by a shared pool of n_workers transfers. Each output is removed from
+    local disk as soon as it has been uploaded, and its space is released from
+    the scratch budget.
+
+    Outputs of a batch which is still being processed can be uploaded early with
+    upload_early(). The batch is then done once it has been received from the
+    upload queue and all of its early uploads have finished.
+
+    The outputs uploaded for each batch are tracked until it is done, so that
+    those left in iRODS by a batch which fails can be reported.
+
+    The number of batches in flight can be changed with set_workers() while the
+    thread runs, up to max_workers.
+
+    Batches which fail to upload are retried according to the retry policy,
+    pushing only the outputs which are still local. Transfers go through the
+    circuit breaker, which pauses them while iRODS is failing.
+    """
 
     def __init__(
         self,
         upload_location: Collection,
-        upload_queue: WrappedQueue,
+        upload_queue: Channel,
         error_queue: Queue,
-        max_size: int,
+        n_workers: int = 1,
+        scratch_budget: Optional[ScratchBudget] = None,
+        observer: Optional[BatchObserver] = None,
+        max_workers: Optional[int] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
     ):
         Thread.__init__(self)
         self.upload_location = upload_location
         self.upload_queue = upload_queue
         self.error_queue = error_queue
         self.done = False
-        self.max_size = max_size
+        self.n_workers = n_workers
+        self.max_workers = max(max_workers or n_workers, n_workers)
+        self.scratch_budget = (
+            scratch_budget if scratch_budget is not None else ScratchBudget()
+        )
+        self.observer = observer if observer is not None else BatchObserver()
         self.logger = get_logger()
         self._count = 0
         self._count_lock = Lock()
+        self.retrier = Retrier(retry_policy, self.observer)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._in_flight = Limiter(n_workers)
+        self._batch_pool: Optional[ThreadPoolExecutor] = None
+        self._obj_pool = ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix="upload-obj"
+        )
+        self._early_uploads: Dict[JobBatch, Tuple[Set[Path], List[Future]]] = {}
+        self._early_uploads_lock = Lock()
+        self._uploaded: Dict[JobBatch, Set[str]] = {}
+
+    def set_workers(self, n_workers: int) -> int:
+        """Change the number of batches uploaded at the same time.
+
+        Args:
+            n_workers: the new number of batches, clamped to [1, max_workers].
+
+        Returns:
+            The new number of batches.
+        """
+        self.n_workers = min(max(n_workers, 1), self.max_workers)
+        self._in_flight.limit = self.n_workers
+        return self.n_workers
 
     def run(self):
-        while not (self.upload_queue.empty() and self.done):
-            self.logger.info("Waiting for next batch to upload")
-            try:
-                batch: JobBatch = self.upload_queue.get()
-            except ClosedException:
-                self.done = True
-                break
-            with self._count_lock:
-                self._count += 1
+        # The batch pool must be shut down first as its tasks use the object pool
+        with self._obj_pool as obj_pool, ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix="upload-batch"
+        ) as batch_pool:
+            self._batch_pool = batch_pool
+
+            while not (self.upload_queue.empty() and self.done):
+                self.logger.info("Waiting for next batch to upload")
+                try:
+                    batch: JobBatch = self.upload_queue.get()
+                except ClosedException:
+                    self.done = True
+                    break
+                if batch is not None:
+                    self.retrier.enter(batch)
+                # Only wait for a slot once there is a batch for it, so that a
+                # batch being retried can take it meanwhile
+                self._in_flight.acquire()
+                batch_pool.submit(self._upload_batch, batch, obj_pool)
+
+            # Batches waiting to be retried still need the pools
+            self.retrier.wait()
+
+        self.logger.info("Upload thread done")
+
+    def _upload_batch(self, batch: JobBatch, obj_pool: ThreadPoolExecutor):
+        """Upload all the outputs of a batch.
+
+        The batch is counted once all of its outputs are uploaded, or as soon as
+        one of them fails unless it is retried.
+
+        Args:
+            batch: the batch to upload, or None if it failed in a previous stage.
+            obj_pool: the executor in which to run the object transfers.
+        """
+        retrying = False
+        try:
             if batch is None:
                 self.logger.info("Batch is empty due to previous error")
-                continue
-            errored = False
+                return
 
             self.logger.info(f"Upload: Got batch at folder {batch.tmp_dir.name}")
+            self.observer.batch_state_changed(batch, BatchState.UPLOADING)
 
-            for obj in batch.get_output_objs(self.upload_location):
-                try:
-                    obj.upload()
-                    obj.remove_local_file()
-
-                except Exception as exception:
-                    failed_batch = FailedJobBatch(
-                        batch, exception.__repr__, ErrorType.UPLOAD_FAILED
-                    )
-                    self.logger.error(failed_batch.get_error_message())
-                    self.error_queue.put(failed_batch)
-                    break
+            claimed, futures = self._pop_early_uploads(batch)
+            futures += [
+                obj_pool.submit(self._upload_obj, batch, obj)
+                for obj in batch.get_output_objs(self.upload_location)
+                if Path(obj.local_folder, obj.local_name) not in claimed
+            ]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
 
-            if not errored:
-                self.logger.info(f"Batch #{self.count} uploaded")
+            failed = [future for future in done if future.exception() is not None]
+            if failed:
+                for future in not_done:
+                    future.cancel()
+                # Uploads already running may still remove their local copy
+                wait(not_done)
+                exception = failed[0].exception()
+                retrying = self.retrier.retry(
+                    batch,
+                    ErrorType.UPLOAD_FAILED,
+                    exception,
+                    partial(self._retry_batch, batch),
+                )
+                if retrying:
+                    return
+                self._fail_batch(batch, exception)
+                return
 
-        self.logger.info("Upload thread done")
+            self.logger.info(f"Upload: Finished batch at folder {batch.tmp_dir.name}")
+            batch.cleanup()
+            self.scratch_budget.release(batch)
+            self.pop_uploaded(batch)
+            self.observer.batch_state_changed(batch, BatchState.UPLOADED)
+            self.retrier.leave(batch)
+        except Exception as exception:  # pylint: disable=broad-except
+            # Fail the batch rather than lose the error in its future
+            if batch is not None and self.retrier.holds(batch):
+                self._fail_batch(batch, exception)
+        finally:
+            if not retrying:
+                with self._count_lock:
+                    self._count += 1
+                    count = self._count
+                self.logger.info(f"Batch #{count} done with upload")
+            self._in_flight.release()
+
+    def _fail_batch(self, batch: JobBatch, exception: Exception):
+        """Report a batch which could not be uploaded."""
+        self.scratch_budget.release(batch)
+        failed_batch = FailedJobBatch(
+            batch,
+            exception.__repr__(),
+            ErrorType.UPLOAD_FAILED,
+            self.pop_uploaded(batch),
+        )
+        self.logger.error(failed_batch.get_error_message())
+        self.observer.batch_state_changed(batch, BatchState.FAILED)
+        self.error_queue.put(failed_batch)
+        self.retrier.leave(batch)
+
+    def _retry_batch(self, batch: JobBatch):
+        """Upload the remaining outputs of a failed batch, once a slot is free."""
+        self._in_flight.acquire()
+        self._batch_pool.submit(self._upload_batch, batch, self._obj_pool)
+
+    def upload_early(self, batch: JobBatch, path: Path):
+        """Start uploading a completed output of a batch which is still being processed.
+
+        Args:
+            batch: the batch which produced the output.
+            path: the path of the output file.
+        """
+        obj = batch.get_output_obj(path, self.upload_location)
+        self.logger.info(f"Uploading {path} before its batch is processed")
+        self.scratch_budget.charge(batch, obj.size)
+        with self._early_uploads_lock:
+            claimed, futures = self._early_uploads.setdefault(batch, (set(), []))
+            claimed.add(path)
+            futures.append(self._obj_pool.submit(self._upload_obj, batch, obj))
+
+    def abandon_early_uploads(self, batch: JobBatch):
+        """Stop tracking the early uploads of a batch which failed to process.
+
+        Uploads which have not started yet are cancelled, and those already
+        running are waited for.
+        """
+        _, futures = self._pop_early_uploads(batch)
+        for future in futures:
+            future.cancel()
+        wait(futures)
+
+    def early_upload_paths(self, batch: JobBatch) -> Set[Path]:
+        """Get the paths of the outputs of a batch which are being uploaded early."""
+        with self._early_uploads_lock:
+            claimed, _ = self._early_uploads.get(batch, (set(), []))
+            return set(claimed)
+
+    def _pop_early_uploads(self, batch: JobBatch) -> Tuple[Set[Path], List[Future]]:
+        """Get the paths and futures of the early uploads of a batch."""
+        with self._early_uploads_lock:
+            return self._early_uploads.pop(batch, (set(), []))
+
+    def pop_uploaded(self, batch: JobBatch) -> List[str]:
+        """Get the iRODS paths of the outputs of a batch uploaded so far.
+
+        They are then forgotten, as the batch is done.
+        """
+        with self._early_uploads_lock:
+            return sorted(self._uploaded.pop(batch, set()))
+
+    def _upload_obj(self, batch: JobBatch, obj: LocalObject2):
+        """Upload an output object, then free its local copy."""
+        self.breaker.call(obj.upload)
+        with self._early_uploads_lock:
+            self._uploaded.setdefault(batch, set()).add(str(obj.data_obj))
+        obj.remove_local_file()
+        self.scratch_budget.release(batch, obj.size)
 
     @property
     def count(self):
-        """Count of files that have been claimed by the upload thread."""
+        """Count of batches that the upload thread is done with."""
         with self._count_lock:
             return self._count
@@ -17,20 +17,29 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 """Useful types"""
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
 from enum import Enum, auto
-from threading import Event, Lock
+from hashlib import sha256
+from threading import Condition, Event, Lock, Thread
 import os
 from os import PathLike, mkdir, remove
 from pathlib import Path
-from queue import Queue
+from queue import Empty, Full
+from shutil import disk_usage
+import select
+import selectors
+import socket
 import subprocess
-from tempfile import TemporaryDirectory
-from typing import Any, List
+from tempfile import TemporaryDirectory, gettempdir
+from time import monotonic
+from typing import Any, BinaryIO, Deque, Dict, Iterable, List, Optional
 from structlog import get_logger
 
 from partisan.irods import DataObject, Collection
 
+from transponster.cache import InputCache
+
 
 LOGGER = get_logger()
 
@@ -41,21 +50,28 @@ class LocalObject2:
 
     data_obj: DataObject
     local_name: str
-    local_folder: Path
+    local_folder: Optional[Path]
     is_local: bool = False
     is_remote: bool = True
+    size: Optional[int] = None
 
-    def download(self, tries=5):
+    def download(self, tries=5, cache: Optional[InputCache] = None):
         """Download the file to is local location.
 
         Args:
             tries: The max number of tries to attempt.
+            cache: A local cache to get the file from, if any.
         """
 
         if self.is_local:
             raise Exception("Cannot download a LocalObject2 twice.")
 
-        self.data_obj.get(Path(self.local_folder, self.local_name), tries=tries)
+        local_path = Path(self.local_folder, self.local_name)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        if cache is not None:
+            cache.fetch(self.data_obj, local_path, tries=tries)
+        else:
+            self.data_obj.get(local_path, tries=tries)
         self.is_local = True
 
     def upload(self, tries=5):
@@ -84,57 +100,502 @@ class LocalObject2:
         self.is_local = False
 
 
+class OutputCompletion(Enum):
+    """How a script marks an output file as complete before it exits."""
+
+    SENTINEL = "sentinel"
+    """An output file is complete once an empty file with its name and a '.done'
+    suffix is created next to it."""
+
+    RENAME = "rename"
+    """Output files are written under a name starting with '.' or ending with
+    '.partial', and renamed once complete."""
+
+
+SENTINEL_SUFFIX = ".done"
+PARTIAL_SUFFIX = ".partial"
+
+# The scratch directory of each batch, and the marker naming its owner in it
+SCRATCH_PREFIX = "transponster-"
+SCRATCH_OWNER = ".transponster-owner"
+
+# Logs of the script in the working directory of each batch
+STDOUT_LOG = "stdout.log"
+STDERR_LOG = "stderr.log"
+SCRIPT_LOG_TAIL = 64 * 1024
+
+MANIFEST_NAME = "inputs.txt"
+MANIFEST_DONE = "#done"
+MANIFEST_FAILED = "#failed"
+
+
+def find_completed_outputs(
+    output_folder: PathLike, completion: OutputCompletion
+) -> List[Path]:
+    """Find the output files which a running script has marked as complete.
+
+    Args:
+        output_folder: the folder in which the script writes its outputs.
+        completion: how the script marks output files as complete.
+
+    Returns:
+        The paths of the completed output files.
+    """
+    completed = []
+    for dirpath, _, filenames in os.walk(output_folder):
+        names = set(filenames)
+        for fname in filenames:
+            if completion == OutputCompletion.SENTINEL:
+                if fname.endswith(SENTINEL_SUFFIX):
+                    target = fname[: -len(SENTINEL_SUFFIX)]
+                    if target in names:
+                        completed.append(Path(dirpath, target))
+            elif not fname.startswith(".") and not fname.endswith(PARTIAL_SUFFIX):
+                completed.append(Path(dirpath, fname))
+    return completed
+
+
+def remove_sentinels(output_folder: PathLike):
+    """Remove the '.done' sentinel files from an output folder."""
+    for dirpath, _, filenames in os.walk(output_folder):
+        for fname in filenames:
+            if fname.endswith(SENTINEL_SUFFIX):
+                remove(Path(dirpath, fname))
+
+
+def move_logs_to_output(batch: "JobBatch"):
+    """Move the script logs of a batch to its output folder, to be uploaded.
+
+    They are named after the first input of the batch, e.g. 1.fast5.stdout.log.
+    Empty logs are left out.
+    """
+    prefix = Path(batch.input_objs[0].local_name).name if batch.input_objs else "batch"
+    for name in (STDOUT_LOG, STDERR_LOG):
+        path = Path(batch.tmp_dir.name, name)
+        if path.exists() and path.stat().st_size > 0:
+            path.rename(Path(batch.output_folder_path, f"{prefix}.{name}"))
+
+
+def get_folder_size(folder: PathLike, exclude: Iterable[Path] = ()) -> int:
+    """Get the total size in bytes of the files in a folder and its subfolders.
+
+    Files removed while the folder is walked, such as outputs which are being
+    uploaded early, are left out.
+
+    Args:
+        folder: the folder.
+        exclude: paths of files to leave out, as found walking the folder.
+    """
+    exclude = set(exclude)
+    size = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for fname in filenames:
+            path = Path(dirpath, fname)
+            if path in exclude:
+                continue
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+    return size
+
+
+class ScriptLog:
+    """Writes the output of a script to a file as it runs, up to a size cap.
+
+    Output beyond max_bytes is left out of the file, which then ends with a note
+    of how much was left out and the last part of the output. The last
+    SCRIPT_LOG_TAIL bytes of the output are also kept in memory for error
+    reports.
+    """
+
+    def __init__(self, path: PathLike, max_bytes: Optional[int] = None) -> None:
+        """Create the log file.
+
+        Args:
+            path: the log file, which is replaced if it exists.
+            max_bytes: the largest amount of output to write to it, or None for
+                no limit.
+        """
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.dropped = 0
+        self._tail = bytearray()
+        # pylint: disable=consider-using-with
+        self._file = open(path, "wb")
+
+    def write(self, data: bytes):
+        """Add output to the log."""
+        self._tail += data
+        del self._tail[:-SCRIPT_LOG_TAIL]
+
+        room = len(data)
+        if self.max_bytes is not None:
+            room = max(min(room, self.max_bytes - self.written), 0)
+        if room:
+            self._file.write(data[:room])
+            self.written += room
+        self.dropped += len(data) - room
+
+    def copy(self, stream: BinaryIO):
+        """Add output read from a stream to the log until it is closed."""
+        while True:
+            data = stream.read1(64 * 1024)
+            if not data:
+                return
+            self.write(data)
+
+    @property
+    def tail(self) -> bytes:
+        """The end of the output."""
+        return bytes(self._tail)
+
+    def close(self):
+        """Finish the log file with the end of the output if some was left out."""
+        if self.dropped:
+            tail = self._tail[-self.dropped :]
+            self._file.write(
+                f"\n[transponster: {self.dropped} bytes of output left out, the "
+                f"last {len(tail)} follow]\n".encode()
+            )
+            self._file.write(tail)
+        self._file.close()
+
+
 class Script:
     """A script to run on an input file and which produces an output file
 
     It must meet the following conditions:
         - the script must take one input folder
         - the script must produce output files in a folder named "output"
+
+    The index of the processing slot running the script is available in the
+    TRANSPONSTER_SLOT environment variable.
+
+    The standard output and error of the script are written as it runs to
+    stdout.log and stderr.log in its working directory, up to log_size bytes
+    each.
     """
 
-    def __init__(self, path: PathLike) -> None:
+    def __init__(self, path: PathLike, log_size: Optional[int] = None) -> None:
 
         self.path = Path(path).resolve()
+        self.log_size = log_size
 
-    def run(self, working_dir: PathLike):
+    def run(self, working_dir: PathLike, slot: int = 0):
         """Run the script.
 
         Args:
             working_dir: the path to the working directory for the script.
+            slot: the processing slot, exported to the script as TRANSPONSTER_SLOT.
 
         Raises:
-            CalledProcessError if the script returns with a non-zero exit status.
+            CalledProcessError if the script returns with a non-zero exit status,
+            with the end of its output.
         """
         working_directory = Path(working_dir)
         input_folder = Path(working_dir, "input")
         LOGGER.debug(f"run script in directory {working_directory}")
 
-        process = subprocess.run(
-            [self.path, input_folder],
-            cwd=working_directory,
-            capture_output=True,
-            check=True,
+        command = [self.path, input_folder]
+        stdout_log = ScriptLog(Path(working_directory, STDOUT_LOG), self.log_size)
+        stderr_log = ScriptLog(Path(working_directory, STDERR_LOG), self.log_size)
+        try:
+            with subprocess.Popen(
+                command,
+                cwd=working_directory,
+                env=dict(os.environ, TRANSPONSTER_SLOT=str(slot)),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            ) as process:
+                # Both pipes must be read at the same time for the script not to block
+                stderr_copy = Thread(target=stderr_log.copy, args=(process.stderr,))
+                stderr_copy.start()
+                stdout_log.copy(process.stdout)
+                stderr_copy.join()
+        finally:
+            stdout_log.close()
+            stderr_log.close()
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                process.returncode, command, stdout_log.tail, stderr_log.tail
+            )
+        LOGGER.debug(f"script run, output in {stdout_log.path} and {stderr_log.path}")
+
+    def close(self):
+        """Release any resources held by the script."""
+
+
+class PersistentScript(Script):
+    """A script which is started once per processing slot and then runs many batches.
+
+    This avoids paying the start up cost of the script for every batch. The
+    script is started without arguments, with TRANSPONSTER_PERSISTENT=1 and
+    TRANSPONSTER_SLOT set in its environment, and must then loop:
+        - read the absolute path of a working directory, as one line on stdin
+        - process its "input" folder, placing outputs in its "output" folder
+        - write "TRANSPONSTER ok" as one line on stdout if successful, or
+          "TRANSPONSTER error <message>" if the batch failed
+    Other lines written to stdout are written to stdout.log in the working
+    directory of the batch, and its standard error to stderr.log. Output
+    written between batches goes to the logs of the next one. The script should
+    exit when stdin is closed. A script which exits while running a batch fails
+    that batch, and is started again for the next one.
+    """
+
+    REPLY_PREFIX = b"TRANSPONSTER "
+
+    def __init__(self, path: PathLike, log_size: Optional[int] = None) -> None:
+        super().__init__(path, log_size)
+        self._workers: Dict[int, subprocess.Popen] = {}
+        # Standard output read past the last reply of the script in each slot
+        self._pending: Dict[int, bytes] = {}
+        self._lock = Lock()
+
+    def _get_worker(self, slot: int) -> subprocess.Popen:
+        """Get the running script for a slot, starting it if needed."""
+        with self._lock:
+            worker = self._workers.get(slot)
+
+        if worker is not None and worker.poll() is None:
+            return worker
+
+        if worker is not None:
+            LOGGER.warning(
+                f"Persistent script in slot {slot} exited with status "
+                f"{worker.returncode}, restarting it"
+            )
+            self._close_pipes(worker)
+
+        LOGGER.debug(f"Starting persistent script in slot {slot}")
+        # pylint: disable=consider-using-with
+        worker = subprocess.Popen(
+            [self.path],
+            env=dict(
+                os.environ, TRANSPONSTER_SLOT=str(slot), TRANSPONSTER_PERSISTENT="1"
+            ),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0,
         )
+        with self._lock:
+            self._workers[slot] = worker
+            self._pending[slot] = b""
+        return worker
+
+    def run(self, working_dir: PathLike, slot: int = 0):
+        """Run the script on a batch, in the persistent script for the slot.
+
+        Args:
+            working_dir: the path to the working directory for the script.
+            slot: the processing slot.
+
+        Raises:
+            CalledProcessError if the script reports an error or exits, with the
+            end of its output.
+        """
+        working_directory = Path(working_dir).resolve()
+        command = [self.path, working_directory]
+        worker = self._get_worker(slot)
+        LOGGER.debug(f"send {working_directory} to persistent script in slot {slot}")
+
+        stdout_log = ScriptLog(Path(working_directory, STDOUT_LOG), self.log_size)
+        stderr_log = ScriptLog(Path(working_directory, STDERR_LOG), self.log_size)
+        try:
+            try:
+                worker.stdin.write(f"{working_directory}\n".encode())
+            except BrokenPipeError:
+                # The script exited, its remaining output is read below
+                pass
+            reply = self._read_reply(worker, slot, stdout_log, stderr_log)
+        finally:
+            stdout_log.close()
+            stderr_log.close()
+
+        if reply is None:
+            # The script exited before replying
+            raise subprocess.CalledProcessError(
+                worker.wait(), command, stdout_log.tail, stderr_log.tail
+            )
+
+        status, _, message = reply.strip().partition(b" ")
+        if status != b"ok":
+            stderr = stderr_log.tail
+            if stderr and not stderr.endswith(b"\n"):
+                stderr += b"\n"
+            raise subprocess.CalledProcessError(
+                1, command, stdout_log.tail, stderr + message
+            )
+        LOGGER.debug(f"script run, output in {stdout_log.path} and {stderr_log.path}")
+
+    def _read_reply(
+        self,
+        worker: subprocess.Popen,
+        slot: int,
+        stdout_log: ScriptLog,
+        stderr_log: ScriptLog,
+    ) -> Optional[bytes]:
+        """Log the output of a script until it replies, and return the reply.
+
+        Both pipes are read at the same time for the script not to block.
+        Returns None if the script exited before replying.
+        """
+        with self._lock:
+            pending = self._pending[slot]
+        logs = {worker.stdout.fileno(): stdout_log, worker.stderr.fileno(): stderr_log}
+        with selectors.DefaultSelector() as selector:
+            for fd in logs:
+                selector.register(fd, selectors.EVENT_READ)
+            while True:
+                *lines, pending = pending.split(b"\n")
+                for i, line in enumerate(lines):
+                    if line.startswith(self.REPLY_PREFIX):
+                        with self._lock:
+                            self._pending[slot] = b"\n".join(lines[i + 1 :] + [pending])
+                        # The script wrote to stderr before replying on stdout
+                        self._drain(worker.stderr.fileno(), stderr_log)
+                        return line[len(self.REPLY_PREFIX) :]
+                    stdout_log.write(line + b"\n")
+
+                if not selector.get_map():
+                    stdout_log.write(pending)
+                    return None
+                for key, _ in selector.select():
+                    data = os.read(key.fd, 64 * 1024)
+                    if not data:
+                        selector.unregister(key.fd)
+                    elif logs[key.fd] is stdout_log:
+                        pending += data
+                    else:
+                        stderr_log.write(data)
+
+    @staticmethod
+    def _drain(fd: int, log: ScriptLog):
+        """Write to a log what can be read from a pipe without waiting."""
+        while select.select([fd], [], [], 0)[0]:
+            data = os.read(fd, 64 * 1024)
+            if not data:
+                return
+            log.write(data)
+
+    @staticmethod
+    def _close_pipes(worker: subprocess.Popen):
+        for pipe in (worker.stdin, worker.stdout, worker.stderr):
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+    def close(self, timeout: float = 10):
+        """Ask all the running scripts to exit, killing them if they do not.
 
-        LOGGER.debug(process.stdout.decode())
-        LOGGER.debug(process.stderr.decode())
-        LOGGER.debug("script run")
+        Args:
+            timeout: how long to wait for each script to exit, in seconds.
+        """
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+            self._pending.clear()
+
+        for worker in workers:
+            try:
+                worker.stdin.close()
+            except BrokenPipeError:
+                pass
+            try:
+                worker.wait(timeout)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+                worker.wait()
+            self._close_pipes(worker)
 
 
 class JobBatch:
-    """An object used to track files being processed."""
+    """An object used to track files being processed.
+
+    The scratch directory of a batch is only created when it is first needed,
+    usually when the batch starts downloading, so that batches waiting to be
+    downloaded do not use any scratch space.
+
+    When inputs are processed as they arrive, the download thread lists each
+    input in a manifest file in the working directory as soon as it is local,
+    and ends the manifest with '#done', or '#failed' if an input could not be
+    downloaded.
+
+    The scratch directory holds a marker naming the host and process which own
+    it, so that directories left behind by crashed runs can be told apart from
+    those of runs still going.
+    """
 
     input_objs: List[LocalObject2]
 
     def __init__(self, scratch_location=None) -> None:
         self.input_objs = []
+        self.scratch_location = scratch_location
+        self.reserved_bytes = 0
+        self.download_error: Optional[Exception] = None
+        self._tmp_dir: Optional[TemporaryDirectory] = None
+        self._downloads_done = Event()
+        self._manifest_lock = Lock()
+
+    @property
+    def tmp_dir(self) -> TemporaryDirectory:
+        """Temporary directory for this batch, created on first access."""
+        self.allocate()
+        return self._tmp_dir
+
+    @property
+    def is_allocated(self) -> bool:
+        """Whether the temporary directory for this batch has been created."""
+        return self._tmp_dir is not None
+
+    def allocate(self):
+        """Create the temporary directory for this batch, if not already done."""
+        if self._tmp_dir is not None:
+            return
 
         # Set up temporary folders. We want to keep the TemporaryDirectory in the object,
         # so it gets destroyed at the same time as the JobBatch.
         # pylint: disable=consider-using-with
-        self.tmp_dir = TemporaryDirectory(prefix="transponster-", dir=scratch_location)
-        mkdir(Path(self.tmp_dir.name, "input"))
-        mkdir(Path(self.tmp_dir.name, "output"))
+        self._tmp_dir = TemporaryDirectory(
+            prefix=SCRATCH_PREFIX, dir=self.scratch_location
+        )
+        Path(self._tmp_dir.name, SCRATCH_OWNER).write_text(
+            f"{socket.gethostname()}:{os.getpid()}"
+        )
+        mkdir(Path(self._tmp_dir.name, "input"))
+        mkdir(Path(self._tmp_dir.name, "output"))
+
+        for obj in self.input_objs:
+            obj.local_folder = self.input_folder_path
+
+    def cleanup(self):
+        """Remove the temporary directory for this batch, if it was created."""
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+
+    def keep(self):
+        """Keep the temporary directory of this batch after the run.
+
+        It is no longer removed when the batch is garbage collected or the
+        process exits, nor as a stale directory by later runs, but still is by
+        cleanup().
+        """
+        if self._tmp_dir is None:
+            return
+        # pylint: disable=protected-access
+        self._tmp_dir._finalizer.detach()
+        Path(self._tmp_dir.name, SCRATCH_OWNER).unlink(missing_ok=True)
+
+    @property
+    def key(self) -> str:
+        """Identifier for this batch, which is the same across runs for the same inputs."""
+        # The path of a DataObject is its collection, its string the full path
+        paths = "\n".join(str(obj.data_obj) for obj in self.input_objs)
+        return sha256(paths.encode()).hexdigest()
 
     def get_output_objs(self, output_collection: Collection) -> List[LocalObject2]:
         """Get all objects to upload from the 'output' folder
@@ -154,26 +615,103 @@ class JobBatch:
             for fname in filenames:
                 fpath = Path(root, dirpath)
                 LOGGER.info(f"Adding {fpath}/{fname} to upload queue")
-                data_obj = DataObject(Path(output_collection, fname))
-                local_obj = LocalObject2(data_obj, fname, fpath, True, False)
-
-                objs.append(local_obj)
+                objs.append(self.get_output_obj(Path(fpath, fname), output_collection))
 
         return objs
 
-    def add_input_obj(self, obj: DataObject):
+    @staticmethod
+    def get_output_obj(path: Path, output_collection: Collection) -> LocalObject2:
+        """Get the object to upload for a file in the 'output' folder.
+
+        Args:
+            path: The path of the output file.
+            output_collection: The destination iRODS Collection for the object.
+
+        Returns:
+            An object which will be uploaded to the intended iRODS location.
+        """
+        data_obj = DataObject(Path(output_collection, path.name))
+        size = os.path.getsize(path)
+        return LocalObject2(data_obj, path.name, path.parent, True, False, size)
+
+    def add_input_obj(
+        self,
+        obj: DataObject,
+        size: Optional[int] = None,
+        local_name: Optional[str] = None,
+    ):
         """Add an object to the list of inputs
 
         Args:
             obj: the DataObject to add.
+            size: the size of the DataObject in bytes, if already known.
+            local_name: the path of the input relative to the input folder, by
+                default the name of the DataObject.
         """
-        local_name = obj.name
-        local_folder = self.input_folder_path
+        if local_name is None:
+            local_name = obj.name
+        local_folder = self.input_folder_path if self.is_allocated else None
         local_object = LocalObject2(
-            obj, local_name, local_folder, is_local=False, is_remote=True
+            obj, local_name, local_folder, is_local=False, is_remote=True, size=size
         )
         self.input_objs.append(local_object)
 
+    @property
+    def manifest_path(self) -> Path:
+        """Path of the manifest of local inputs for this batch."""
+        return Path(self.tmp_dir.name, MANIFEST_NAME)
+
+    def add_to_manifest(self, obj: LocalObject2):
+        """List an input which is now local in the manifest.
+
+        Args:
+            obj: the input object, which must already be downloaded.
+        """
+        self._append_to_manifest(str(Path("input", obj.local_name)))
+
+    def finish_downloads(self, error: Optional[Exception] = None):
+        """Mark all the downloads of this batch as finished.
+
+        Args:
+            error: the reason why an input could not be downloaded, if any.
+        """
+        try:
+            self._append_to_manifest(
+                MANIFEST_DONE if error is None else MANIFEST_FAILED
+            )
+        except OSError as exception:
+            error = error if error is not None else exception
+            raise
+        finally:
+            # Whatever happens, the batch must not wait for its downloads forever
+            self.download_error = error
+            self._downloads_done.set()
+
+    def wait_for_downloads(self) -> Optional[Exception]:
+        """Wait until all the downloads of this batch are finished.
+
+        Returns:
+            The reason why an input could not be downloaded, if any.
+        """
+        self._downloads_done.wait()
+        return self.download_error
+
+    def _append_to_manifest(self, line: str):
+        with self._manifest_lock:
+            with open(self.manifest_path, "a", encoding="utf-8") as manifest:
+                manifest.write(line + "\n")
+
+    @property
+    def input_size(self) -> int:
+        """Total size in bytes of the inputs of this batch.
+
+        Sizes which are not yet known are fetched from iRODS.
+        """
+        for obj in self.input_objs:
+            if obj.size is None:
+                obj.size = obj.data_obj.size()
+        return sum(obj.size for obj in self.input_objs)
+
     @property
     def input_folder_path(self):
         """Input folder path for this batch"""
@@ -185,6 +723,186 @@ class JobBatch:
         return Path(self.tmp_dir.name, "output")
 
 
+class ScratchBudget:
+    """Bytes of scratch space which batches may use at the same time.
+
+    Batches reserve the size of their inputs before they are downloaded, and
+    are charged for their outputs once they have been processed. Space is
+    released as inputs and outputs are removed from scratch. A budget without a
+    total does not limit anything.
+    """
+
+    def __init__(self, total: Optional[int] = None) -> None:
+        self.total = total
+        self._used = 0
+        self._condition = Condition()
+
+    @property
+    def limited(self) -> bool:
+        """Whether this budget limits the scratch space used."""
+        return self.total is not None
+
+    @property
+    def used(self) -> int:
+        """Bytes currently reserved by batches."""
+        with self._condition:
+            return self._used
+
+    def reserve_inputs(self, batch: JobBatch):
+        """Wait until there is enough space for the inputs of a batch, and reserve it.
+
+        A batch larger than the whole budget is let through once nothing else
+        holds any space, so that it does not wait forever.
+
+        Args:
+            batch: the batch about to be downloaded.
+        """
+        if not self.limited:
+            return
+
+        size = batch.input_size
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._used == 0 or self._used + size <= self.total
+            )
+            self._used += size
+            batch.reserved_bytes += size
+
+    def release_inputs(self, batch: JobBatch):
+        """Release the space reserved for the inputs of a batch."""
+        if self.limited:
+            self.release(batch, batch.input_size)
+
+    def release_outputs(self, batch: JobBatch):
+        """Release the space charged for the outputs of a batch, but not its inputs."""
+        if not self.limited:
+            return
+
+        input_size = batch.input_size
+        with self._condition:
+            size = max(batch.reserved_bytes - input_size, 0)
+            self._used -= size
+            batch.reserved_bytes -= size
+            self._condition.notify_all()
+
+    def charge(self, batch: JobBatch, size: int):
+        """Account for space used by a batch without waiting for it to be free.
+
+        Args:
+            batch: the batch using the space.
+            size: the number of bytes used.
+        """
+        if not self.limited:
+            return
+
+        with self._condition:
+            self._used += size
+            batch.reserved_bytes += size
+
+    def release(self, batch: JobBatch, size: Optional[int] = None):
+        """Release space held by a batch.
+
+        Args:
+            batch: the batch holding the space.
+            size: the number of bytes to release, or None to release all of them.
+        """
+        if not self.limited:
+            return
+
+        with self._condition:
+            if size is None or size > batch.reserved_bytes:
+                size = batch.reserved_bytes
+            self._used -= size
+            batch.reserved_bytes -= size
+            self._condition.notify_all()
+
+
+def parse_scratch_budget(value: str, scratch_location: Optional[PathLike]) -> int:
+    """Parse a scratch budget given as a number of bytes or a percentage.
+
+    Byte counts are parsed with parse_size. Percentages are of the size of the
+    filesystem holding the scratch location.
+
+    Args:
+        value: the budget, e.g. "500000000", "200G" or "80%".
+        scratch_location: the scratch location, or None for the default location.
+
+    Returns:
+        The budget in bytes.
+    """
+    if value.strip().endswith("%"):
+        percentage = float(value.strip()[:-1])
+        if not 0 < percentage <= 100:
+            raise ValueError(f"Invalid scratch budget percentage {value}")
+        location = scratch_location if scratch_location is not None else gettempdir()
+        return int(disk_usage(location).total * percentage / 100)
+
+    return parse_size(value)
+
+
+def parse_size(value: str) -> int:
+    """Parse a strictly positive number of bytes.
+
+    Args:
+        value: the number of bytes, with an optional K, M, G or T suffix for
+            powers of 1024, e.g. "500000000" or "200G".
+
+    Returns:
+        The number of bytes.
+    """
+    number = value.strip().upper()
+
+    multiplier = 1
+    for power, suffix in enumerate("KMGT", start=1):
+        if number.endswith(suffix):
+            multiplier = 1024**power
+            number = number[:-1]
+            break
+
+    size = int(float(number) * multiplier)
+    if size <= 0:
+        raise ValueError(f"Invalid size {value}")
+    return size
+
+
+class BatchState(Enum):
+    """State of a batch in the pipeline."""
+
+    QUEUED = auto()
+    DOWNLOADING = auto()
+    DOWNLOADED = auto()
+    PROCESSING = auto()
+    PROCESSED = auto()
+    UPLOADING = auto()
+    UPLOADED = auto()
+    FAILED = auto()
+    RETRYING = auto()
+    """Failed in its current stage, and waiting to be retried in it."""
+
+
+class BatchObserver:
+    """Notified of each batch state change. Does nothing by default."""
+
+    def batch_state_changed(self, batch: JobBatch, state: BatchState):
+        """Called by the stages of the pipeline when a batch changes state.
+
+        Args:
+            batch: the batch which changed state.
+            state: the new state of the batch.
+        """
+
+
+class BatchObservers(BatchObserver):
+    """Forwards batch state changes to several observers."""
+
+    def __init__(self, observers: List[BatchObserver]) -> None:
+        self.observers = observers
+
+    def batch_state_changed(self, batch: JobBatch, state: BatchState):
+        for observer in self.observers:
+            observer.batch_state_changed(batch, state)
+
+
 class ErrorType(Enum):
     """Type of error a batch can fail with."""
 
@@ -193,6 +911,7 @@ class ErrorType(Enum):
     UPLOAD_FAILED = auto()
     FILE_NOT_FOUND = auto()
     PERMISSION_ERROR = auto()
+    LEASE_EXPIRED = auto()
 
 
 @dataclass
@@ -202,10 +921,12 @@ class FailedJobBatch:
     job_batch: JobBatch
     exception: Exception
     reason: ErrorType
+    uploaded: List[str] = field(default_factory=list)
+    """iRODS paths of the outputs uploaded before the batch failed."""
 
     def cleanup_tmp(self):
         """Cleanup the temporary directory for the batch."""
-        self.job_batch.tmp_dir.cleanup()
+        self.job_batch.cleanup()
 
     def get_input_object_locations(self) -> List[str]:
         """Get the list of input files for the batch."""
@@ -220,9 +941,14 @@ class FailedJobBatch:
             return f"Failed to download some inputs: {self.exception}"
 
         if self.reason == ErrorType.PROCESSING_FAILED:
+            # Only the end of the output of the script is kept
             message = f"Failed to process some inputs: {self.exception}\n"
-            message += f"\tstdout:\n{self.exception.stdout.decode()}\n"
-            message += f"\tstderr:\n{self.exception.stderr.decode()}\n"
+            for stream in ("stdout", "stderr"):
+                output = getattr(self.exception, stream, None)
+                if isinstance(output, bytes):
+                    output = output.decode(errors="replace")
+                if output is not None:
+                    message += f"\t{stream}:\n{output}\n"
             return message
 
         if self.reason == ErrorType.UPLOAD_FAILED:
@@ -234,6 +960,11 @@ class FailedJobBatch:
         if self.reason == ErrorType.PERMISSION_ERROR:
             return f"Permission error whilst running a script: {self.exception}"
 
+        if self.reason == ErrorType.LEASE_EXPIRED:
+            return (
+                f"Gave up on some inputs after their leases expired: {self.exception}"
+            )
+
         # Default case for linter
         return f"Unknown failure for some inputs: {self.exception}"
 
@@ -242,56 +973,206 @@ class ClosedException(Exception):
     """Just an Exception"""
 
 
-class WrappedQueue:
-    """Wrapper around a Queue which allows to signal closing the Queue."""
-
-    _queue: Queue
-    _closed: bool
-    _put_event: Event
-    _lock: Lock
+@dataclass
+class ChannelStats:
+    """Counters describing how busy a Channel has been."""
+
+    depth: int
+    """Number of items currently in the channel."""
+    max_depth: int
+    """Largest number of items the channel held at once."""
+    n_put: int
+    """Number of items put into the channel."""
+    n_got: int
+    """Number of items taken from the channel."""
+    put_wait: float
+    """Total time in seconds producers spent waiting for the channel to have room."""
+    get_wait: float
+    """Total time in seconds consumers spent waiting for the channel to have items."""
+
+
+class Channel:
+    """A closable queue for any number of producers and consumers.
+
+    Once closed, nothing more can be put into a channel, but the items left in
+    it can still be taken out. Consumers get a ClosedException once a channel
+    is both closed and empty.
+    """
 
     def __init__(self, maxsize: int = 0) -> None:
-        self._queue = Queue(maxsize=maxsize)
+        """Create a channel.
+
+        Args:
+            maxsize: the largest number of items the channel holds at once, or 0
+                for no limit.
+        """
+        self.maxsize = maxsize
+        self._items: Deque[Any] = deque()
         self._closed = False
         self._lock = Lock()
-        self._put_event = Event()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._max_depth = 0
+        self._n_put = 0
+        self._n_got = 0
+        self._put_wait = 0.0
+        self._get_wait = 0.0
 
-    def put(self, item: Any):
-        """Put an item into the queue.
+    def put(self, item: Any, timeout: Optional[float] = None):
+        """Put an item into the channel, waiting for room if it is full.
 
         Args:
-            item: the item to put
+            item: the item to put.
+            timeout: the longest time in seconds to wait for room, or None to
+                wait for as long as needed.
+
+        Raises:
+            ClosedException: if the channel is closed, or closes while waiting.
+            queue.Full: if there was still no room after timeout seconds.
         """
-        with self._lock:
+        with self._not_full:
+            if self.maxsize > 0 and len(self._items) >= self.maxsize:
+                start = monotonic()
+                has_room = self._not_full.wait_for(
+                    lambda: self._closed or len(self._items) < self.maxsize, timeout
+                )
+                self._put_wait += monotonic() - start
+                if not has_room:
+                    raise Full
             if self._closed:
-                raise ClosedException("Cannot put to a closed WrappedQueue.")
-        self._put_event.set()
-        self._queue.put(item)
+                raise ClosedException("Cannot put to a closed Channel.")
+            self._items.append(item)
+            self._n_put += 1
+            self._max_depth = max(self._max_depth, len(self._items))
+            self._not_empty.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """Get the next item from the channel, waiting for one if it is empty.
+
+        Args:
+            timeout: the longest time in seconds to wait for an item, or None to
+                wait for as long as needed.
+
+        Raises:
+            ClosedException: if the channel is both closed and empty.
+            queue.Empty: if there was still no item after timeout seconds.
+        """
+        return self.get_many(1, timeout)[0]
+
+    def get_many(self, n: int, timeout: Optional[float] = None) -> List[Any]:
+        """Get up to n items from the channel, waiting for at least one.
+
+        Args:
+            n: the largest number of items to get.
+            timeout: the longest time in seconds to wait for an item, or None to
+                wait for as long as needed.
+
+        Raises:
+            ClosedException: if the channel is both closed and empty.
+            queue.Empty: if there was still no item after timeout seconds.
+        """
+        with self._not_empty:
+            if not self._items:
+                start = monotonic()
+                self._not_empty.wait_for(lambda: self._closed or self._items, timeout)
+                self._get_wait += monotonic() - start
+            if not self._items:
+                if self._closed:
+                    raise ClosedException("Channel is closed and empty")
+                raise Empty
+
+            items = [self._items.popleft() for _ in range(min(n, len(self._items)))]
+            self._n_got += len(items)
+            self._not_full.notify(len(items))
+            return items
 
     def close(self):
-        """Close the queue.
+        """Close the channel.
 
         Subsequent calls to put() will raise a ClosedException.
-        Subsequent calls to get() will raise a ClosedException if the queue is empty.
+        Subsequent calls to get() will raise a ClosedException once the channel is
+        empty.
         """
         with self._lock:
             self._closed = True
-            self._put_event.set()
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        """Whether the channel is closed."""
+        return self._closed
 
-    def get(self):
-        """Get the next item from the queue.
+    def empty(self) -> bool:
+        """Is the channel empty."""
+        with self._lock:
+            return not self._items
+
+    def qsize(self) -> int:
+        """Number of items in the channel."""
+        with self._lock:
+            return len(self._items)
+
+    def stats(self) -> ChannelStats:
+        """Get the counters of the channel."""
+        with self._lock:
+            return ChannelStats(
+                len(self._items),
+                self._max_depth,
+                self._n_put,
+                self._n_got,
+                self._put_wait,
+                self._get_wait,
+            )
 
-        Raises a ClosedException if the queue is both closed and empty.
+    def resize(self, maxsize: int):
+        """Change the largest number of items the channel holds at once.
+
+        Items already in the channel are kept if there are more than maxsize.
+
+        Args:
+            maxsize: the new maximum size, or 0 for no limit.
         """
-        if self._queue.empty():
-            with self._lock:
-                if self._queue.empty() and self._closed:
-                    raise ClosedException("Queue is closed and empty")
-            self._put_event.wait()
-            self._put_event.clear()
+        with self._lock:
+            self.maxsize = maxsize
+            self._not_full.notify_all()
 
-        return self._queue.get()
 
-    def empty(self) -> bool:
-        """Is the queue empty."""
-        return self._queue.empty()
+class Limiter:
+    """A semaphore whose limit can be changed while it is in use."""
+
+    def __init__(self, limit: int) -> None:
+        self._limit = limit
+        self._in_use = 0
+        self._condition = Condition()
+
+    @property
+    def limit(self) -> int:
+        """Largest number of holders at once."""
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int):
+        # Current holders above a lowered limit keep their place until released
+        with self._condition:
+            self._limit = value
+            self._condition.notify_all()
+
+    @property
+    def in_use(self) -> int:
+        """Number of current holders."""
+        return self._in_use
+
+    def acquire(self):
+        """Wait until there are fewer holders than the limit, and become one."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_use < self._limit)
+            self._in_use += 1
+
+    def release(self):
+        """Stop being a holder."""
+        with self._condition:
+            if self._in_use == 0:
+                raise ValueError("Limiter released too many times")
+            self._in_use -= 1
+            self._condition.notify()